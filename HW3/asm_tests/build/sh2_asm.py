@@ -9,18 +9,86 @@ output file suitable for loading into an SH-2 simulator. Assembled code is in
 big-endian format.
 
 Usage:
-    python sh2_assembler.py <input_file.asm> <output_file.bin>
+    python sh2_asm.py <input_file.asm> [-o <output_dir>] [--format text|bin]
+    python sh2_asm.py --jobs N <a.asm> <b.asm> ... [-o <output_dir>]
+    python sh2_asm.py -O fill-slots <input_file.asm>
+    python sh2_asm.py --split-memory -O schedule <input_file.asm>
+    python sh2_asm.py --hazards [--split-memory] <input_file.asm>
+    python sh2_asm.py --listing <input_file.asm>
+    python sh2_asm.py -c <a.asm> <b.asm> ... [-o <output_dir>]
+    python sh2_asm.py --link <a.asm|a.obj> <b.asm|b.obj> ... [-o <output_dir>]
+
+    Batch mode (several files or --jobs) assembles the programs across a pool
+    of N processes (0 for one per CPU). Each program <test>.asm is written to
+    <output_dir>/<test>/ and <output_dir>/manifest.json lists every output.
+
+    By default the memory files read by memory.vhd (build_mem0.txt through
+    build_mem3.txt, one per memory block) are written: one 16-bit binary string
+    per line commented with its address and source. With --format bin, each
+    of the four memory blocks is instead written as a raw big-endian image
+    (build_mem0.bin to build_mem3.bin) with a build.json sidecar holding the
+    block addresses and the symbol map, so tools can mmap or np.frombuffer the
+    images directly.
+
+    Assembled memory files are cached under .asm_cache/ in the build directory,
+    keyed by a hash of the source, the assembler, and the output options, so
+    unchanged programs are not re-assembled (--no-cache to bypass the cache).
+
+    With -O fill-slots, instructions are moved into branch delay slots (see
+    fill_delay_slots) and the cycles saved at each branch are printed. With
+    -O schedule, the instructions of each basic block are reordered to
+    separate loads from the instructions using them (see schedule_loads), and
+    the load-use stalls of each rescheduled block before and after are printed.
+    Load-use stalls only exist with separate instruction and data memories
+    (on the HW3 memory the MA/IF stall of a load already covers them), so
+    -O schedule must be given with --split-memory.
+
+    With --hazards, a static analysis of the HW3 pipeline is printed for each
+    program: the stall cycles of every basic block from MA/IF memory conflicts
+    and multi-cycle instructions (and the flush of taken BF/BT, or the slot
+    refetch of BF/S and BT/S not taken), then a hot list of the worst hazards,
+    so performance bugs are found without simulating. The timing is that of
+    sh2_pipe.py; with --split-memory, data accesses no longer stall fetch and
+    load-use stalls are reported instead.
+
+    With --listing, build.lst is also written: every instruction with its
+    address, encoding, SH-2 manual issue cycles and latency, cycles in the HW3
+    pipeline, and source, with cycle totals for each basic block and label
+    (and the extra cycles when the block's branch is taken, or not taken).
+
+    With -c, each source is assembled to a relocatable object,
+    <output_dir>/<name>.obj, instead of memory files. With --link, the sources
+    and objects given are linked with the runtime (lib/runtime.asm, or
+    --runtime; --no-runtime to leave it out) into a single program written to
+    the output directory. Sources are assembled to objects through the build
+    cache, so re-linking after changing one module only re-assembles that
+    module (see Linking).
+
+    The assembler can also be used in-process, which avoids paying interpreter
+    startup for every program and keeps programs isolated from each other:
+
+        from sh2_asm import assemble_file, write_mem_files
+        image = assemble_file("../asm_tests/fibonacci.asm")
+        write_mem_files(image, "../asm_tests/build/")
 
 Architecture:
-    -Lexer/Parser: reads input file line-by-line, tokenizes instructions and
-     operands, and construction internal instruction representations.
-    -Symbol Table: Maintains label definitions and reference to support forward
-     and backward label usage.
-    -Encoder : Converts each parsed instruction into its binary machine code
-     according to SH-2 encoding rules.
-    -Assembler passes: (1) parses instruction, records labels, and instruction
-     addresses (2) resolves label addresses, finalizes instruction encodings,
-     and writes output.
+    The assembler is a streaming pipeline of generators, so memory use is bound
+    by the assembled image, symbol table, and fixup list rather than the size of
+    the source:
+    -Scanner (scan_lines): reads the input line-by-line, strips comments, and
+     splits each line into its label, operation, and operands.
+    -Parser/Encoder (parse_statements): turns each statement into an IR record
+     (section change, label, data, or instruction encoded according to SH-2
+     encoding rules).
+    -Layout (assemble): places IR records in sections, maintains the symbol
+     table, and records a fixup for every PC-relative branch.
+    -Relaxation (relax_branches): once all sections are placed, expands every
+     branch whose target is out of range (see Branches).
+    -Fixups (resolve_fixups): once all labels are known, fills in the
+     displacement of every branch.
+    The layout stage alone (assemble_object) produces a relocatable object;
+    placing its sections and the last two stages (locate) run when it is
+    linked, so a program of several modules is placed and resolved as one.
 
 Directives:
     .text : Marks the beginning of the program code section. Contains the SH-2
@@ -30,16 +98,115 @@ Directives:
     .vectable : Defines the exception and interrupt vector table. This section
                 holds the vector addresses used by the CPU. Entries are specified
                 as labels paired with their corresponding 32-bit handler addresses.
+    .section name, addr : Starts (or resumes, if no address is given) a named
+                          section placed at addr.
+    .org addr : Continues the current section at addr.
+    .pool : Places the literals loaded since the last pool here.
+    .space size[, fill] : Reserves size bytes (of fill, by default 0).
+    .fill count[, size[, value]] : Places count values of size (1, 2, or 4)
+                                   bytes (by default count bytes of 0).
+    .align alignment[, fill] : Pads (with fill, by default 0) to a multiple
+                               of alignment bytes (a power of two).
+    .incbin "file"[, skip[, count]] : Includes the bytes of a file (relative
+                                      to the source file), optionally only
+                                      count bytes after the first skip.
+    .equ name, expr : Defines a symbol for the value of expr.
+    .set name, expr : Defines a symbol that may be redefined later in the
+                      source (expr must be constant).
+    .global name[, name ...] : Makes labels and symbols visible to the other
+                               modules of a linked program (also .globl).
+
+    .text, .data, and .vectable may also be given an address. By default the
+    vector table is at 0x0 with the program text right after it, and the data
+    section is at 0x400 (the runs of a section without an address are packed
+    one after another, in source and then link order, and packed again as
+    relaxed branches grow them). Sections may be placed anywhere in the four
+    memory.vhd blocks (0x000, 0x400, 0x800, 0xFFFFFC00, 1 KB each); sections
+    that overlap or do not fit in a block are errors. Instructions, data
+    directives, and labels may appear in any section.
+
+Expressions:
+    Immediates (#imm), displacements (@(disp, Rn), @(disp, GBR), @(disp, PC)),
+    literals, branch targets, data values, and section addresses may be
+    constant expressions of numbers, .equ/.set symbols, and labels using
+    + - * / << >> & | ^ ~ and parentheses (with C precedence; / truncates toward
+    zero). Expressions of labels are evaluated once all labels are placed.
+    Every value is checked against the range of the field it is encoded in:
+    displacements are unsigned (in units of the access size), immediates of
+    MOV, ADD, and CMP/EQ are signed bytes, and other immediates are bytes.
+    0x80 to 0xFF are still accepted by MOV, ADD, and CMP/EQ as the byte
+    pattern, with a warning that the value is sign-extended.
+
+        .equ    STRIDE, 4
+        .equ    TABLE_LEN, TableEnd - Table
+        MOV     #TABLE_LEN / STRIDE, R1
+        MOV.L   @((Count - Table) / 4, R2), R3
+
+Literals:
+    MOV.L #imm, Rn, MOV.W #imm, Rn, and MOV.L =label, Rn load a constant (or
+    the address of a label) from a literal pool with MOV.L/MOV.W @(disp,PC), Rn.
+    Constants that fit in 8 bits become MOV #imm, Rn and those that fit in 16
+    bits are loaded with MOV.W. Repeated constants share one pool entry. Pools
+    are placed at .pool, after the delay slot of BRA, JMP, RTS, and RTE, and at
+    the end of each section run; a pool more than 1020 bytes (510 for MOV.W)
+    past its load is an error.
+
+Branches:
+    BF/BT reach 256 bytes and BRA 4 KB around the branch. Branch displacements
+    are from the branch address plus PC_OFFSET, which is 0 for the HW3 CPU
+    (the SH-2 itself branches relative to PC+4). Branches that do not reach
+    their target are relaxed until every branch fits:
+    -BF/BT label becomes BT/BF over a BRA label (and its NOP delay slot).
+    -BF/S/BT/S label becomes BT/BF over a BRA label with the delay slot
+     instruction in the slot of the BRA, and a copy of it where BT/BF goes
+     (so it still runs whether or not the branch is taken).
+    -BRA label becomes its delay slot instruction followed by a JMP through R0
+     to the address of label in a literal; R0 is pushed on the R15 stack and
+     popped in the JMP delay slot, so the stack must be valid.
+    -BSR label becomes its delay slot instruction followed by a JSR through R0
+     the same way (with a BRA over the literal, so the call returns past it).
+    Out of range BRAs and BSRs with labeled delay slots are errors.
+
+Linking:
+    A relocatable object (assemble_object, write_object) holds the sections of
+    a module before they are placed, its symbol table (labels by section and
+    offset, and .equ/.set symbols), its relocations (the fixups still to be
+    filled in), and the names it makes .global. Objects are JSON files.
+    link combines objects: labels and symbols that are not .global are local
+    to their module, a .global name may only be defined by one module, and
+    references to names no module defines are undefined symbol errors. The
+    runtime linked first provides:
+    -__start: the code at 0x0 the CPU starts at, which sets VBR to the trap
+     table, R15 to the top of memory, and calls main (defined .global by a
+     module) with JSR, then ends the program with SLEEP at __exit.
+    -__vectors: the TRAPA vector table (TRAPA #0 ends the program, the others
+     return from the trap).
+    -memcpy(R4 dst, R5 src, R6 n) and memset(R4 dst, R5 byte, R6 n), returning
+     dst in R0, which copy or fill by longs when all arguments are multiples
+     of 4 and by bytes otherwise (R1, R2, R5, and R6 are not preserved).
 
 Author: Garrett Knuf
 Date: April 25 2025
 """
 
+import argparse
+import ast
+import hashlib
+import json
 import re
 import sys
 import struct
 import math
+import operator
 import os
+import shutil
+import tempfile
+import time
+import warnings
+from collections import ChainMap, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
 
 # Convert n in Rn to integer value
 REGISTER_MAP = {
@@ -256,15 +423,534 @@ INSTRUCTION_SET = {
 
 }
 
-# Create list of labels during first pass for later assingments
-label_dict = {}
+# Address of chunks
+CHUNK0_ADDR = 1024*0
+CHUNK1_ADDR = 1024*1
+CHUNK2_ADDR = 1024*2
+CHUNK3_ADDR = 0xFFFFFC00 # end of memory space
+CHUNK_SIZE = 1024
+
+# Memory blocks of memory.vhd (address, size) as instantiated by tb_sh2_cpu.vhd
+MEM_BLOCKS = (
+    (CHUNK0_ADDR, CHUNK_SIZE),
+    (CHUNK1_ADDR, CHUNK_SIZE),
+    (CHUNK2_ADDR, CHUNK_SIZE),
+    (CHUNK3_ADDR, CHUNK_SIZE),
+)
+
+# Default base address of the predefined sections (.text follows the vector table)
+SECTION_ADDRS = {
+    ".vectable": CHUNK0_ADDR,
+    ".text": None,
+    ".data": CHUNK1_ADDR,
+}
+
+# Default output directory of the memory files (relative to the run directory)
+OUTPUT_DIR = '../asm_tests/build/'
+
+# Memory files written for each output format
+OUTPUT_FILES = {
+    "text": ("build_mem0.txt", "build_mem1.txt", "build_mem2.txt", "build_mem3.txt"),
+    "bin":  ("build_mem0.bin", "build_mem1.bin", "build_mem2.bin", "build_mem3.bin",
+             "build.json"),
+}
+
+# Cycle-annotated listing (--listing)
+LISTING_FILE = "build.lst"
+
+# Relocatable objects (-c, --link) and the runtime linked before other modules
+OBJECT_FORMAT = "sh2-object"
+OBJECT_VERSION = 1
+OBJECT_EXT = ".obj"
+OBJECT_FILE = "module.obj"          # object of a source in the build cache
+RUNTIME_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            os.pardir, "lib", "runtime.asm")
+
+# Build cache of previously assembled programs (keyed by content hash)
+CACHE_DIR = os.path.join(OUTPUT_DIR, '.asm_cache')
+CACHE_MAX_BYTES = 64 * 1024 * 1024     # evict least recently used beyond this size
+CACHE_MAX_AGE = 14 * 24 * 60 * 60      # evict entries unused for two weeks (seconds)
+HASH_CHUNK_SIZE = 1024 * 1024          # bytes of source hashed at a time
+REPORT_FILE = "report.json"            # optimization report of a cached build
+
+# PC relative branches (8-bit and 12-bit displacement)
+BRANCHES_DISP8 = ('BF', 'BF/S', 'BT', 'BT/S')
+BRANCHES_DISP12 = ('BRA', 'BSR')
+PC_REL_BRANCHES = BRANCHES_DISP8 + BRANCHES_DISP12
+BRANCH_RANGE = {8: (-0x80, 0x7F), 12: (-0x800, 0x7FF)}     # displacement (words)
+
+# Out of range conditional branches are relaxed to the inverted (not delayed)
+# branch over a BRA (INVERTED_BRANCHES), out of range BRAs to a jump through R0
+# to an address in a literal pool (R0 is saved on the stack and restored in the
+# slot), and out of range BSRs to a call through R0 the same way (LONG_CALL,
+# with a BRA over the literal before the JSR so the call returns past it)
+INVERTED_BRANCHES = {'BF': 'BT', 'BT': 'BF', 'BF/S': 'BT', 'BT/S': 'BF'}
+LONG_BRANCH = ("MOV.L   R0, @-R15", "MOV.L   @(0, PC), R0", "JMP     @R0", "MOV.L   @R15+, R0")
+LONG_CALL = ("MOV.L   R0, @-R15", "MOV.L   @(0, PC), R0", "BRA     0", "NOP",
+             "JSR     @R0", "MOV.L   @R15+, R0")
+
+# Range of the value of each operand type holding an immediate or displacement
+# (displacements are unsigned; immediates are bytes, but sign-extended by
+# SIGNED_IMMEDIATES, so 0x80 to 0xFF given to those are taken as the byte
+# pattern with a warning that the value loaded is negative)
+FIELD_RANGES = {
+    "imm":          (-0x80, 0xFF),
+    "indexed":      (0, 0xF),
+    "indexed_gbr":  (0, 0xFF),
+    "indexed_pc":   (0, 0xFF),
+}
+SIGNED_IMMEDIATES = ('MOV', 'ADD', 'CMP/EQ')
+SIGNED_BYTE_RANGE = (-0x80, 0x7F)
+
+# Range of the values of each data directive (signed or unsigned), the struct
+# format they are packed with, and the directive of each .fill size
+DATA_RANGES = {
+    ".byte": (-(1 << 7), (1 << 8) - 1),
+    ".word": (-(1 << 15), (1 << 16) - 1),
+    ".long": (-(1 << 31), (1 << 32) - 1),
+}
+DATA_FORMATS = {".byte": "B", ".word": "H", ".long": "I"}
+FILL_DIRECTIVES = {1: ".byte", 2: ".word", 4: ".long"}
+
+# .incbin "file"[, skip[, count]] (the quotes are optional)
+INCBIN_RE = re.compile(r'\s*(?:"(?P<quoted>[^"]+)"|(?P<file>[^\s,]+))\s*(?:,(?P<args>.*))?$')
+
+# Operators allowed in constant expressions. Python's precedence of these is
+# the same as C's; division truncates toward zero like C
+EXPR_OPERATORS = {
+    ast.Add:    operator.add,
+    ast.Sub:    operator.sub,
+    ast.Mult:   operator.mul,
+    ast.Div:    lambda a, b: abs(a) // abs(b) * (1 if (a < 0) == (b < 0) else -1),
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitAnd: operator.and_,
+    ast.BitOr:  operator.or_,
+    ast.BitXor: operator.xor,
+    ast.USub:   operator.neg,
+    ast.UAdd:   operator.pos,
+    ast.Invert: operator.invert,
+}
+EXPR_NODES = (ast.Expression, ast.BinOp, ast.UnaryOp, ast.Constant, ast.Name, ast.Load,
+              *EXPR_OPERATORS)
+
+# Symbol names in expressions, binary numbers (e.g., b1010, like parse_value),
+# and the leading zeros of decimal numbers (which Python does not accept)
+NAME_RE = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*")
+BINARY_RE = re.compile(r"\bb([01]+)\b")
+LEADING_ZEROS_RE = re.compile(r"\b0+(?=\d)")
+
+# Names that cannot be defined as symbols
+RESERVED_NAMES = frozenset(REGISTER_MAP) | {"SR", "GBR", "VBR", "PR", "PC", "MACH", "MACL"}
+
+# Offset of PC from the address of the executing instruction in PC-relative
+# addressing. The HW3 CPU computes branch targets and @(disp,PC) addresses from
+# the address of the instruction itself (PC + 4 in the SH-2 manual).
+PC_OFFSET = 0
+
+# PC relative loads whose base address is the PC with its low two bits cleared
+# (MOVA uses the PC as is on the HW3 CPU, DAU_AddrPC in cu.vhd)
+PC_MASKED_LOADS = ('MOV.L',)
+
+# Literal loads (MOV.L #imm, Rn / MOV.L =label, Rn / MOV.W #imm, Rn) and the
+# PC-relative loads they become once their constant is placed in a literal pool
+LITERAL_RE = re.compile(r"""\s*(?:\#(?P<imm>[^,]+?)|=(?P<label>[^,]+?))
+                            \s*,\s*R(?P<reg>1[0-5]|[0-9])\s*$""", re.IGNORECASE | re.VERBOSE)
+LITERAL_LOADS = {"MOV.W": 0x9000, "MOV.L": 0xD000}
+
+# Unconditional branches, after whose delay slot a pending literal pool is placed
+POOL_BRANCHES = ('BRA', 'JMP', 'RTS', 'RTE')
+
+# Branches followed by a delay slot (the slot instruction executes before the
+# branch target) and conditional branches that flush the next instruction when
+# taken (TakeBranch/FlushPL in sh2_cpu.vhd)
+DELAYED_BRANCHES = ('BF/S', 'BT/S', 'BRA', 'BSR', 'BRAF', 'BSRF', 'JMP', 'JSR', 'RTS', 'RTE')
+FLUSHING_BRANCHES = {'BF': 'BF/S', 'BT': 'BT/S'}
+
+# Branches whose slot the fill-slots optimization fills (not calls: the NOP
+# left after their slot is where they return to, so it would still execute)
+FILLED_BRANCHES = ('BF', 'BT', 'BF/S', 'BT/S', 'BRA', 'JMP', 'RTS')
+
+# Instructions that may not be moved into a delay slot: branches, exceptions,
+# PC-relative loads (their displacement depends on their address), and writes
+# of SR
+SLOT_ILLEGAL = DELAYED_BRANCHES + tuple(FLUSHING_BRANCHES) + ('TRAPA', 'SLEEP', 'MOVA')
+
+# Instructions that set the T bit, and those that read it (other than the
+# conditional branches)
+T_WRITERS = ('CLRT', 'SETT', 'CMP/EQ', 'CMP/GE', 'CMP/GT', 'CMP/HI', 'CMP/HS',
+             'CMP/PL', 'CMP/PZ', 'CMP/STR', 'TST', 'TST.B', 'DT', 'TAS.B',
+             'ROTL', 'ROTR', 'ROTCL', 'ROTCR', 'SHAL', 'SHAR', 'SHLL', 'SHLR',
+             'ADDC', 'ADDV', 'SUBC', 'SUBV', 'NEGC', 'DIV0U')
+T_READERS = ('ADDC', 'SUBC', 'NEGC', 'ROTCL', 'ROTCR', 'MOVT') + BRANCHES_DISP8
+
+# Instructions that write the MACH/MACL multiply registers, and those that
+# accumulate into them (HW3 only implements CLRMAC; the multiplies are listed
+# so their effects are right if they are added)
+MAC_WRITERS = ('CLRMAC', 'MAC.W', 'MAC.L', 'MUL.L', 'MULS.W', 'MULU.W', 'DMULS.L', 'DMULU.L')
+MAC_READERS = ('MAC.W', 'MAC.L')
+
+# Instructions that only read their last operand
+DEST_READ_ONLY = ('CMP/EQ', 'CMP/GE', 'CMP/GT', 'CMP/HI', 'CMP/HS', 'CMP/PL',
+                  'CMP/PZ', 'CMP/STR', 'TST', 'TST.B', 'BRAF', 'BSRF', 'JMP', 'JSR')
+
+# Instructions that overwrite their last operand without reading it (by prefix)
+DEST_WRITE_ONLY = ('MOV', 'MOVA', 'MOVT', 'STC', 'STS', 'LDC', 'LDS', 'EXTS', 'EXTU',
+                   'NEG', 'NOT', 'SWAP')
+
+# Instructions that read and write back a byte in memory
+READ_MODIFY_WRITE = ('TAS.B', 'AND.B', 'OR.B', 'XOR.B')
+
+# Registers each operand type addresses (memory operands also access "MEM")
+OPERAND_REGS = {
+    "reg":              lambda v: (f"R{v}",),
+    "mem":              lambda v: (f"R{v}", "MEM"),
+    "inc":              lambda v: (f"R{v}", "MEM"),
+    "dec":              lambda v: (f"R{v}", "MEM"),
+    "indexed":          lambda v: (f"R{v[1]}", "MEM"),
+    "indexed_gbr":      lambda v: ("GBR", "MEM"),
+    "indexed_r0_gbr":   lambda v: ("R0", "GBR", "MEM"),
+    "r0_indexed":       lambda v: ("R0", f"R{v}", "MEM"),
+    "indexed_pc":       lambda v: ("PC", "MEM"),
+    "sr":               lambda v: ("SR", "T"),
+    "gbr":              lambda v: ("GBR",),
+    "vbr":              lambda v: ("VBR",),
+    "pr":               lambda v: ("PR",),
+    "pc":               lambda v: ("PC",),
+    "imm":              lambda v: (),
+    "label":            lambda v: (),
+}
+
+# Optimization pass reports (cycles saved each time the code runs, or each
+# time the branch is taken)
+Optimization = namedtuple("Optimization", "line_num message cycles when")
+
+# HW3 pipeline timing used by the static analyses (cycles), matching the model
+# of sh2_pipe.py. memory.vhd has a single port, so a data access in MA holds
+# off the next instruction fetch (UpdateIR in cu.vhd, then WaitForFetch). That
+# stall also covers the write back of loaded data (UseWB), so a load only
+# stalls the instruction using its register with a separate data memory
+# (split_memory). Branches are resolved in EX: taken BF/BT flush the
+# instruction behind them (FlushPL), and BF/S and BT/S not taken fetch their
+# slot again.
+MA_STALL = 1            # per data access, from the MA/IF memory conflict
+LOAD_USE_STALL = 1      # next instruction reads a loaded register (split memory)
+BRANCH_FLUSH = 1        # taken BF/BT flush the next instruction
+SLOT_REFETCH = 1        # BF/S and BT/S not taken fetch their slot again
+
+# MA/IF stalls of instructions accessing memory that differ from one
+MEM_ACCESSES = {
+    "RTE": 0,           # pops PC and SR, and the branch refetches anyway
+    "JMP": 0, "JSR": 0, # @Rn is the target, not an access
+    "SLEEP": 0,
+}
+
+# Control unit states of instructions taking more than one (not counting
+# WaitForFetch, the MA/IF stall)
+EXTRA_STATES = {
+    "TAS.B": 1, "AND.B": 1, "OR.B": 1, "XOR.B": 1,  # read-modify-write (WriteBack)
+    "TRAPA": 2,                                     # push PC, read vector
+    "RTE": 1,                                       # pop SR
+}
+
+# Issue cycles of instructions taking more than one (SH-2 Programming Manual,
+# Appendix A; conditional branches are listed as taken/not taken)
+ISSUE_CYCLES = {
+    "BF": (3, 1), "BT": (3, 1), "BF/S": (2, 1), "BT/S": (2, 1),
+    "BRA": 2, "BSR": 2, "BRAF": 2, "BSRF": 2, "JMP": 2, "JSR": 2, "RTS": 2,
+    "RTE": 4, "TRAPA": 8, "SLEEP": 3, "TAS.B": 4,
+    "AND.B": 3, "OR.B": 3, "XOR.B": 3, "TST.B": 3,
+    "LDC.L": 3, "STC.L": 2,
+}
+LOAD_LATENCY = 2        # cycles until a loaded register may be used (others 1)
+
+# Instructions that end a basic block (after their delay slot, if any)
+BLOCK_ENDS = PC_REL_BRANCHES + ('BRAF', 'BSRF', 'JMP', 'JSR', 'RTS', 'RTE', 'TRAPA', 'SLEEP')
+
+# Assembled instruction: address, machine code, and source statement
+Instruction = namedtuple("Instruction", "addr word stmt")
+
+# Pipeline hazard: kind ("MA/IF", "multi-cycle", "load-use", "branch flush",
+# "slot refetch"), address of the instruction that stalls, stall cycles, and
+# the instructions involved
+Hazard = namedtuple("Hazard", "kind addr cycles instructions")
+
+
+# Source statement: a non-empty line split into label, operation, and operands
+Statement = namedtuple("Statement", "line_num line label op args")
+
+# Intermediate representation records passed from the parser to the layout
+# stage of the assembler. Each record is a tuple of its kind followed by:
+IR_SECTION = "section"  # name, address (or None to resume/default)
+IR_ORG = "org"          # address
+IR_VECTOR = "vector"    # name, handler address
+IR_LABEL = "label"      # name
+IR_DATA = "data"        # bytes, whether word aligned, (directive, offset, expression) of values of labels
+IR_SYMBOL = "symbol"    # name, value (or expression of labels)
+IR_GLOBAL = "global"    # names visible to other modules
+IR_ALIGN = "align"      # alignment (bytes), fill byte
+IR_INSTR = "instr"      # 16-bit word, fixup (see encode_instruction) or None, source line
+IR_LITERAL = "literal"  # constant size (2 or 4), value (or None), label (or None), Rn, source line
+IR_POOL = "pool"        # place the literals loaded since the last pool
+
+
+@dataclass
+class Section:
+    """
+    Contiguous run of assembled bytes. A section directive or .org starts a new
+    run, so the program is stored sparsely as a list of runs and unused memory
+    is only filled in when the memory files are written.
+    """
+    name: str                                           # section name (e.g., ".text")
+    addr: int                                           # base address (None until placed)
+    data: bytearray = field(default_factory=bytearray)  # contents (big-endian)
+    source: dict = field(default_factory=dict)          # offset -> source line of instruction
+    align: int = 4                                      # alignment of the base address once placed
+
+    @property
+    def end(self):
+        """Address just past the end of the section."""
+        return self.addr + len(self.data)
+
+
+@dataclass
+class Fixup:
+    """
+    PC-relative reference recorded during the first pass that is filled in
+    once all labels are known: a branch displacement, a literal pool load
+    displacement, a label address stored in a literal pool or data (".long", etc.),
+    or an instruction with expressions of labels (encoded from its operands).
+    """
+    opcode: str         # mnemonic (e.g., "BF", "BRA", "MOV.L", ".long")
+    label: str          # target label (or expression of labels)
+    section: Section    # section holding the reference
+    offset: int         # offset of the reference in the section
+    operands: str = None    # operand field of an instruction encoded once labels are known
+
+    @property
+    def addr(self):
+        """Address of the reference."""
+        return self.section.addr + self.offset
 
-# Create list of relative branches during first pass for later assignment
-pc_rel_branch_list = []
 
+@dataclass
+class Image:
+    """
+    Assembled SH-2 program. By default the code segment (vector table followed
+    by the program text) is placed in chunk 0 and the data segment in chunk 1,
+    but .section and .org can place code and data anywhere in the four memory
+    blocks. The contents are kept as bytes; they are only formatted as text
+    when the memory files are written.
+    """
+    sections: list = field(default_factory=list)    # Section runs in source order
+    vectors: list = field(default_factory=list)     # (name, address) vector entries
+    symbols: dict = field(default_factory=dict)     # label name -> address
+    constants: dict = field(default_factory=dict)   # .equ/.set name -> value (or expression)
+    fixups: list = field(default_factory=list)      # PC-relative branch fixups
+    report: list = field(default_factory=list)      # Optimizations applied
+
+
+@dataclass
+class ObjectFile:
+    """
+    Relocatable object: an assembled module whose sections without an address
+    are only placed, and whose fixups (relocations) are only resolved, once it
+    is linked with the other modules of the program.
+    """
+    image: Image                                    # sections, fixups, constants, vectors
+    labels: dict = field(default_factory=dict)      # label -> (section, offset)
+    aligns: list = field(default_factory=list)      # (label, alignment) of each .align
+    globals: set = field(default_factory=set)       # names visible to other modules
+
+
+@dataclass
+class BasicBlock:
+    """
+    Straight-line run of instructions entered only at the top (a label or the
+    instruction after a branch) and left only at the bottom (a branch and its
+    delay slot, or falling through to the next block).
+    """
+    start: int                                          # address of the first instruction
+    label: str = None                                   # label at the start (if any)
+    instructions: list = field(default_factory=list)    # Instructions in the block
+    hazards: list = field(default_factory=list)         # Hazards found in the block
+    loop: bool = False                                  # inside a backward branch
+
+    @property
+    def stalls(self):
+        """Stall cycles each time the block runs (not counting branch flushes)."""
+        return sum(h.cycles for h in self.hazards
+                   if h.kind not in ("branch flush", "slot refetch"))
+
+    @property
+    def flush(self):
+        """Cycles lost when the BF/BT ending the block is taken and flushes."""
+        return sum(h.cycles for h in self.hazards if h.kind == "branch flush")
+
+    @property
+    def refetch(self):
+        """Cycles lost when the BF/S or BT/S ending the block is not taken."""
+        return sum(h.cycles for h in self.hazards if h.kind == "slot refetch")
+
+
+# Register number 0-15 (e.g., the 7 in R7)
+_REG = r"(?:1[0-5]|[0-9])"
+
+# Single-pass operand classifier. Each alternative captures into a named group
+# matching the operand type it identifies so that the type of a match is its
+# lastgroup. Order matters: @(R0, ...) must be tried before @(disp, ...).
+OPERAND_RE = re.compile(rf"""
+      \#(?P<imm>.+)                                             # #imm
+    | @-R(?P<dec>{_REG})                                        # @-Rn
+    | @R(?P<inc>{_REG})\+                                       # @Rn+
+    | @R(?P<mem>{_REG})                                         # @Rn
+    | @\(\s*R0\s*,\s*(?:(?P<indexed_r0_gbr>GBR)                 # @(R0, GBR)
+                     |R(?P<r0_indexed>{_REG}))\s*\)             # @(R0, Rn)
+    | @\(\s*(?P<disp>[^,]+?)\s*,\s*(?:R(?P<indexed>{_REG})      # @(disp, Rn)
+                                      |(?P<indexed_gbr>GBR)     # @(disp, GBR)
+                                      |(?P<indexed_pc>PC))\s*\) # @(disp, PC)
+    | R(?P<reg>{_REG})                                          # Rn
+    | (?P<sr>SR) | (?P<gbr>GBR) | (?P<vbr>VBR) | (?P<pr>PR) | (?P<pc>PC)
+    """, re.VERBOSE | re.IGNORECASE)
+
+# Operand value of each operand type given its match (immediates and
+# displacements that are not plain numbers are kept as expressions)
+OPERAND_VALUES = {
+    "imm":              lambda m: parse_number(m["imm"]),
+    "dec":              lambda m: int(m["dec"]),
+    "inc":              lambda m: int(m["inc"]),
+    "mem":              lambda m: int(m["mem"]),
+    "indexed_r0_gbr":   lambda m: None,
+    "r0_indexed":       lambda m: int(m["r0_indexed"]),
+    "indexed":          lambda m: (parse_number(m["disp"]), int(m["indexed"])),
+    "indexed_gbr":      lambda m: parse_number(m["disp"]),
+    "indexed_pc":       lambda m: parse_number(m["disp"]),
+    "reg":              lambda m: int(m["reg"]),
+    "sr":               lambda m: None,
+    "gbr":              lambda m: None,
+    "vbr":              lambda m: None,
+    "pr":               lambda m: None,
+    "pc":               lambda m: None,
+}
+
+# Splits the operand field by commas, preserving grouping like @(disp,PC) (and
+# parentheses in the displacement)
+OPERANDS_RE = re.compile(r"\s*(@?\((?:[^()]|\((?:[^()]|\([^()]*\))*\))*\)|[^,]+)")
+
+# Label definition at the start of a line (e.g., "Loop:")
+LABEL_RE = re.compile(r"([A-Za-z_][A-Za-z0-9_]*):")
+
+
+def parse_number(text):
+    """
+    Parses an immediate or displacement: a plain number is returned as an int,
+    anything else as an expression to be evaluated (see evaluate).
+    """
+    text = text.strip()
+    try:
+        return int(text, 0)
+    except ValueError:
+        return text
+
+
+@lru_cache(maxsize=4096)
+def parse_expression(expr):
+    """
+    Parses a constant expression into a Python expression tree, accepting only
+    numbers, names, and the operators in EXPR_OPERATORS.
+
+    Raises:
+        ValueError: if expr is not a valid constant expression
+    """
+    text = LEADING_ZEROS_RE.sub("", BINARY_RE.sub(r"0b\1", expr.strip()))
+    try:
+        tree = ast.parse(text, mode='eval')
+    except SyntaxError:
+        raise ValueError(f"Invalid expression: {expr}") from None
+    for node in ast.walk(tree):
+        if not isinstance(node, EXPR_NODES) or (isinstance(node, ast.Constant) and
+                                                type(node.value) is not int):
+            raise ValueError(f"Invalid expression: {expr}")
+    return tree.body
+
+
+@lru_cache(maxsize=4096)
+def expression_names(expr):
+    """
+    Finds the (uppercase) symbol names an expression refers to.
+    """
+    if isinstance(expr, int):
+        return frozenset()
+    return frozenset(node.id.upper() for node in ast.walk(parse_expression(expr))
+                     if isinstance(node, ast.Name))
+
+
+def evaluate(expr, symbols=None):
+    """
+    Evaluates a constant expression. Symbols may themselves be defined by
+    expressions, which are evaluated in turn. An expression that is just a
+    symbol (including internal labels like .LIT0) is looked up directly.
+
+    Args:
+        expr (str or int): the expression (or its value)
+        symbols (dict): uppercase symbol name -> value or expression
+
+    Returns:
+        int: the value of the expression
+
+    Raises:
+        ValueError: if the expression is invalid or uses an undefined symbol
+    """
+    if isinstance(expr, int):
+        return expr
+    symbols = {} if symbols is None else symbols
+
+    def value(node):
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.Name):
+            name = node.id.upper()
+            if name not in symbols:
+                raise ValueError(f"Undefined symbol: {node.id}")
+            return evaluate(symbols[name], symbols)
+        if isinstance(node, ast.UnaryOp):
+            return EXPR_OPERATORS[type(node.op)](value(node.operand))
+        return EXPR_OPERATORS[type(node.op)](value(node.left), value(node.right))
+
+    try:
+        if expr.upper() in symbols:
+            return evaluate(symbols[expr.upper()], symbols)
+        return value(parse_expression(expr))
+    except ZeroDivisionError:
+        raise ValueError(f"Division by zero: {expr}") from None
+    except RecursionError:
+        raise ValueError(f"Circular symbol definition: {expr}") from None
+
+
+def is_constant(expr, symbols):
+    """
+    Checks that every symbol an expression refers to is defined in symbols.
+    """
+    if isinstance(expr, str) and expr.upper() in symbols:
+        return True
+    return all(name in symbols for name in expression_names(expr))
+
+
+def substitute(expr, symbols):
+    """
+    Replaces the symbols defined in symbols by their values, so an expression
+    of labels that is evaluated later does not see symbols redefined by .set.
+    """
+    return NAME_RE.sub(lambda m: f"({symbols[m[0].upper()]})" if m[0].upper() in symbols
+                       else m[0], expr)
+
+
+@lru_cache(maxsize=4096)
 def parse_operand(op):
     """
     Parses a single operand string from SH-2 assembly syntax and classifies it.
+    The operand is classified in a single match against OPERAND_RE, and since
+    programs reuse the same few operands over and over, results are cached.
 
     Operand types
     - Immediate values (e.g., "#10")
@@ -283,114 +969,55 @@ def parse_operand(op):
             - type (str): The operand type identifier, e.g., "imm", "reg", "label".
             - value: The operand value(s)
     """
-    op = op.strip().upper()
-    op = re.sub(r"\s+", "", op)  # remove whitespace
-    
-    # Immediate value (e.g., #10, #-5)
-    if re.match(r"#-?\d+", op):
-        return "imm", int(op[1:], 0)
-
-    # Pre-decrement (e.g., @-R4)
-    if re.match(r"@-R\d+", op):
-        reg = REGISTER_MAP[op[2:]]
-        return "dec", reg
-
-    # Post-increment (e.g., @R3+)
-    if re.match(r"@R\d+\+", op):
-        reg = REGISTER_MAP[op[1:-1]]
-        return "inc", reg
-
-    # Indirect (e.g., @R3)
-    if re.match(r"@R\d+", op):
-        reg = REGISTER_MAP[op[1:]]
-        return "mem", reg
-
-    # Indexed displacement with register (e.g., @(4, R2))
-    match = re.match(r"@\s*\(\s*([-+]?\d+)\s*,\s*R(\d+)\s*\)", op)
-    if match:
-        disp = int(match.group(1), 0)
-        reg = int(match.group(2))
-        return "indexed", (disp, reg)
-    
-    # Indexed displacement with GBR (e.g., @(4, GBR))
-    match_gbr = re.match(r"@\s*\(\s*([-+]?\d+)\s*,\s*GBR\s*\)", op)
-    if match_gbr:
-        disp = int(match_gbr.group(1), 0)  # Handle the displacement
-        return "indexed_gbr", disp
-    
-    # Indexed displacement with R0 and GBR (e.g., @(R0, GBR))
-    match_r0_gbr = re.match(r"@\s*\(\s*R0\s*,\s*GBR\s*\)", op)
-    if match_r0_gbr:
-        return "indexed_r0_gbr", None
-    
-    # Indexed displacement with PC (e.g., @(4, PC))
-    match_pc = re.match(r"@\s*\(\s*([-+]?\d+)\s*,\s*PC\s*\)", op)
-    if match_pc:
-        disp = int(match_pc.group(1), 0)    # Handle the displacement
-        return "indexed_pc", disp
-
-    # Indexed indirect with R0: @(R0, Rn)
-    match = re.match(r"@\s*\(\s*R0\s*,\s*R(\d+)\s*\)", op)
+    op = op.strip()
+    match = OPERAND_RE.fullmatch(op)
     if match:
-        rn = int(match.group(1))
-        return "r0_indexed", rn
-
-    # Register direct (e.g., R7)
-    if re.match(r"R\d+", op):
-        return "reg", REGISTER_MAP[op]
-    
-    # Special registers
-    if op == "SR":
-        return "sr", None
-    if op == "GBR":
-        return "gbr", None
-    if op == "VBR":
-        return "vbr", None
-    if op == "PR":
-        return "pr", None
-    if op == "PC":
-        return "pc", None
+        op_type = match.lastgroup
+        return op_type, OPERAND_VALUES[op_type](match)
 
     # Otherwise probably a label or symbolic address (e.g., jump target)
-    return "label", op
+    return "label", "".join(op.split()).upper()
     
 
-def assemble_instruction(line, addr):
+@lru_cache(maxsize=4096)
+def parse_operands(operand_field):
     """
-    Assembles a single line of SH-2 assembly code into bytecode. Removes
-    comments and unneccessary whitespace, tokenizes opcode and operands, parses
-    operands into types and values using parse_operands, looks up encoding from
-    INSTRUCTION_SET table, tracks label defintions and PC-relative branch
-    instructions.
-
-    Args:
-        line (str): a single line of assembly code
-        addr (int): current instruction address in the program
+    Splits an operand field into its operands and parses each with
+    parse_operand. Cached like parse_operand.
 
     Returns:
-        int or None: 16-bit machine instruction as integer, or if not a valid
-                     instruction, None
+        tuple: (type, value) of each operand
     """
+    return tuple(parse_operand(op) for op in OPERANDS_RE.findall(operand_field))
 
-    # Remove comments and strip white space
-    line = line.split(';')[0].strip()
 
-    # Do not handle empty lines
-    if not line or line == '':
-        return None
+def encode_instruction(opcode, operand_field, symbols=None):
+    """
+    Encodes a tokenized SH-2 instruction. Parses operands into types and values
+    using parse_operand and looks up encoding from INSTRUCTION_SET table.
+    PC-relative branches are encoded with a zero displacement that is filled in
+    once the target label is known. Immediates and displacements are evaluated
+    and checked against the range of their field; those that are expressions
+    of symbols not in symbols (labels) are encoded as zero and the instruction
+    is encoded again once all labels are known.
 
-    # Tokenize instruction
-    tokens = line.split(None, 1)
-    opcode = tokens[0].upper()
-    operands = []
+    Args:
+        opcode (str): instruction mnemonic (e.g., "MOV.L")
+        operand_field (str): comma separated operands (e.g., "R1, @R2")
+        symbols (dict): symbol name -> value of the symbols defined so far
 
-    if len(tokens) > 1:
-        # Split operands by commas, preserve grouping like @(disp,PC)
-        raw_operands = re.findall(r'@?\([^)]*\)|[^,]+', tokens[1])
-        operands = [op.strip() for op in raw_operands]
+    Returns:
+        tuple: (16-bit machine instruction as integer, fixup or None), where
+               the fixup is (opcode, target label) for a PC-relative branch or
+               (opcode, None, operand field) for an instruction with
+               expressions of labels
+    """
+    opcode = opcode.upper()
+    symbols = {} if symbols is None else symbols
 
-    # Parse each operands for its type and value
-    parsed_operands = [parse_operand(op) for op in operands]
+    # Split operands by commas, preserve grouping like @(disp,PC), and parse
+    # each operand for its type and value
+    parsed_operands = parse_operands(operand_field)
 
     # Extract only operand types to determine the instruction format
     operand_types = tuple(op_type for op_type, _ in parsed_operands)
@@ -398,25 +1025,110 @@ def assemble_instruction(line, addr):
     # Form the key used to look up instruction in INSTRUCTION_SET table
     key = (opcode, operand_types)
 
-    # If a label is found, save it, and return None
-    if re.match(r'^\s*([A-Za-z_][A-Za-z0-9_]*):\s*$', opcode):
-        label_dict[opcode[:-1]] = addr
-        return None
-
     # Check instruction is valid
     if key not in INSTRUCTION_SET:
-        raise ValueError(f"Unsupported instruction: {opcode} {operand_types}\n{line}")
-
-    # Extract operand values for table lookup
-    operand_values = [value for _, value in parsed_operands]
+        raise ValueError(f"Unsupported instruction: {opcode} {operand_types}")
+
+    # Extract operand values for table lookup, evaluating immediates and
+    # displacements (those of labels are left as zero until labels are known)
+    operand_values = []
+    deferred = False
+    for op_type, value in parsed_operands:
+        if op_type in FIELD_RANGES:
+            num = value[0] if op_type == "indexed" else value
+            if isinstance(num, str):
+                if is_constant(num, symbols):
+                    num = evaluate(num, symbols)
+                else:
+                    deferred, num = True, 0
+            low, high = FIELD_RANGES[op_type]
+            if not low <= num <= high:
+                raise ValueError(f"Operand out of range ({low} to {high}) for {opcode}: {num}")
+            if op_type == "imm" and opcode in SIGNED_IMMEDIATES and num > SIGNED_BYTE_RANGE[1]:
+                warnings.warn(f"{opcode} #{num} is sign-extended to {num - 0x100}")
+            value = (num, value[1]) if op_type == "indexed" else num
+        operand_values.append(value)
+    word = INSTRUCTION_SET[key](*operand_values)
+    if deferred:
+        return word, (opcode, None, substitute(operand_field, symbols))
 
     # Defer encoding PC-relative branches until all labels are known (temporarily
-    # just save that this branch exists)
-    if opcode in ['BF', 'BF/S', 'BT', 'BT/S', 'BRA','BSR']:
-        pc_rel_branch_list.append((opcode, operand_values, addr))
+    # just return the branch target)
+    if opcode in PC_REL_BRANCHES:
+        target = operand_values[0]
+        if target in symbols or not target.isidentifier():
+            target = substitute(target, symbols)
+        return word, (opcode, target)
+    return word, None
+
+
+def assemble_instruction(line):
+    """
+    Assembles a single line of SH-2 assembly code into bytecode. Removes
+    comments and unneccessary whitespace, tokenizes opcode and operands, and
+    encodes the instruction using encode_instruction.
+
+    Args:
+        line (str): a single line of assembly code (without a label)
+
+    Returns:
+        tuple or None: (16-bit machine instruction as integer, (opcode, target
+                       label) if the instruction is a PC-relative branch or
+                       None), or if not a valid instruction, None
+    """
+
+    # Remove comments and strip white space
+    line = line.split(';')[0].strip()
+
+    # Do not handle empty lines
+    if not line:
+        return None
+
+    # Tokenize instruction
+    tokens = line.split(None, 1)
+    return encode_instruction(tokens[0], tokens[1] if len(tokens) > 1 else '')
+
 
-    # Lookup bytecode in table
-    return INSTRUCTION_SET[key](*operand_values)
+def parse_literal(opcode, operand_field, symbols=None):
+    """
+    Parses a literal load: MOV.L #imm, Rn, MOV.W #imm, Rn, or MOV.L =label, Rn.
+    The constant is shrunk to the smallest load that holds it: MOV #imm, Rn for
+    8-bit values, then a 16-bit (MOV.W) literal, then a 32-bit (MOV.L) literal.
+    Expressions of labels are always 32-bit literals.
+
+    Args:
+        opcode (str): instruction mnemonic
+        operand_field (str): comma separated operands
+        symbols (dict): symbol name -> value of the symbols defined so far
+
+    Returns:
+        tuple or None: (size in bytes (1 for MOV #imm), signed value or None,
+                       label (or expression of labels) or None, Rn), or None
+                       if not a literal load
+    """
+    opcode = opcode.upper()
+    match = LITERAL_RE.match(operand_field) if opcode in LITERAL_LOADS else None
+    if not match:
+        return None
+    reg = int(match["reg"])
+
+    # Address of a label (resolved once the label is placed)
+    imm = (match["label"] or match["imm"]).strip()
+    symbols = {} if symbols is None else symbols
+    if not is_constant(imm, symbols):
+        if opcode != "MOV.L":
+            raise ValueError(f"{opcode} cannot load a label address")
+        return 4, None, substitute(imm, symbols), reg
+
+    # Constant (stored signed, since loads sign-extend)
+    value = evaluate(imm, symbols)
+    low, high = (-(1 << 31), 1 << 32) if opcode == "MOV.L" else (-(1 << 15), 1 << 15)
+    if not low <= value < high:
+        raise ValueError(f"Literal out of range for {opcode}: {imm}")
+    if value >= 1 << 31:
+        value -= 1 << 32
+    size = 1 if -128 <= value < 128 else 2 if -32768 <= value < 32768 else 4
+    return size, value, None, reg
 
 
 def parse_value(val):
@@ -437,239 +1149,2155 @@ def parse_value(val):
     else:  # Decimal
         return int(val)
 
-def parse_data(line):
+def parse_data(line, symbols=None, fixups=None):
     """
-    Parses a line from the .data section and returns a list of binary string
-    representations. Strips comments. Data is big-endian.
-    Recognizes the following directives: .byte, .word, .long types.
+    Parses a data directive and returns the bytes it defines. Strips comments.
+    Data is big-endian.
+    Recognizes the following directives: .byte, .word, .long types, and
+    .space size[, fill] and .fill count[, size[, value]] to reserve space.
+    Values are constant expressions, or expressions of labels, which are left
+    zero and appended to fixups. The values are packed
+    into a preallocated buffer all at once, so large tables cost time in
+    proportion to their size only.
 
     Args:
-        line (str): A single line from the .data section.
+        line (str): A single data directive line (without a label).
+        symbols (dict): symbol name -> value of the symbols defined so far
+        fixups (list): (directive, offset, expression) of each value of labels
 
     Returns:
-        list[str]: A list of binary string representations of the data (8 or 16 bits wide),
-                   or None if the line is not a valid data directive.
+        bytearray: The bytes of the data, or None if the line is not a valid
+                   data directive.
     """
 
-    data = bytearray()  # Uses binary data as bytes
-    labels = {}         # Label dictionary (local)
-
-    # Skip empty lines or comments headers
-    line = line.strip()
-    if not line or line.startswith(';') or line == ".data":
-        return None
-    
     # Remove inline comments
     line = line.split(';')[0].strip()
-    
-    # Extract label and directive
-    label_match = re.match(r'(\w+):\s*(\.\w+)\s+(.*)', line)
-    if not label_match:
+
+    # Extract directive and values
+    directive_match = re.match(r'(\.\w+)\s*(.*)', line)
+    if not directive_match:
         return None
-    
-    # Track label's offset if needed outside function
-    label, directive, value = label_match.groups()
-
-    # Track output format
-    isbyte = False
-
-    # .byte each value becomes one byte
-    if directive == ".byte":
-        data.extend(parse_value(v) & 0xFF for v in value.split(','))
-        isbyte = True
-
-    # .word each value becomes two bytes
-    elif directive == ".word":
-        for v in value.split(','):
-            intval = parse_value(v)
-            # Convert to unsigned 16-bit if negative
-            if intval < 0:
-                intval = (1 << 16) + intval  # Two's complement
-            data.extend(struct.pack('>H', intval))
-
-    # .long each value becomes foure bytes
-    elif directive == ".long":
-        for v in value.split(','):
-            intval = parse_value(v)
-            # Convert to unsigned 32-bit if negative
-            if intval < 0:
-                intval = (1 << 32) + intval  # Two's complement
-            data.extend(struct.pack('>I', intval))
-            
-    else:
+    directive, value = directive_match.groups()
+    symbols = {} if symbols is None else symbols
+
+    # .space size[, fill] is size bytes of fill (0 by default)
+    if directive == ".space":
+        size, fill = parse_constants(value, symbols, (None, 0))
+        check_range(".space fill", fill, DATA_RANGES[".byte"])
+        return bytearray([fill & 0xFF]) * size
+
+    # .fill count[, size[, value]] is count values of size (1, 2, or 4) bytes
+    if directive == ".fill":
+        count, size, fill = parse_constants(value, symbols, (None, 1, 0))
+        directive = FILL_DIRECTIVES.get(size)
+        if directive is None:
+            raise ValueError(f"Invalid .fill size: {size}")
+        check_range(".fill value", fill, DATA_RANGES[directive])
+        return bytearray(struct.pack(f">{DATA_FORMATS[directive]}",
+                                     fill & ((1 << 8*size) - 1))) * count
+
+    if directive not in DATA_RANGES:
         raise ValueError(f"Unknown directive: {directive}")
-    
-    # Create final list of binary strings
-    binary_strs = []
-    if not isbyte:
-        # Pad to 16-bit boundary if needed
-        if len(data) % 2 != 0:
-            data.append(0)
-
-        # Convert to 16-bit binary strings
-        for i in range(0, len(data), 2):
-            high = data[i]
-            low = data[i + 1]
-            word = (high << 8) | low
-            binary_strs.append(f"{word:016b}")
+    items = value.split(',')
+
+    # Plain numbers are converted all at once (expressions one at a time)
+    try:
+        values = [int(v, 0) for v in items]
+    except ValueError:
+        values = []
+        for v in items:
+            v = parse_number(v)
+            if fixups is not None and isinstance(v, str) and not is_constant(v, symbols):
+                fixups.append((directive, struct.calcsize(DATA_FORMATS[directive])*len(values),
+                               substitute(v, symbols)))
+                v = 0
+            values.append(evaluate(v, symbols))
+    low, high = DATA_RANGES[directive]
+    if values and (min(values) < low or max(values) > high):
+        value = next(v for v in values if not low <= v <= high)
+        raise ValueError(f"Value out of range for {directive}: {value}")
+
+    # Pack each value into its size in bytes (negative values as two's complement)
+    fmt = DATA_FORMATS[directive]
+    mask = (1 << 8*struct.calcsize(fmt)) - 1
+    data = bytearray(struct.calcsize(fmt) * len(values))
+    struct.pack_into(f">{len(values)}{fmt}", data, 0, *(v & mask for v in values))
+    return data
+
+
+def parse_constants(args, symbols=None, defaults=()):
+    """
+    Parses the comma separated constant expressions of a directive.
+
+    Args:
+        args (str): the directive arguments
+        symbols (dict): symbol name -> value of the symbols defined so far
+        defaults (tuple): default value of each argument (None if required)
+
+    Returns:
+        list[int]: the value of each argument
+    """
+    values = [evaluate(parse_number(arg), symbols) for arg in args.split(',')] if args.strip() else []
+    if len(values) > len(defaults) or None in defaults[len(values):]:
+        raise ValueError(f"Wrong number of arguments: {args.strip()}")
+    return values + list(defaults[len(values):])
+
+
+def check_range(name, value, value_range):
+    """
+    Checks that value is in value_range (low, high), raising ValueError if not.
+    """
+    low, high = value_range
+    if not low <= value <= high:
+        raise ValueError(f"{name} out of range ({low} to {high}): {value}")
+
+
+def parse_align(args, symbols=None):
+    """
+    Parses the arguments of .align alignment[, fill]: the alignment in bytes
+    (a power of two) and the byte padding is filled with (0 by default).
+
+    Returns:
+        tuple: (alignment, fill byte)
+    """
+    align, fill = parse_constants(args, symbols, (None, 0))
+    if align <= 0 or align & (align - 1):
+        raise ValueError(f"Alignment must be a power of two: {align}")
+    check_range(".align fill", fill, DATA_RANGES[".byte"])
+    return align, fill & 0xFF
+
+
+def read_incbin(args, include_dir=None, symbols=None):
+    """
+    Reads the bytes included by .incbin "file"[, skip[, count]]: count bytes
+    (the rest of the file by default) after the first skip bytes of a file.
+    The file is relative to include_dir (the directory of the source file).
+
+    Returns:
+        bytearray: the included bytes
+    """
+    match = INCBIN_RE.match(args)
+    if not match:
+        raise ValueError(f"Invalid .incbin: {args.strip()}")
+    name = match["quoted"] or match["file"]
+    skip, count = parse_constants(match["args"] or "", symbols, (0, -1))
+    with open(os.path.join(include_dir or os.curdir, name), 'rb') as in_file:
+        in_file.seek(skip)
+        data = bytearray(in_file.read(count))
+    if count > 0 and len(data) < count:
+        raise ValueError(f".incbin {name} has only {len(data)} bytes after {skip}")
+    return data
+
+
+def parse_vector(line):
+    """
+    Parses a line from the .vectable section into a vector table entry. Strips
+    comments.
+
+    Args:
+        line (str): A single line from the .vectable section.
+
+    Returns:
+        tuple or None: (name, address) of the vector entry, or None if the
+                       line holds no entry.
+    """
+    line = line.split(';')[0].strip()  # remove inline comment
+    parts = line.split(':')
+    if len(parts) < 2:
+        return None
+    address_part = parts[1].strip().split()[0]  # Get '0x00000020'
+    return parts[0], int(address_part, 16)      # Convert hex to int
+
+
+def resolve_fixups(image):
+    """
+    Fills in the displacement of every PC-relative branch in the image now that
+    all labels are known, along with the other references to labels.
+
+    Args:
+        image (Image): assembled program with unresolved branches
+
+    Raises:
+        ValueError: if a branch targets an undefined label or is out of range
+                    (with the source line of the reference)
+    """
+    symbols = ChainMap(image.symbols, image.constants)
+    for fixup in image.fixups:
+        try:
+            resolve_fixup(fixup, symbols)
+        except ValueError as err:
+            line = fixup.section.source.get(fixup.offset, f"{fixup.opcode} " +
+                                            (fixup.operands or fixup.label))
+            raise ValueError(f"{err}\n{line.strip()}") from None
+
+
+def resolve_fixup(fixup, symbols):
+    """
+    Fills in a single reference now that all labels are known (see
+    resolve_fixups).
+
+    Args:
+        fixup (Fixup): the reference
+        symbols (dict): label and symbol name -> value
+    """
+    data = fixup.section.data
+
+    # Instruction with expressions of labels
+    if fixup.operands is not None:
+        word, pending = encode_instruction(fixup.opcode, fixup.operands, symbols)
+        if pending:
+            raise ValueError(f"Undefined symbol in {fixup.opcode} {fixup.operands}")
+        data[fixup.offset:fixup.offset + 2] = word.to_bytes(2, 'big')
+        return
+    target = evaluate(fixup.label, symbols)
+
+    # Label address stored in a literal pool or data
+    if fixup.opcode in DATA_FORMATS:
+        check_range(f"{fixup.opcode} value", target, DATA_RANGES[fixup.opcode])
+        size = struct.calcsize(DATA_FORMATS[fixup.opcode])
+        data[fixup.offset:fixup.offset + size] = (target & ((1 << 8*size) - 1)).to_bytes(size, 'big')
+        return
+
+    # Literal pool loads (unsigned displacement in longs or words)
+    word = (data[fixup.offset] << 8) | data[fixup.offset + 1]
+    if fixup.opcode in LITERAL_LOADS:
+        size = 4 if fixup.opcode == "MOV.L" else 2
+        base = (fixup.addr & ~3 if size == 4 else fixup.addr) + PC_OFFSET
+        offset = (target - base) // size
+        if target % size != 0 or not 0 <= offset <= 0xFF:
+            raise ValueError(f"Literal pool out of range of {fixup.opcode} at " +
+                             f"0x{fixup.addr:08X}: add a .pool after an " +
+                             "unconditional branch closer to it")
+        word |= offset
+        data[fixup.offset:fixup.offset + 2] = word.to_bytes(2, 'big')
+        return
+
+    # Calculate signed displacement (in words)
+    offset = branch_displacement(fixup, target)
+    low, high = BRANCH_RANGE[8 if fixup.opcode in BRANCHES_DISP8 else 12]
+    if not low <= offset <= high:
+        raise ValueError(f"Branch target out of range: {fixup.opcode} {fixup.label} " +
+                         f"at 0x{fixup.addr:08X}")
+
+    # Add displacement to instruction
+    if fixup.opcode in BRANCHES_DISP8:
+        word |= offset & 0x00FF     # 8-bit displacement
     else:
-        # Convert to 8-bit binary strings otherwise
-        for byte in data:
-            binary_strs.append(f"{byte:08b}")      
-    
-    return binary_strs
+        word |= offset & 0x0FFF     # 12-bit displacement
+    data[fixup.offset:fixup.offset + 2] = word.to_bytes(2, 'big')
 
 
-# Main loop
-if __name__ == '__main__':
+def branch_displacement(fixup, target):
+    """
+    Computes the signed displacement (in words) of a branch to target. Addresses
+    wrap at 32 bits, so branches between 0x00000000 and 0xFFFFFC00 are short.
+    """
+    offset = (target - fixup.addr - PC_OFFSET) & 0xFFFFFFFF
+    return (offset - (1 << 32) if offset & 0x80000000 else offset) // 2
+
+
+def encode_code(lines):
+    """
+    Encodes instructions that do not refer to labels (e.g., "JMP     @R0").
+
+    Returns:
+        bytes: the machine code of the instructions (big-endian)
+    """
+    return b"".join(encode_instruction(*(line.split(None, 1) + [""])[:2])[0].to_bytes(2, 'big')
+                    for line in lines)
 
-    # Make sure input and output files provided
-    if len(sys.argv) < 2:
-        print("Usage: python3 sh2_asm.py <asm_file>")
-        sys.exit(1)
-
-    # Code Sections
-    SEG_UNKNOWN = 0
-    SEG_TEXT = 1
-    SEG_DATA = 2
-    SEG_VEC_TABLE = 3
-
-    # List of text lines to output
-    chunk0_output = []
-    chunk1_output = []
-    chunk2_output = []
-    chunk3_output = []
-
-    # Address of chunks
-    CHUNK0_ADDR = 1024*0
-    CHUNK1_ADDR = 1024*1
-    CHUNK2_ADDR = 1024*2 # not used
-    CHUNK3_ADDR = 1024*3 # not used
-    CHUNK_SIZE = 1024
-
-    # Used to combine bytes into words for output
-    between_bytes = False
-
-    # Read assembly file
-    with open(sys.argv[1], 'r') as asm_file:
-        lines = asm_file.readlines()
-
-        addr = 0            # current memory address in segment
-        seg = SEG_UNKNOWN   # current segment being parsed
-        data_arr = []       # stores binary strings for data segment
-        vector_words = []   # stores binary lines for vector table
-
-        # Iterate through all lines of file
-        for line_num, line in enumerate(lines):
-
-            # Change code section if directive is found
-            if len(line.split()) > 0 and line.split()[0] == '.text':
-                seg = SEG_TEXT
+
+def insert_code(image, labels, section, offset, code):
+    """
+    Inserts bytes into a section, moving the labels, fixups, and source lines
+    at or after offset along with the code.
+
+    Args:
+        image (Image): program being assembled
+        labels (dict): label -> (section, offset)
+        section (Section): section to insert into
+        offset (int): offset to insert at
+        code (bytes): bytes to insert
+    """
+    size = len(code)
+    section.data[offset:offset] = code
+    for label, (sect, off) in labels.items():
+        if sect is section and off >= offset:
+            labels[label] = (sect, off + size)
+    for fixup in image.fixups:
+        if fixup.section is section and fixup.offset >= offset:
+            fixup.offset += size
+    section.source = {off + size if off >= offset else off: line
+                      for off, line in section.source.items()}
+
+
+def relax_branches(image, labels, unplaced=()):
+    """
+    Expands PC-relative branches whose target is out of range, repeating until
+    every branch fits (an expansion may push other branches out of range).
+    Every expansion adds a multiple of 4 bytes, so the alignment of literal
+    pools and data after it is unchanged. An expansion grows its section, so
+    the sections packed by place_sections are placed again after each round
+    (moving the runs after the grown one, in this module or the next).
+
+        BF label        ->  BT      skip            BRA label; slot  ->  slot
+                            BRA     label                                MOV.L   R0, @-R15
+                            NOP                                          MOV.L   @(disp, PC), R0
+                        skip:                                            JMP     @R0
+                                                                         MOV.L   @R15+, R0
+                                                                         .long   label
+
+        BF/S label; slot -> BT      skip            BSR label; slot  ->  slot
+                            BRA     label                                MOV.L   R0, @-R15
+                            slot                                         MOV.L   @(disp, PC), R0
+                        skip:                                            BRA     call
+                            slot                                         NOP
+                                                                         .long   label
+                                                                     call:
+                                                                         JSR     @R0
+                                                                         MOV.L   @R15+, R0
+
+    Args:
+        image (Image): program with all sections placed
+        labels (dict): label -> (section, offset), updated as code moves
+        unplaced (list): sections placed by place_sections (not at an address
+                         given in the source)
+
+    Raises:
+        ValueError: if a branch that cannot be relaxed is out of range
+    """
+    while True:
+        for sect in unplaced:
+            sect.addr = None
+        place_sections(image)
+        symbols = ChainMap({label: sect.addr + off for label, (sect, off) in labels.items()},
+                           image.constants)
+        relax = []
+        for fixup in image.fixups:
+            if (fixup.opcode in PC_REL_BRANCHES and fixup.operands is None
+                    and is_constant(fixup.label, symbols)):
+                low, high = BRANCH_RANGE[8 if fixup.opcode in BRANCHES_DISP8 else 12]
+                if not low <= branch_displacement(fixup, evaluate(fixup.label, symbols)) <= high:
+                    relax.append(fixup)
+        if not relax:
+            return
+
+        # Expand from the end of each section so earlier offsets stay valid
+        for fixup in sorted(relax, key=lambda f: f.offset, reverse=True):
+            section, offset = fixup.section, fixup.offset
+            line = section.source.get(offset, f"{fixup.opcode} {fixup.label}").split(';')[0].strip()
+            if fixup.opcode in ("BRA", "BSR") and any(sect is section and off == offset + 2
+                                                      for sect, off in labels.values()):
+                raise ValueError(f"Cannot relax {line}: its delay slot is labeled")
+
+            if fixup.opcode in INVERTED_BRANCHES and fixup.opcode not in DELAYED_BRANCHES:
+                inverted = INVERTED_BRANCHES[fixup.opcode]
+                skip = f".R{len(labels)}"
+                insert_code(image, labels, section, offset + 2, encode_code(("BRA     0", "NOP")))
+                labels[skip] = (section, offset + 6)
+                section.data[offset:offset + 2] = encode_instruction(inverted, skip)[0].to_bytes(2, 'big')
+                section.source[offset] = f"{inverted:<8}{skip} ; relaxed: {line}"
+                section.source[offset + 2] = f"BRA     {fixup.label}"
+                section.source[offset + 4] = "NOP"
+                image.fixups.append(Fixup(inverted, skip, section, offset))
+                fixup.opcode, fixup.offset = "BRA", offset + 2
+
+            elif fixup.opcode in INVERTED_BRANCHES:
+                # The slot (with its labels) becomes the target of the inverted
+                # branch, and a copy of it goes in the slot of the BRA
+                inverted = INVERTED_BRANCHES[fixup.opcode]
+                skip = f".R{len(labels)}"
+                slot = bytes(section.data[offset + 2:offset + 4])
+                insert_code(image, labels, section, offset + 2, encode_code(("BRA     0",)) + slot)
+                labels[skip] = (section, offset + 6)
+                for slot_fixup in [f for f in image.fixups if f.section is section and f.offset == offset + 6]:
+                    image.fixups.append(Fixup(slot_fixup.opcode, slot_fixup.label, section,
+                                              offset + 4, slot_fixup.operands))
+                section.data[offset:offset + 2] = encode_instruction(inverted, skip)[0].to_bytes(2, 'big')
+                section.source[offset] = f"{inverted:<8}{skip} ; relaxed: {line}"
+                section.source[offset + 2] = f"BRA     {fixup.label}"
+                section.source[offset + 4] = section.source.get(offset + 6, "NOP")
+                image.fixups.append(Fixup(inverted, skip, section, offset))
+                fixup.opcode, fixup.offset = "BRA", offset + 2
+
+            elif fixup.opcode == "BRA":
+                # The slot moves ahead of the jump, followed by a 4-byte aligned literal
+                slot = bytes(section.data[offset + 2:offset + 4])
+                literal = 12 if (section.addr + offset) % 4 == 0 else 10
+                code = slot + encode_code(LONG_BRANCH)
+                code += bytes(2) + bytes(4) if literal == 12 else bytes(4) + bytes(2)
+                insert_code(image, labels, section, offset + 4, bytes(12))
+                section.data[offset:offset + 16] = code
+                for slot_fixup in image.fixups:
+                    if slot_fixup.section is section and slot_fixup.offset == offset + 2:
+                        slot_fixup.offset = offset
+
+                # The literal load is resolved like any other
+                name = f".R{len(labels)}"
+                labels[name] = (section, offset + literal)
+                fixup.opcode, fixup.offset = ".long", offset + literal
+                image.fixups.append(Fixup("MOV.L", name, section, offset + 4))
+                section.source[offset] = section.source.pop(offset + 2, "NOP")
+                for i, op in enumerate(LONG_BRANCH):
+                    section.source[offset + 2 + 2*i] = f"{op} ; relaxed: {line}"
+                section.source[offset + literal] = f".long   {fixup.label}"
+
+            elif fixup.opcode == "BSR":
+                # The slot moves ahead of the call, then a BRA over a 4-byte
+                # aligned literal to the JSR (which returns past the literal)
+                slot = bytes(section.data[offset + 2:offset + 4])
+                literal = 10 if (section.addr + offset) % 4 == 2 else 12
+                code = slot + encode_code(LONG_CALL[:4])
+                code += bytes(4) + bytes(2) if literal == 10 else bytes(2) + bytes(4)
+                code += encode_code(LONG_CALL[4:])
+                insert_code(image, labels, section, offset + 4, bytes(16))
+                section.data[offset:offset + 20] = code
+                for slot_fixup in image.fixups:
+                    if slot_fixup.section is section and slot_fixup.offset == offset + 2:
+                        slot_fixup.offset = offset
+
+                # The literal load and the BRA to the call are resolved like any other
+                name, call = f".R{len(labels)}", f".R{len(labels) + 1}"
+                labels[name] = (section, offset + literal)
+                labels[call] = (section, offset + 16)
+                fixup.opcode, fixup.offset = ".long", offset + literal
+                image.fixups.append(Fixup("MOV.L", name, section, offset + 4))
+                image.fixups.append(Fixup("BRA", call, section, offset + 6))
+                section.source[offset] = section.source.pop(offset + 2, "NOP")
+                for off, op in zip((2, 4, 6, 8, 16, 18), LONG_CALL):
+                    section.source[offset + off] = f"{op} ; relaxed: {line}"
+                section.source[offset + 6] = f"BRA     {call} ; relaxed: {line}"
+                section.source[offset + literal] = f".long   {fixup.label}"
+
+            else:
+                raise ValueError(f"Branch target out of range: {line}")
+
+
+def check_overlap(image):
+    """
+    Checks that no two sections of the image share any memory.
+
+    Raises:
+        ValueError: if two sections overlap
+    """
+    sections = sorted((s for s in image.sections if s.data), key=lambda s: s.addr)
+    for prev, curr in zip(sections, sections[1:]):
+        if curr.addr < prev.end:
+            raise ValueError(f"Section {curr.name} at 0x{curr.addr:08X} overlaps " +
+                             f"section {prev.name} (0x{prev.addr:08X}-0x{prev.end - 1:08X})")
+
+
+def parse_address(val, symbols=None):
+    """
+    Parses the address argument of a section directive (a constant expression).
+    Addresses must be word aligned since instructions are placed at the start
+    of a section.
+    """
+    addr = evaluate(parse_number(val), symbols)
+    if addr % 2 != 0:
+        raise ValueError(f"Section address 0x{addr:08X} is not word aligned")
+    return addr
+
+
+def scan_lines(source):
+    """
+    First stage of the assembler pipeline. Strips comments and blank lines and
+    splits each remaining line into its label, operation, and operand field.
+
+    Args:
+        source (iterable): lines of assembly source
+
+    Yields:
+        Statement: each non-empty source line
+    """
+    for line_num, line in enumerate(source, 1):
+        code = line.split(';', 1)[0].strip()
+        if not code:
+            continue
+
+        # Split off label (e.g., "Loop:")
+        label = None
+        if ':' in code:
+            label_match = LABEL_RE.match(code)
+            if label_match:
+                label = label_match.group(1)
+                code = code[label_match.end():].lstrip()
+
+        tokens = code.split(None, 1)
+        yield Statement(line_num, line, label, tokens[0] if tokens else '',
+                        tokens[1] if len(tokens) > 1 else '')
+
+
+def parse_statements(statements, include_dir=None):
+    """
+    Second stage of the assembler pipeline. Parses statements into IR records:
+    section changes, vector table entries, labels, data, encoded instructions,
+    and literal loads. Errors are reported with the line they occur on.
+
+    The literals loaded since the last pool are placed in a new literal pool at
+    a .pool directive, after the delay slot of an unconditional branch (where
+    execution cannot fall through into the pool), and at the end of each
+    section run.
+
+    Args:
+        statements (iterable): Statements from scan_lines
+        include_dir (str): directory .incbin files are relative to
+
+    Yields:
+        tuple: IR record (one of the IR_* kinds followed by its fields)
+    """
+    sections = set(SECTION_ADDRS)   # sections that may be used without an address
+    section = None                  # current section name
+    symbols = {}                    # constant symbol -> value
+    defined = {}                    # symbol or label name -> defining directive (or label)
+    literals = False                # literals loaded since the last pool
+    in_slot = False                 # next instruction is the slot of an unconditional branch
+
+    for stmt in statements:
+        try:
+            op = stmt.op
+
+            # Place pending literals before leaving the section run
+            if literals and op in ('.text', '.data', '.vectable', '.section', '.org', '.pool'):
+                yield IR_POOL,
+                literals = False
+            if op == '.pool':
                 continue
-            elif len(line.split())> 0 and line.split()[0] == '.data':
-                seg = SEG_DATA
+
+            # Symbol definitions (.equ of labels are evaluated once labels are known)
+            if op in ('.equ', '.set'):
+                name, _, expr = stmt.args.partition(',')
+                name = name.strip().upper()
+                if not NAME_RE.fullmatch(name) or name in RESERVED_NAMES or not expr.strip():
+                    raise ValueError(f"Invalid symbol definition: {op} {stmt.args.strip()}")
+                if name in defined and not (op == defined[name] == '.set'):
+                    raise ValueError(f"Symbol {name} already defined")
+                defined[name] = op
+                if is_constant(expr, symbols):
+                    value = symbols[name] = evaluate(expr, symbols)
+                elif op == '.set':
+                    raise ValueError(f".set value must be constant: {expr.strip()}")
+                else:
+                    value = substitute(expr.strip(), symbols)
+                yield IR_SYMBOL, name, value
                 continue
-            elif len(line.split())> 0 and line.split()[0] == '.vectable':
-                seg = SEG_VEC_TABLE
+
+            # Names visible to other modules (defined anywhere in the module)
+            if op in ('.global', '.globl'):
+                names = [name.strip().upper() for name in stmt.args.split(',')]
+                for name in names:
+                    if not NAME_RE.fullmatch(name) or name in RESERVED_NAMES:
+                        raise ValueError(f"Invalid global name: {name}")
+                yield IR_GLOBAL, names
+                continue
+
+            # Section directives
+            if op in ('.text', '.data', '.vectable', '.section', '.org'):
+                args = [arg.strip() for arg in stmt.args.split(',')] if stmt.args else []
+                if op == '.org':
+                    if section is None:
+                        raise ValueError(".org outside of a section")
+                    yield IR_ORG, parse_address(args[0], symbols)
+                    continue
+                if op == '.section':
+                    op = args.pop(0)
+                if not args and op not in sections:
+                    raise ValueError(f"Section {op} requires an address")
+                sections.add(op)
+                section = op
+                yield IR_SECTION, op, parse_address(args[0], symbols) if args else None
+                continue
+
+            # Lines outside of any section are ignored
+            if section is None:
                 continue
 
             # Parse vector table
-            if seg == SEG_VEC_TABLE:
-                if not line or line.startswith(';'):
-                    continue  # skip empty or comment lines
-                line = line.split(';')[0].strip()  # remove inline comment
-                parts = line.split(':')
-                if len(parts) < 2:
+            if section == '.vectable':
+                vector = parse_vector(stmt.line)
+                if vector:
+                    yield IR_VECTOR, vector[0], vector[1]
+                continue
+
+            # Labels are uppercase, like label operands
+            if stmt.label:
+                label = stmt.label.upper()
+                if defined.get(label, 'label') != 'label':
+                    raise ValueError(f"Label {label} already defined as a symbol")
+                defined[label] = 'label'
+                yield IR_LABEL, label
+
+            # Alignment and included binary files
+            if op == '.align':
+                yield (IR_ALIGN, *parse_align(stmt.args, symbols))
+            elif op == '.incbin':
+                yield IR_DATA, read_incbin(stmt.args, include_dir, symbols), False, []
+
+            # Parse data (words and longs are word aligned)
+            elif op.startswith('.'):
+                fixups = []
+                yield IR_DATA, parse_data(f"{op} {stmt.args}", symbols, fixups), op != '.byte', fixups
+
+            # Parse program code (literal loads of 8-bit values are just MOV #imm)
+            elif op:
+                literal = parse_literal(op, stmt.args, symbols)
+                if literal and literal[0] > 1:
+                    yield (IR_LITERAL, *literal, stmt.line)
+                    literals = True
+                elif literal:
+                    yield (IR_INSTR, INSTRUCTION_SET[("MOV", ("imm", "reg"))](literal[1], literal[3]),
+                           None, stmt.line)
+                else:
+                    # Warnings of the instruction are given its source line
+                    with warnings.catch_warnings(record=True) as caught:
+                        warnings.simplefilter("always")
+                        word, fixup = encode_instruction(op, stmt.args, symbols)
+                    for warning in caught:
+                        warnings.warn(f"line {stmt.line_num}: {warning.message}\n" +
+                                      stmt.line.strip(), warning.category)
+                    yield IR_INSTR, word, fixup, stmt.line
+
+                # Place pending literals after the slot of an unconditional branch
+                if in_slot and literals:
+                    yield IR_POOL,
+                    literals = False
+                in_slot = not in_slot and op.upper() in POOL_BRANCHES
+
+        except (ValueError, KeyError, IndexError, OSError) as err:
+            raise ValueError(f"line {stmt.line_num}: {err}\n{stmt.line.strip()}") from None
+
+    if literals:
+        yield IR_POOL,
+
+
+@lru_cache(maxsize=4096)
+def instruction_effects(opcode, operand_field):
+    """
+    Finds the registers (and memory, T bit, PC) an instruction reads and
+    writes, for moving instructions without changing what the program does and
+    for finding pipeline hazards. Memory is treated as a single resource.
+
+    Args:
+        opcode (str): instruction mnemonic (e.g., "MOV.L")
+        operand_field (str): comma separated operands (e.g., "R1, @R2")
+
+    Returns:
+        tuple: (frozenset of resources read, frozenset of resources written)
+    """
+    opcode = opcode.upper()
+
+    # Literal loads read the literal pool (unless they are just MOV #imm)
+    literal = parse_literal(opcode, operand_field)
+    if literal:
+        reads = ("PC", "MEM") if literal[0] > 1 else ()
+        return frozenset(reads), frozenset((f"R{literal[3]}",))
+
+    operands = [parse_operand(op) for op in OPERANDS_RE.findall(operand_field)]
+    reads, writes = set(), set()
+
+    for i, (op_type, value) in enumerate(operands):
+        regs = OPERAND_REGS[op_type](value)
+        if op_type in ("inc", "dec"):
+            writes.add(f"R{value}")
+
+        # Source operands are read (as are the address registers of memory
+        # operands)
+        if i < len(operands) - 1 or opcode in DEST_READ_ONLY:
+            reads.update(regs)
+
+        # The destination is written, and read too unless it is overwritten
+        # (e.g., MOV R1, R2 but not ADD R1, R2)
+        elif "MEM" in regs:
+            reads.update(reg for reg in regs if reg != "MEM")
+            writes.add("MEM")
+            if opcode in READ_MODIFY_WRITE:
+                reads.add("MEM")
+        else:
+            writes.update(regs)
+            if not opcode.startswith(DEST_WRITE_ONLY):
+                reads.update(regs)
+
+    # Implicit operands
+    if opcode in T_WRITERS:
+        writes.add("T")
+    if opcode in T_READERS:
+        reads.add("T")
+    if opcode in MAC_WRITERS:
+        writes.add("MAC")
+    if opcode in MAC_READERS:
+        reads.add("MAC")
+    if opcode in ("BSR", "BSRF", "JSR"):
+        writes.add("PR")
+    elif opcode == "RTS":
+        reads.add("PR")
+    elif opcode in ("TRAPA", "RTE", "SLEEP"):
+        reads.update(("SR", "T", "PC", "MEM"))
+        writes.update(("SR", "T", "PC", "MEM"))
+    elif opcode in ("JMP", "JSR", "MOVA"):
+        reads.discard("MEM")    # @Rm and @(disp,PC) are only addresses here
+
+    return frozenset(reads), frozenset(writes)
+
+
+def independent(effects_a, effects_b):
+    """
+    Checks whether two instructions may be reordered: neither writes anything
+    the other reads or writes.
+    """
+    reads_a, writes_a = effects_a
+    reads_b, writes_b = effects_b
+    return not (writes_a & (reads_b | writes_b) or writes_b & reads_a)
+
+
+def fill_delay_slots(statements, report, window_size=8):
+    """
+    Optimization pass between scan_lines and parse_statements that fills branch
+    delay slots. The latest instruction of the basic block before a branch that
+    is independent of the instructions after it and of the branch is moved
+    into the slot:
+        - BRA, JMP, RTS, BF/S, BT/S followed by a NOP: the instruction
+          replaces the NOP in the slot, saving a cycle each time the branch
+          executes (each time it is taken for BF/S and BT/S). The NOP is kept
+          after the slot, where it is dead code (or, for BF/S and BT/S, runs
+          only when the branch is not taken, as the moved instruction did).
+          BSR and JSR are not filled: they return to the NOP after the slot,
+          so it would run on every return and nothing would be saved.
+        - BF and BT, which flush the next instruction when taken, become
+          BF/S and BT/S with the instruction in the slot, saving a cycle each
+          time the branch is taken. Only backward branches (loops) whose
+          target is in range are converted: a BF/S or BT/S that is not taken
+          fetches its slot again on HW3 (see sh2_pipe.py), so a forward
+          branch, which mostly falls through (e.g., a test's check of a
+          result), would lose a cycle each time it is not taken.
+    Code size and the address of every label are unchanged.
+
+    Args:
+        statements (iterable): Statements from scan_lines
+        report (list): Optimization records for each filled slot are appended
+        window_size (int): how many instructions back to look for a candidate
+
+    Yields:
+        Statement: the reordered statements
+    """
+    window = []         # (statement, effects) of the basic block before the branch
+    held = None         # delayed branch (statement, candidate index) waiting on its slot
+    in_slot = False     # the next instruction is in a delay slot
+    section = None      # current section name
+    words = {}          # section name -> instructions so far
+    label_words = {}    # label -> (section name, instructions before it)
+
+    def is_instruction(stmt):
+        return section not in (None, '.vectable') and stmt.op and stmt.op[0] != '.'
+
+    def backward_in_range(branch):
+        # Whether a BF/BT targets an earlier label of its section that a BF/S
+        # or BT/S reaches (counting instructions only, as literal pools and
+        # data are rare inside loops)
+        target = label_words.get(branch.args.strip().upper())
+        return (target is not None and target[0] == section and
+                words[section] - target[1] <= -BRANCH_RANGE[8][0])
+
+    def find_candidate(branch):
+        # Latest movable instruction independent of those after it and the branch
+        effects = instruction_effects(branch.op, branch.args)
+        for i in range(len(window) - 1, -1, -1):
+            stmt, stmt_effects = window[i]
+            if (not stmt.label and stmt.op.upper() != 'NOP' and "PC" not in stmt_effects[0]
+                    and "SR" not in stmt_effects[1] and independent(stmt_effects, effects)):
+                return i
+            effects = (effects[0] | stmt_effects[0], effects[1] | stmt_effects[1])
+        return None
+
+    def fill(branch, i, op):
+        # Move the candidate into the slot of the branch (renamed to op)
+        stmt, _ = window.pop(i)
+        if op != branch.op:
+            start = branch.line.index(':') + 1 if branch.label else 0
+            start = branch.line.index(branch.op, start)
+            rest = branch.line[start + len(branch.op):]
+            spaces = len(rest) - len(rest.lstrip(' '))
+            pad = ' ' * max(1, spaces + len(branch.op) - len(op)) if spaces else ''
+            branch = branch._replace(op=op, line=branch.line[:start] + op + pad +
+                                     rest.lstrip(' '))
+        when = "taken" if op.upper() in BRANCHES_DISP8 else "executed"
+        report.append(Optimization(branch.line_num, f"{branch.op.upper()} slot filled " +
+                                   f"with '{stmt.line.split(';')[0].strip()}' " +
+                                   f"(line {stmt.line_num})", 1, when))
+        yield from flush()
+        yield branch
+        yield stmt
+
+    def flush():
+        for stmt, _ in window:
+            yield stmt
+        window.clear()
+
+    for stmt in statements:
+
+        # Labels and instructions are counted in their section (before any
+        # reordering, which is only within a basic block)
+        if stmt.op in ('.text', '.data', '.vectable'):
+            section = stmt.op
+        elif stmt.op == '.section':
+            section = stmt.args.split(',')[0].strip()
+        if stmt.label:
+            label_words[stmt.label.upper()] = (section, words.get(section, 0))
+        if is_instruction(stmt):
+            words[section] = words.get(section, 0) + 1
+
+        # Delayed branch waiting to see if its slot holds a NOP
+        if held:
+            branch, i = held
+            held = None
+            if is_instruction(stmt) and stmt.op.upper() == 'NOP' and not stmt.label:
+                yield from fill(branch, i, branch.op)
+                yield stmt
+                continue
+            yield from flush()
+            yield branch
+            in_slot = True
+
+        # Directives and labels end the basic block
+        if not is_instruction(stmt):
+            yield from flush()
+            yield stmt
+            continue
+        if stmt.label:
+            yield from flush()
+
+        # Instructions already in a delay slot stay there
+        op = stmt.op.upper()
+        if in_slot:
+            yield from flush()
+            yield stmt
+            in_slot = False
+
+        elif op in FILLED_BRANCHES:
+            i = None if op in FLUSHING_BRANCHES and not backward_in_range(stmt) else find_candidate(stmt)
+            if i is None:
+                yield from flush()
+                yield stmt
+                in_slot = op in DELAYED_BRANCHES
+            elif op in FLUSHING_BRANCHES:
+                delayed = FLUSHING_BRANCHES[op]
+                yield from fill(stmt, i, delayed if stmt.op.isupper() else delayed.lower())
+            else:
+                held = (stmt, i)
+
+        elif op in SLOT_ILLEGAL:
+            yield from flush()
+            yield stmt
+            in_slot = op in DELAYED_BRANCHES
+
+        else:
+            window.append((stmt, instruction_effects(stmt.op, stmt.args)))
+            if len(window) > window_size:
+                yield window.pop(0)[0]
+
+    if held:
+        yield from flush()
+        yield held[0]
+    yield from flush()
+
+
+def list_schedule(block, loaded, follower):
+    """
+    Reorders the instructions of a straight-line block so that as few as
+    possible read a register loaded by the instruction before them. Each step
+    takes the first ready instruction (all the instructions it depends on are
+    placed) that does not stall, preferring loads that have users left in the
+    block so they are started early.
+
+    Args:
+        block (list): (statement, effects, loaded registers) in source order
+        loaded (frozenset): registers loaded by the instruction before the block
+        follower (frozenset): registers read by the instruction after the block
+
+    Returns:
+        tuple: (statements in the new order, load-use stall cycles before, after)
+    """
+    def stalls(order):
+        prev = loaded
+        count = 0
+        for _, (reads, _), regs in order:
+            count += bool(prev & reads)
+            prev = regs
+        return (count + bool(prev & follower)) * LOAD_USE_STALL
+
+    # Dependencies on earlier instructions (in either direction of access)
+    deps = [{j for j in range(i) if not independent(block[j][1], block[i][1])}
+            for i in range(len(block))]
+    users = [{i for i in range(j + 1, len(block)) if block[j][2] & block[i][1][0]}
+             for j in range(len(block))]
+
+    order, placed, prev = [], set(), loaded
+    while len(order) < len(block):
+        ready = [i for i in range(len(block)) if i not in placed and deps[i] <= placed]
+        i = min(ready, key=lambda i: (bool(prev & block[i][1][0]),
+                                      not (users[i] - placed), i))
+        order.append(block[i])
+        placed.add(i)
+        prev = block[i][2]
+
+    return [stmt for stmt, _, _ in order], stalls(block), stalls(order)
+
+
+def schedule_loads(statements, report, window_size=32):
+    """
+    Optimization pass between scan_lines and parse_statements that list
+    schedules each basic block to hide load latency: with separate instruction
+    and data memories, an instruction reading a register loaded from memory by
+    the instruction just before it stalls for the register to be written back
+    (see find_hazards with split_memory), so independent instructions are
+    moved between loads and their users (see list_schedule).
+
+    The pass targets split memory (sh2_pipe.py --split-memory). On the HW3
+    memory the MA/IF stall of every data access already covers the write
+    back, and reordering does not change the number of accesses, so the
+    reordered code takes the same cycles there.
+
+    The pass is conservative: instructions are only reordered within a run of
+    unlabeled instructions between branches, delay slots, and directives, and
+    only when they are independent (registers, T, MACH/MACL, and memory as a
+    single resource, so loads never move across stores). Instructions that
+    read the PC (other than literal loads) or write SR are not moved. A block
+    is only reordered if that removes stalls; code size and the address of
+    every label are unchanged.
+
+    Args:
+        statements (iterable): Statements from scan_lines
+        report (list): Optimization records for each rescheduled block (with
+                       its split memory load-use stalls before and after) are
+                       appended
+        window_size (int): most instructions scheduled together
+
+    Yields:
+        Statement: the reordered statements
+    """
+    block = []              # (statement, effects, loaded registers) being scheduled
+    loaded = frozenset()    # registers loaded by the instruction before the block
+    section = None          # current section name
+
+    def flush(follower=frozenset()):
+        # Schedule the block, keeping the source order unless stalls are removed
+        nonlocal loaded
+        if len(block) > 1:
+            order, before, after = list_schedule(block, loaded, follower)
+            if after < before:
+                report.append(Optimization(block[0][0].line_num,
+                                           f"{len(block)} instructions scheduled, split " +
+                                           f"memory load-use stalls {before} -> {after}",
+                                           before - after, "executed"))
+                yield from order
+            else:
+                yield from (stmt for stmt, _, _ in block)
+        else:
+            yield from (stmt for stmt, _, _ in block)
+        loaded = block[-1][2] if block else loaded
+        block.clear()
+
+    in_slot = False     # the next instruction is in a delay slot
+    for stmt in statements:
+
+        # Directives end the basic block
+        if section in (None, '.vectable') or not stmt.op or stmt.op[0] == '.':
+            if stmt.op in ('.text', '.data', '.vectable'):
+                section = stmt.op
+            elif stmt.op == '.section':
+                section = stmt.args.split(',')[0].strip()
+            yield from flush()
+            loaded = frozenset()
+            yield stmt
+            continue
+
+        op = stmt.op.upper()
+        effects = instruction_effects(op, stmt.args)
+        regs = loaded_registers(op, stmt.args)
+        pinned = ("PC" in effects[0] and not parse_literal(op, stmt.args)) or "SR" in effects[1]
+
+        # Labels, branches, delay slots, and pinned instructions stay in place
+        if stmt.label or in_slot or pinned or op in BLOCK_ENDS or op in SLOT_ILLEGAL:
+            yield from flush(effects[0])
+            yield stmt
+            loaded = regs
+            in_slot = op in DELAYED_BRANCHES
+            continue
+
+        block.append((stmt, effects, regs))
+        if len(block) >= window_size:
+            yield from flush()
+
+    yield from flush()
+
+
+# Optional optimization passes (run on the statements in the order given)
+OPTIMIZATIONS = {
+    "fill-slots": fill_delay_slots,
+    "schedule": schedule_loads,
+}
+
+
+def assemble_object(source, keep_source=True, optimize=(), include_dir=None):
+    """
+    Assembles an SH-2 module into a relocatable object. Sections without an
+    address are left unplaced and no fixups are resolved, so the object can be
+    linked with other modules (see link) or located on its own (assemble).
+
+    The source is streamed through the pipeline scan_lines -> parse_statements
+    -> layout (below), so only the image, symbol table, and fixup list are held
+    in memory, never the source itself (unless keep_source is set, in which
+    case the source line of each instruction is kept for the memory file
+    comments).
+
+    Args:
+        source (str or iterable): assembly source text or an iterable of lines
+        keep_source (bool): keep the source line of each instruction
+        optimize (iterable): names of OPTIMIZATIONS passes to run, in order
+                             (each records what it did in image.report)
+        include_dir (str): directory .incbin files are relative to (by default
+                           the current directory)
+
+    Returns:
+        ObjectFile: the assembled module
+    """
+    if isinstance(source, str):
+        source = source.splitlines()
+
+    image = Image()
+    current = {}        # section name -> section run being assembled
+    labels = {}         # label -> (section, offset)
+    pending = []        # labels not yet bound to an instruction or data
+    section = None      # section being assembled
+    pool = {}           # (size, value, label) -> name of literal in the next pool
+    aligns = []         # (label, alignment) of each .align
+    exported = set()    # .global names
+
+    def bind_labels(sect):
+        # Bind pending labels to the current location of the section
+        for label in pending:
+            labels[label] = (sect, len(sect.data))
+        pending.clear()
+
+    # Run the optimization passes on the statements
+    statements = scan_lines(source)
+    for name in optimize:
+        statements = OPTIMIZATIONS[name](statements, image.report)
+
+    # Lay out each IR record
+    for record in parse_statements(statements, include_dir):
+        kind = record[0]
+
+        # Instruction (aligned to 2 bytes)
+        if kind is IR_INSTR:
+            _, word, fixup, line = record
+            data = section.data
+            if len(data) % 2 != 0:
+                data.append(0)
+            if pending:
+                bind_labels(section)
+            if fixup:
+                opcode, target, *operands = fixup
+                image.fixups.append(Fixup(opcode, target, section, len(data), *operands))
+            if keep_source:
+                section.source[len(data)] = line.lstrip().rstrip('\n')
+            data += word.to_bytes(2, 'big')
+
+        # Literal load (the displacement is filled in once the pool is placed)
+        elif kind is IR_LITERAL:
+            _, size, value, label, reg, line = record
+            data = section.data
+            if len(data) % 2 != 0:
+                data.append(0)
+            if pending:
+                bind_labels(section)
+            name = pool.setdefault((size, value, label), f".LIT{len(image.fixups)}")
+            opcode = "MOV.L" if size == 4 else "MOV.W"
+            image.fixups.append(Fixup(opcode, name, section, len(data)))
+            if keep_source:
+                section.source[len(data)] = line.lstrip().rstrip('\n')
+            data += (LITERAL_LOADS[opcode] | (reg << 8)).to_bytes(2, 'big')
+
+        # Literal pool (longs first, aligned to 4 bytes, then words)
+        elif kind is IR_POOL:
+            data = section.data
+            data += bytes(-((section.addr or 0) + len(data)) % (4 if any(
+                size == 4 for size, _, _ in pool) else 2))
+            for (size, value, label), name in sorted(pool.items(), key=lambda item: -item[0][0]):
+                labels[name] = (section, len(data))
+                if label:
+                    image.fixups.append(Fixup(".long", label, section, len(data)))
+                data += ((value or 0) & ((1 << 8*size) - 1)).to_bytes(size, 'big')
+            pool.clear()
+
+        # Data (optionally aligned to 2 bytes)
+        elif kind is IR_DATA:
+            _, values, align, fixups = record
+            if align and len(section.data) % 2 != 0:
+                section.data.append(0)
+            if pending:
+                bind_labels(section)
+            for directive, offset, expr in fixups:
+                image.fixups.append(Fixup(directive, expr, section, len(section.data) + offset))
+            section.data += values
+
+        elif kind is IR_SYMBOL:
+            image.constants[record[1]] = record[2]
+
+        elif kind is IR_GLOBAL:
+            exported.update(record[1])
+
+        # Alignment (checked again once sections are placed and branches relaxed)
+        elif kind is IR_ALIGN:
+            _, align, fill = record
+            data = section.data
+            data += bytes([fill]) * (-((section.addr or 0) + len(data)) % align)
+            section.align = max(section.align, align)
+            name = f".A{len(labels)}"
+            labels[name] = (section, len(data))
+            aligns.append((name, align))
+
+        elif kind is IR_LABEL:
+            pending.append(record[1])
+
+        elif kind is IR_VECTOR:
+            image.vectors.append(record[1:])
+            section.data += record[2].to_bytes(4, 'big')
+
+        # Change section, resuming the section where it left off unless a new
+        # address is given (labels at the end of a section stay there)
+        else:
+            if section is not None:
+                bind_labels(section)
+            if kind is IR_ORG:
+                name, addr = section.name, record[1]
+            else:
+                _, name, addr = record
+                if name in current and addr is None:
+                    section = current[name]
                     continue
-                address_part = parts[1].strip().split()[0]  # Get '0x00000020'
-                address_int = int(address_part, 16)         # Convert hex to int
-                address_bin = format(address_int, '032b')   # Convert int to 32-bit binary string
-                vector_words.append(address_bin[:16] + '\t; ' + parts[0] + '\n')
-                vector_words.append(address_bin[16:] + '\n')
-
-            # Parse program code
-            if seg == SEG_TEXT:
-                asm = assemble_instruction(line, addr)
-                if asm:
-                    text = format(asm, '016b') + f'\t; 0x{addr + len(vector_words)*2:08X} : ' + \
-                            f"{(lines[line_num].lstrip())}".rstrip('\n') + '\n'
-                    chunk0_output.append(text)
-                    addr += 2   # Advances by 2 bytes per instruction
-
-            # Parse data segment
-            elif seg == SEG_DATA:
-                data = parse_data(line)
-                if data:
-                    if len(data[0]) == 8:   # is byte
-                        if not between_bytes:
-                            temp_byte = data[0]
-                        else:
-                            # Combine two bytes into a word for output
-                            data_arr.append([temp_byte + data[0]])
-                        between_bytes = not between_bytes
-                    else:
-                        data_arr.append(data)
-
-        # Pad code segment with 0s up to the chunk size
-        addr += 2*len(vector_words)
-        while addr < CHUNK0_ADDR + CHUNK_SIZE:
-            chunk0_output.append(f'{format(0x0000, "016b")}\t; 0x{addr:08X} : 0x00\n')
-            addr += 2
-
-        # Add data segment with appropriate comments
-        addr = CHUNK1_ADDR
-        for var in data_arr:
-            for word in var: 
-                dec_val = int(word, 2)
-                hex_val = hex(dec_val)
-                left_byte = int(word[:8], 2)
-                right_byte = int(word[8:16], 2)
-                chunk1_output.append(f"{word}\t; 0x{addr:08X} : {left_byte}," +
-                                    f"{right_byte} / {dec_val} / {hex_val}\n")
-                addr += 2
-
-        # Pad data segment with zeros
-        while addr < CHUNK1_ADDR + CHUNK_SIZE:
-            chunk1_output.append(f'{format(0x0000, "016b")}\t; 0x{addr:08X} : 0x00\n')
-            addr += 2
-
-    # Handle PC relative branches
-    for branch in pc_rel_branch_list:
-        # Calculate signed displacement
-        branch_instr_addr = branch[2]
-        label_addr = label_dict[branch[1][0]]
-        offset = label_addr - branch_instr_addr
-        offset = (int)(offset / 2)
-        new_line = ''
-
-        # Add displacement to instruction
-        if branch[0] in ['BF', 'BF/S', 'BT', 'BT/S']:
-            # 8-bit displacement
-            output_bin = format(offset & 0x00FF, '08b')
-            for i in range(8, 16):
-                old_line = chunk0_output[(int)(branch_instr_addr / 2)]
-                new_line = old_line[0:8] + output_bin + old_line[16:]
-        elif branch[0] in ['BRA', 'BSR']:
-            # 12-bit displacement
-            output_bin = format(offset & 0x0FFF, '012b')
-            for i in range(4, 16):
-                old_line = chunk0_output[(int)(branch_instr_addr / 2)]
-                new_line = old_line[0:4] + output_bin + old_line[16:]
-        
-        chunk0_output[(int)(branch_instr_addr / 2)] = new_line
-
-    # Write to output files
-    output_file_basename =  os.path.splitext(os.path.basename(sys.argv[1]))[0]
-    output_file_path = '../asm_tests/build/'
-
-    # Write program memory code
-    with open(output_file_path + "build_mem0.txt", 'w') as out_file:
-        for word in vector_words:
-            out_file.write(word)
-        for line in chunk0_output:
-            out_file.write(line)
-
-    # Write data memory code
-    with open(output_file_path  + "build_mem1.txt", 'w') as out_file:
-        for line in chunk1_output:
-            out_file.write(line)
+            section = current[name] = Section(name, addr)
+            image.sections.append(section)
+
+    if section is not None:
+        bind_labels(section)
+
+    return ObjectFile(image, labels, aligns, exported)
+
+
+def place_sections(image):
+    """
+    Places the sections without an address. The runs of each predefined
+    section are packed one after another (each aligned to its largest .align)
+    from its address in SECTION_ADDRS, and the program text follows the vector
+    table.
+
+    Args:
+        image (Image): program with unplaced sections
+    """
+    for name, addr in SECTION_ADDRS.items():
+        if addr is None:
+            addr = max((sect.end for sect in image.sections
+                        if sect.name == '.vectable'), default=CHUNK0_ADDR)
+        for sect in image.sections:
+            if sect.name == name and sect.addr is None:
+                sect.addr = addr + -addr % sect.align
+                addr = sect.end
+
+
+def locate(image, labels, aligns):
+    """
+    Final stage of the assembler and linker: places the sections without an
+    address, relaxes out of range branches, builds the symbol table, and
+    resolves every fixup.
+
+    Args:
+        image (Image): program with unplaced sections and unresolved fixups
+        labels (dict): label -> (section, offset)
+        aligns (list): (label, alignment) of each .align
+
+    Returns:
+        Image: the program with all branches resolved
+    """
+    # Expand branches that do not reach their targets (placing the sections
+    # again as they grow)
+    relax_branches(image, labels, [sect for sect in image.sections if sect.addr is None])
+
+    image.symbols = {label: sect.addr + offset for label, (sect, offset) in labels.items()}
+    check_overlap(image)
+    for name, align in aligns:
+        if image.symbols[name] % align != 0:
+            raise ValueError(f".align {align} at 0x{image.symbols[name]:08X} is not aligned " +
+                             "once its section is placed and long branches are relaxed")
+
+    # Handle PC relative branches and literal loads (literal pool entries are
+    # not program symbols)
+    resolve_fixups(image)
+    image.symbols = {label: addr for label, addr in image.symbols.items()
+                     if not label.startswith('.')}
+
+    return image
+
+
+def assemble(source, keep_source=True, optimize=(), include_dir=None):
+    """
+    Assembles an SH-2 program. All assembler state is local to the call, so
+    any number of programs may be assembled in the same process.
+
+    Args:
+        source (str or iterable): assembly source text or an iterable of lines
+        keep_source (bool): keep the source line of each instruction
+        optimize (iterable): names of OPTIMIZATIONS passes to run, in order
+                             (each records what it did in image.report)
+        include_dir (str): directory .incbin files are relative to (by default
+                           the current directory)
+
+    Returns:
+        Image: the assembled program with all branches resolved
+    """
+    obj = assemble_object(source, keep_source, optimize, include_dir)
+    return locate(obj.image, obj.labels, obj.aligns)
+
+
+def assemble_file(path, keep_source=True, optimize=()):
+    """
+    Assembles an SH-2 assembly source file. The file is streamed through the
+    assembler a line at a time. .incbin files are relative to the source file.
+
+    Args:
+        path (str): path to the .asm file
+        keep_source (bool): keep the source line of each instruction
+        optimize (iterable): names of OPTIMIZATIONS passes to run, in order
+
+    Returns:
+        Image: the assembled program
+    """
+    with open(path, 'r') as asm_file:
+        return assemble(asm_file, keep_source, optimize, os.path.dirname(path))
+
+
+def assemble_object_file(path, keep_source=True, optimize=()):
+    """
+    Assembles an SH-2 assembly source file into a relocatable object.
+
+    Args:
+        path (str): path to the .asm file
+        keep_source (bool): keep the source line of each instruction
+        optimize (iterable): names of OPTIMIZATIONS passes to run, in order
+
+    Returns:
+        ObjectFile: the assembled module
+    """
+    with open(path, 'r') as asm_file:
+        return assemble_object(asm_file, keep_source, optimize, os.path.dirname(path))
+
+
+def rename_symbols(expr, renames):
+    """
+    Renames the symbols of an expression (or an internal label such as a
+    literal pool entry).
+
+    Args:
+        expr (str): expression or label
+        renames (dict): old name -> new name
+
+    Returns:
+        str: the expression with the symbols renamed
+    """
+    if expr in renames:
+        return renames[expr]
+    return NAME_RE.sub(lambda match: renames.get(match[0].upper(), match[0]), expr)
+
+
+def link(objects):
+    """
+    Links relocatable objects into one program. The names each module does not
+    make .global are renamed to be local to the module, the sections of every
+    module are placed together (in the order of the objects), and all
+    relocations are resolved against the combined symbol table. The objects
+    are consumed: their sections become part of the program.
+
+    Args:
+        objects (iterable): ObjectFiles, in link order
+
+    Returns:
+        Image: the linked program
+
+    Raises:
+        ValueError: if a .global name is defined by more than one module, or a
+                    relocation refers to a name no module defines
+    """
+    image = Image()
+    labels = {}         # label -> (section, offset)
+    aligns = []         # (label, alignment) of each .align
+    defined = set()     # labels and symbols of all modules
+
+    for num, obj in enumerate(objects):
+        module = obj.image
+        renames = {name: f"{name}__{num}" for name in (*obj.labels, *module.constants)
+                   if name not in obj.globals}
+
+        # Symbol table (local names cannot clash, so only globals are checked)
+        for name in (*obj.labels, *module.constants):
+            if renames.get(name, name) in defined:
+                raise ValueError(f"Symbol {name} defined in more than one module")
+            defined.add(renames.get(name, name))
+        for name, location in obj.labels.items():
+            labels[renames.get(name, name)] = location
+        for name, value in module.constants.items():
+            image.constants[renames.get(name, name)] = (
+                rename_symbols(value, renames) if isinstance(value, str) else value)
+        aligns += [(renames.get(name, name), align) for name, align in obj.aligns]
+
+        # Relocations
+        for fixup in module.fixups:
+            fixup.label = fixup.label and rename_symbols(fixup.label, renames)
+            fixup.operands = fixup.operands and rename_symbols(fixup.operands, renames)
+        image.fixups += module.fixups
+        image.sections += module.sections
+        image.vectors += module.vectors
+        image.report += module.report
+
+    return locate(image, labels, aligns)
+
+
+def write_object(obj, path):
+    """
+    Writes a relocatable object as JSON: its sections (as hex), symbol table
+    (labels as section number and offset), relocations, .equ/.set symbols,
+    vector table entries, alignments, and global names.
+
+    Args:
+        obj (ObjectFile): the assembled module
+        path (str): path of the object file
+    """
+    image = obj.image
+    index = {id(sect): num for num, sect in enumerate(image.sections)}
+    contents = {
+        "format": OBJECT_FORMAT,
+        "version": OBJECT_VERSION,
+        "sections": [{"name": sect.name, "addr": sect.addr, "align": sect.align,
+                      "data": sect.data.hex(), "source": sect.source}
+                     for sect in image.sections],
+        "labels": {name: [index[id(sect)], offset]
+                   for name, (sect, offset) in obj.labels.items()},
+        "relocations": [[fixup.opcode, fixup.label, index[id(fixup.section)],
+                         fixup.offset, fixup.operands] for fixup in image.fixups],
+        "constants": image.constants,
+        "vectors": image.vectors,
+        "aligns": obj.aligns,
+        "globals": sorted(obj.globals),
+        "report": [opt._asdict() for opt in image.report],
+    }
+    with open(path, 'w') as out_file:
+        json.dump(contents, out_file)
+
+
+def read_object(path):
+    """
+    Reads a relocatable object written by write_object.
+
+    Args:
+        path (str): path of the object file
+
+    Returns:
+        ObjectFile: the assembled module
+
+    Raises:
+        ValueError: if the file is not an object of this version
+    """
+    with open(path, 'r') as in_file:
+        contents = json.load(in_file)
+    if contents.get("format") != OBJECT_FORMAT or contents.get("version") != OBJECT_VERSION:
+        raise ValueError(f"{path} is not a version {OBJECT_VERSION} SH-2 object")
+
+    sections = [Section(sect["name"], sect["addr"], bytearray.fromhex(sect["data"]),
+                        {int(offset): line for offset, line in sect["source"].items()},
+                        sect["align"])
+                for sect in contents["sections"]]
+    image = Image(sections=sections,
+                  vectors=[tuple(vector) for vector in contents["vectors"]],
+                  constants=contents["constants"],
+                  fixups=[Fixup(opcode, label, sections[num], offset, operands)
+                          for opcode, label, num, offset, operands in contents["relocations"]],
+                  report=[Optimization(**opt) for opt in contents["report"]])
+    labels = {name: (sections[num], offset) for name, (num, offset) in contents["labels"].items()}
+    return ObjectFile(image, labels, [tuple(align) for align in contents["aligns"]],
+                      set(contents["globals"]))
+
+
+def image_instructions(image):
+    """
+    Lists the instructions of an image in address order. The image must be
+    assembled with keep_source set, since the source of each instruction is
+    what is analyzed.
+
+    Args:
+        image (Image): the assembled program
+
+    Yields:
+        Instruction: each instruction of the program
+    """
+    for section in sorted(image.sections, key=lambda sect: sect.addr):
+        for offset in sorted(section.source):
+            word = int.from_bytes(section.data[offset:offset + 2], 'big')
+            stmt = next(scan_lines([section.source[offset]]))
+            yield Instruction(section.addr + offset, word, stmt)
+
+
+def basic_blocks(image):
+    """
+    Splits the program into basic blocks. Blocks start at labels, after a
+    branch (and its delay slot), and wherever instructions are not contiguous.
+    Blocks between a backward branch and its target are marked as loops.
+
+    Args:
+        image (Image): the assembled program (with keep_source set)
+
+    Returns:
+        list[BasicBlock]: the blocks in address order
+    """
+    labels = {}
+    for name, addr in image.symbols.items():
+        labels.setdefault(addr, name)
+
+    blocks = []
+    block = None
+    ends = False    # the block ends after the next instruction
+    for inst in image_instructions(image):
+        if (block is None or inst.addr in labels or
+                inst.addr != block.instructions[-1].addr + 2):
+            block = BasicBlock(inst.addr, labels.get(inst.addr))
+            blocks.append(block)
+        block.instructions.append(inst)
+
+        op = inst.stmt.op.upper()
+        if ends or op in BLOCK_ENDS and op not in DELAYED_BRANCHES:
+            block, ends = None, False
+        elif op in BLOCK_ENDS:
+            ends = True     # the delay slot belongs to the branch's block
+
+    # Mark the blocks spanned by each backward branch
+    for fixup in image.fixups:
+        if fixup.opcode not in PC_REL_BRANCHES or fixup.label not in image.symbols:
+            continue
+        target = image.symbols[fixup.label]
+        if target <= fixup.addr:
+            for block in blocks:
+                if target <= block.start <= fixup.addr:
+                    block.loop = True
+
+    return blocks
+
+
+def loaded_registers(opcode, operand_field):
+    """
+    Finds the registers an instruction loads from memory (written back in WB,
+    so not available to the next instruction).
+
+    Returns:
+        frozenset: registers loaded (empty if the instruction is not a load)
+    """
+    literal = parse_literal(opcode, operand_field)
+    if literal:
+        return frozenset((f"R{literal[3]}",) if literal[0] > 1 else ())
+
+    operands = [parse_operand(op) for op in OPERANDS_RE.findall(operand_field)]
+    if (len(operands) < 2 or opcode.upper() == 'MOVA' or
+            "MEM" not in OPERAND_REGS[operands[0][0]](operands[0][1])):
+        return frozenset()
+    last_type, last_value = operands[-1]
+    regs = OPERAND_REGS[last_type](last_value)
+    return frozenset() if "MEM" in regs else frozenset(regs)
+
+
+def find_hazards(block, split_memory=False):
+    """
+    Finds the pipeline hazards of a basic block using the HW3 timing above
+    (the model of sh2_pipe.py): every data access stalls instruction fetch
+    (MA/IF), read-modify-write instructions, TRAPA, and RTE take extra control
+    unit states (multi-cycle), a BF/BT flushes the instruction behind it when
+    taken, and a BF/S or BT/S fetches its slot again when not taken. With a
+    separate data memory, data accesses no longer stall fetch, and instead an
+    instruction reading a register loaded by the instruction before it waits
+    for WB (load-use).
+
+    Args:
+        block (BasicBlock): the block to analyze (its hazards are filled in)
+        split_memory (bool): whether instruction and data memories are separate
+    """
+    block.hazards.clear()
+    prev_loaded = frozenset()
+    prev = None
+    for inst in block.instructions:
+        op, args = inst.stmt.op.upper(), inst.stmt.args
+        reads, writes = instruction_effects(op, args)
+
+        # Load-use: register loaded by the previous instruction (only exposed
+        # when fetch is not held off by the load)
+        if split_memory and prev_loaded & reads:
+            block.hazards.append(Hazard("load-use", inst.addr, LOAD_USE_STALL, (prev, inst)))
+
+        # MA/IF: data accesses hold off fetching the next instruction
+        accesses = MEM_ACCESSES.get(op, 1 if "MEM" in reads | writes else 0)
+        if accesses and not split_memory:
+            block.hazards.append(Hazard("MA/IF", inst.addr, accesses * MA_STALL, (inst,)))
+
+        # Multi-cycle: extra control unit states
+        if op in EXTRA_STATES:
+            block.hazards.append(Hazard("multi-cycle", inst.addr, EXTRA_STATES[op], (inst,)))
+
+        # Control: taken BF/BT flush the next instruction, BF/S and BT/S not
+        # taken fetch their slot again
+        if op in FLUSHING_BRANCHES:
+            block.hazards.append(Hazard("branch flush", inst.addr, BRANCH_FLUSH, (inst,)))
+        elif op in ('BF/S', 'BT/S'):
+            block.hazards.append(Hazard("slot refetch", inst.addr, SLOT_REFETCH, (inst,)))
+
+        prev_loaded = loaded_registers(op, args)
+        prev = inst
+
+
+def analyze_hazards(image, split_memory=False):
+    """
+    Runs the static pipeline hazard analysis over a program.
+
+    Args:
+        image (Image): the assembled program (with keep_source set)
+        split_memory (bool): whether instruction and data memories are separate
+
+    Returns:
+        list[BasicBlock]: the basic blocks with their hazards
+    """
+    blocks = basic_blocks(image)
+    for block in blocks:
+        find_hazards(block, split_memory)
+    return blocks
+
+
+def print_hazards(blocks, hot=10):
+    """
+    Prints the stall estimate of each basic block followed by a hot list of the
+    worst hazards (those inside loops first).
+
+    Args:
+        blocks (list[BasicBlock]): analyzed blocks
+        hot (int): number of hazards in the hot list
+    """
+    def describe(inst):
+        return f"0x{inst.addr:08X} {inst.stmt.op} {inst.stmt.args}".rstrip()
+
+    print(f"{'block':<28}{'instrs':>7}{'stalls':>8}{'flush':>7}{'refetch':>8}")
+    for block in blocks:
+        name = f"0x{block.start:08X} {block.label or ''}"
+        print(f"{name:<28}{len(block.instructions):7}{block.stalls:8}{block.flush:7}" +
+              f"{block.refetch:8}" + ("  loop" if block.loop else ""))
+    print(f"{'total':<28}{sum(len(b.instructions) for b in blocks):7}" +
+          f"{sum(b.stalls for b in blocks):8}{sum(b.flush for b in blocks):7}" +
+          f"{sum(b.refetch for b in blocks):8}")
+
+    hazards = [(block.loop, hazard) for block in blocks for hazard in block.hazards]
+    hazards.sort(key=lambda item: (item[0], item[1].cycles), reverse=True)
+    if hazards:
+        print("hot list:")
+    for loop, hazard in hazards[:hot]:
+        print(f"  {hazard.kind:<13}{hazard.cycles} cycle{'s' if hazard.cycles != 1 else ' '}" +
+              f"{'  loop' if loop else '      '}  " +
+              " -> ".join(describe(inst) for inst in hazard.instructions))
+
+
+def listing_lines(image):
+    """
+    Yields the lines of a cycle-annotated listing of a program. Each
+    instruction is listed with its address, encoding, SH-2 manual issue cycles
+    and latency, the cycles it takes in the HW3 pipeline (including stalls),
+    and its source. Each basic block is headed by its cycle total, and the
+    listing ends with the cycle total from each label to the next.
+
+    Args:
+        image (Image): the assembled program (with keep_source set)
+
+    Yields:
+        str: each line of the listing
+    """
+    blocks = analyze_hazards(image)
+    block_at = {block.start: block for block in blocks}
+    stalls = {}
+    for block in blocks:
+        for hazard in block.hazards:
+            if hazard.kind not in ("branch flush", "slot refetch"):
+                stalls[hazard.addr] = stalls.get(hazard.addr, 0) + hazard.cycles
+
+    yield f"; {'address':<10} {'code':<4}  {'issue':>5} {'lat':>3} {'hw3':>3}  source\n"
+    for section in sorted(image.sections, key=lambda sect: sect.addr):
+        if not section.data:
+            continue
+        yield f"\n; section {section.name} at 0x{section.addr:08X}\n"
+
+        if section.name == '.vectable':
+            for i, (name, vector) in enumerate(image.vectors):
+                yield f"  0x{section.addr + 4*i:08X} {vector:08X}{'':15}{name}\n"
+            continue
+
+        offset = 0
+        while offset < len(section.data):
+            addr = section.addr + offset
+            line = section.source.get(offset)
+
+            # Data (shown a word at a time)
+            if line is None:
+                word = section.data[offset:offset + 2].hex().upper()
+                yield f"  0x{addr:08X} {word:<4}{'':17}.data\n"
+                offset += 2
+                continue
+
+            block = block_at.get(addr)
+            if block:
+                yield (f"\n; block {block.label or ''} 0x{block.start:08X}: " +
+                       f"{len(block.instructions)} instructions, " +
+                       f"{len(block.instructions) + block.stalls} cycles" +
+                       (f" (+{block.flush} if taken)" if block.flush else "") +
+                       (f" (+{block.refetch} if not taken)" if block.refetch else "") +
+                       (", loop" if block.loop else "") + "\n")
+
+            stmt = next(scan_lines([line]))
+            op = stmt.op.upper()
+            issue = ISSUE_CYCLES.get(op, 1)
+            issue = f"{issue[0]}/{issue[1]}" if isinstance(issue, tuple) else str(issue)
+            latency = LOAD_LATENCY if loaded_registers(op, stmt.args) else 1
+            word = int.from_bytes(section.data[offset:offset + 2], 'big')
+            yield (f"  0x{addr:08X} {word:04X}  {issue:>5} {latency:>3} " +
+                   f"{1 + stalls.get(addr, 0):>3}  {line}\n")
+            offset += 2
+
+    # Totals from each label to the next
+    yield f"\n; {'label':<24} {'address':<10} {'instrs':>6} {'cycles':>6} {'taken':>6}\n"
+    labels = sorted((addr, name) for name, addr in image.symbols.items())
+    for i, (addr, name) in enumerate(labels):
+        end = labels[i + 1][0] if i + 1 < len(labels) else None
+        spanned = [block for block in blocks
+                   if addr <= block.start and (end is None or block.start < end)]
+        if not spanned or spanned[0].start != addr:
+            continue
+        instrs = sum(len(block.instructions) for block in spanned)
+        cycles = instrs + sum(block.stalls for block in spanned)
+        taken = sum(block.flush for block in spanned)
+        yield f"; {name:<24} 0x{addr:08X} {instrs:6} {cycles:6} {taken:6}\n"
+
+
+def write_listing(image, output_dir=OUTPUT_DIR):
+    """
+    Writes the cycle-annotated listing of a program to build.lst.
+
+    Args:
+        image (Image): the assembled program (with keep_source set)
+        output_dir (str): directory to write build.lst to
+    """
+    with open(os.path.join(output_dir, LISTING_FILE), 'w') as out_file:
+        out_file.writelines(listing_lines(image))
+
+
+def block_sections(image):
+    """
+    Sorts the sections of the image into the memory.vhd blocks.
+
+    Args:
+        image (Image): the assembled program
+
+    Returns:
+        list[(int, int, list[Section])]: (address, size, sections sorted by
+                                         address) of each memory block
+
+    Raises:
+        ValueError: if a section does not fit entirely within a memory block
+    """
+    blocks = [(addr, size, []) for addr, size in MEM_BLOCKS]
+    for section in image.sections:
+        if not section.data:
+            continue
+        for addr, size, sections in blocks:
+            if addr <= section.addr and section.end <= addr + size:
+                sections.append(section)
+                break
+        else:
+            raise ValueError(f"Section {section.name} (0x{section.addr:08X}-" +
+                             f"0x{section.end - 1:08X}) does not fit in a memory block")
+    for _, _, sections in blocks:
+        sections.sort(key=lambda s: s.addr)
+    return blocks
+
+
+def pad_mem_lines(addr, end_addr):
+    """
+    Yields zero-filled memory file lines from addr up to (not including)
+    end_addr.
+    """
+    for pad_addr in range(addr, end_addr, 2):
+        yield f"{0:016b}\t; 0x{pad_addr:08X} : 0x00\n"
+
+
+def section_mem_lines(image, section):
+    """
+    Yields the memory file lines of a section. Vector table entries are
+    commented with their name, instructions with their address and source
+    line, and data words with their address and value (as bytes, decimal, and
+    hex).
+    """
+    data = section.data + bytes(len(section.data) % 2)     # pad to whole words
+
+    if section.name == '.vectable':
+        for (name, _), (high, low) in zip(image.vectors, struct.iter_unpack('>HH', data)):
+            yield f"{high:016b}\t; {name}\n"
+            yield f"{low:016b}\n"
+        return
+
+    addr = section.addr
+    for offset, (word,) in enumerate(struct.iter_unpack('>H', data)):
+        line = section.source.get(2*offset)
+        if line is not None:
+            yield f"{word:016b}\t; 0x{addr:08X} : {line}\n"
+        else:
+            yield f"{word:016b}\t; 0x{addr:08X} : {word >> 8},{word & 0xFF} / {word} / {word:#x}\n"
+        addr += 2
+
+
+def block_mem_lines(image, block_addr, block_size, sections):
+    """
+    Yields the lines of the memory file of one memory block: the lines of each
+    section in it, with the gaps between them padded with zeros.
+    """
+    addr = block_addr
+    for section in sections:
+        yield from pad_mem_lines(addr, section.addr)
+        yield from section_mem_lines(image, section)
+        addr = section.end + len(section.data) % 2
+    yield from pad_mem_lines(addr, block_addr + block_size)
+
+
+def write_mem_files(image, output_dir=OUTPUT_DIR):
+    """
+    Writes the memory files loaded by memory.vhd (build_mem0.txt through
+    build_mem3.txt, one per memory block). Each line holds a 16-bit binary
+    string followed by a comment. The image is only formatted here, streaming
+    straight into the files.
+
+    Args:
+        image (Image): the assembled program
+        output_dir (str): directory to write the memory files to
+    """
+    for num, (addr, size, sections) in enumerate(block_sections(image)):
+        with open(os.path.join(output_dir, f"build_mem{num}.txt"), 'w') as out_file:
+            out_file.writelines(block_mem_lines(image, addr, size, sections))
+
+
+def mem_blocks(image):
+    """
+    Builds the raw big-endian contents of the four memory.vhd blocks.
+
+    Args:
+        image (Image): the assembled program
+
+    Returns:
+        list[(int, bytearray)]: (address, contents) of each memory block
+    """
+    blocks = []
+    for addr, size, sections in block_sections(image):
+        contents = bytearray(size)
+        for section in sections:
+            start = section.addr - addr
+            contents[start:start + len(section.data)] = section.data
+        blocks.append((addr, contents))
+    return blocks
+
+
+def write_bin_files(image, output_dir=OUTPUT_DIR):
+    """
+    Writes each memory block as a raw big-endian binary image (build_mem0.bin
+    through build_mem3.bin) that can be memory-mapped or loaded directly, plus
+    a build.json sidecar describing the blocks and holding the symbol map.
+
+    Args:
+        image (Image): the assembled program
+        output_dir (str): directory to write the binary images to
+    """
+    blocks = []
+    for num, (addr, contents) in enumerate(mem_blocks(image)):
+        filename = f"build_mem{num}.bin"
+        with open(os.path.join(output_dir, filename), 'wb') as out_file:
+            out_file.write(contents)
+        blocks.append({"file": filename, "addr": addr, "size": len(contents)})
+
+    with open(os.path.join(output_dir, "build.json"), 'w') as out_file:
+        json.dump({"endian": "big", "blocks": blocks, "symbols": image.symbols},
+                  out_file, indent=4)
+
+
+def cache_key(asm_file, options):
+    """
+    Computes the build cache key of a program: a hash of its source, the
+    assembler itself (so any change to the assembler invalidates the cache),
+    and the output options, along with the files it includes with .incbin. The
+    source is hashed in chunks so large programs are never read into memory
+    whole.
+
+    Args:
+        asm_file (str): path to the .asm file
+        options (tuple): output options that affect the memory files
+
+    Returns:
+        str: hex digest identifying the build
+    """
+    digest = hashlib.sha256()
+    with open(__file__, 'rb') as in_file:
+        digest.update(in_file.read())
+    digest.update(repr(options).encode())
+    with open(asm_file, 'rb') as in_file:
+        for chunk in iter(lambda: in_file.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+
+    # Included files (missing files are reported when the program is assembled)
+    with open(asm_file, 'r') as in_file:
+        includes = [INCBIN_RE.match(line.split(';')[0].split('.incbin', 1)[1])
+                    for line in in_file if '.incbin' in line.split(';')[0]]
+    for match in filter(None, includes):
+        path = os.path.join(os.path.dirname(asm_file), match["quoted"] or match["file"])
+        if os.path.isfile(path):
+            with open(path, 'rb') as in_file:
+                for chunk in iter(lambda: in_file.read(HASH_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_restore(cache_dir, key, filenames, output_dir):
+    """
+    Copies the memory files of a cached build to the output directory.
+
+    Returns:
+        list[Optimization]: the optimization report of the build on a cache
+                            hit, None if the build is not cached
+    """
+    entry = os.path.join(cache_dir, key)
+    if not all(os.path.isfile(os.path.join(entry, name)) for name in filenames + (REPORT_FILE,)):
+        return None
+    for name in filenames:
+        shutil.copyfile(os.path.join(entry, name), os.path.join(output_dir, name))
+    with open(os.path.join(entry, REPORT_FILE), 'r') as in_file:
+        report = [Optimization(**opt) for opt in json.load(in_file)]
+    os.utime(entry)     # mark entry as recently used
+    return report
+
+
+def cache_store(cache_dir, key, filenames, output_dir, report=None):
+    """
+    Saves the memory files just written to the output directory in the cache,
+    with the optimization report of the build (the -O passes are part of the
+    key, so the report of an entry is that of any build it is restored for).
+    The entry is written under a temporary name and renamed into place so a
+    concurrent or interrupted build never leaves a partial entry behind.
+    """
+    entry = os.path.join(cache_dir, key)
+    if os.path.isdir(entry):
+        return
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_entry = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp")
+    for name in filenames:
+        shutil.copyfile(os.path.join(output_dir, name), os.path.join(temp_entry, name))
+    if report is not None:
+        with open(os.path.join(temp_entry, REPORT_FILE), 'w') as out_file:
+            json.dump([opt._asdict() for opt in report], out_file)
+    try:
+        os.rename(temp_entry, entry)
+    except OSError:
+        shutil.rmtree(temp_entry, ignore_errors=True)   # stored concurrently
+
+
+def cache_evict(cache_dir, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+    """
+    Removes cache entries not used within max_age seconds, then the least
+    recently used entries until the cache holds at most max_bytes.
+    """
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []    # (last used time, size, path)
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if os.path.isdir(path) and not name.startswith('.'):
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            entries.append((os.path.getmtime(path), size, path))
+
+    now = time.time()
+    total = sum(size for _, size, _ in entries)
+    for used, size, path in sorted(entries):
+        if now - used > max_age or total > max_bytes:
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+
+
+def build_file(asm_file, output_dir, fmt="text", cache_dir=CACHE_DIR, optimize=(),
+               listing=False):
+    """
+    Assembles a source file and writes its memory files to output_dir, reusing
+    a cached build of an unchanged program when possible.
+
+    Args:
+        asm_file (str): path to the .asm file
+        output_dir (str): directory to write the memory files to
+        fmt (str): output format, "text" or "bin"
+        cache_dir (str or None): build cache directory, or None to disable it
+        optimize (tuple): names of OPTIMIZATIONS passes to run, in order
+        listing (bool): also write the cycle-annotated listing (build.lst)
+
+    Returns:
+        tuple: (paths of the memory files written, whether the build was cached,
+                Optimization report)
+    """
+    filenames = OUTPUT_FILES[fmt] + ((LISTING_FILE,) if listing else ())
+    paths = [os.path.join(output_dir, name) for name in filenames]
+
+    # Reuse the memory files of an unchanged program from the build cache
+    key = cache_key(asm_file, (fmt, tuple(optimize), listing))
+    report = cache_restore(cache_dir, key, filenames, output_dir) if cache_dir else None
+    if report is not None:
+        return paths, True, report
+
+    image = assemble_file(asm_file, optimize=optimize)
+    if fmt == "bin":
+        write_bin_files(image, output_dir)
+    else:
+        write_mem_files(image, output_dir)
+    if listing:
+        write_listing(image, output_dir)
+
+    if cache_dir:
+        cache_store(cache_dir, key, filenames, output_dir, image.report)
+    return paths, False, image.report
+
+
+def build_batch(asm_files, output_dir, fmt="text", cache_dir=CACHE_DIR, jobs=1,
+                optimize=(), listing=False):
+    """
+    Assembles many programs across a pool of processes. Each program is written
+    to its own directory, <output_dir>/<test>/, and a manifest.json listing the
+    memory files of every program is written to output_dir.
+
+    Args:
+        asm_files (list[str]): paths to the .asm files
+        output_dir (str): directory to create the per-test directories in
+        fmt (str): output format, "text" or "bin"
+        cache_dir (str or None): build cache directory, or None to disable it
+        jobs (int): number of worker processes (0 for one per CPU)
+        optimize (tuple): names of OPTIMIZATIONS passes to run, in order
+        listing (bool): also write the cycle-annotated listing of each program
+
+    Returns:
+        list[dict]: manifest entry of each program, with "error" set for any
+                    program that failed to assemble and "report" listing the
+                    optimizations applied
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in asm_files]
+    if len(set(names)) != len(names):
+        raise ValueError("Batch assembly requires unique test names")
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        futures = []
+        for name, asm_file in zip(names, asm_files):
+            test_dir = os.path.join(output_dir, name)
+            os.makedirs(test_dir, exist_ok=True)
+            futures.append(pool.submit(build_file, asm_file, test_dir, fmt, cache_dir,
+                                       optimize, listing))
+
+        manifest = []
+        for name, asm_file, future in zip(names, asm_files, futures):
+            entry = {"test": name, "source": asm_file,
+                     "output_dir": os.path.join(output_dir, name)}
+            try:
+                entry["files"], entry["cached"], report = future.result()
+                entry["report"] = [opt._asdict() for opt in report]
+            except (OSError, ValueError, KeyError) as err:
+                entry["error"] = str(err)
+            manifest.append(entry)
+
+    with open(os.path.join(output_dir, "manifest.json"), 'w') as out_file:
+        json.dump({"format": fmt, "tests": manifest}, out_file, indent=4)
+    return manifest
+
+
+def compile_file(asm_file, cache_dir=CACHE_DIR, optimize=()):
+    """
+    Assembles a source file into a relocatable object, reusing the cached
+    object of an unchanged module when possible.
+
+    Args:
+        asm_file (str): path to the .asm file
+        cache_dir (str or None): build cache directory, or None to disable it
+        optimize (tuple): names of OPTIMIZATIONS passes to run, in order
+
+    Returns:
+        ObjectFile: the assembled module
+    """
+    key = cache_key(asm_file, ("object", tuple(optimize)))
+    entry = os.path.join(cache_dir, key) if cache_dir else None
+    if entry and os.path.isfile(os.path.join(entry, OBJECT_FILE)):
+        os.utime(entry)     # mark entry as recently used
+        return read_object(os.path.join(entry, OBJECT_FILE))
+
+    obj = assemble_object_file(asm_file, optimize=optimize)
+    if cache_dir:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            write_object(obj, os.path.join(temp_dir, OBJECT_FILE))
+            cache_store(cache_dir, key, (OBJECT_FILE,), temp_dir)
+    return obj
+
+
+def link_files(paths, runtime=RUNTIME_FILE, cache_dir=CACHE_DIR, optimize=()):
+    """
+    Links modules, given as sources or objects, into one program after the
+    runtime. Sources are assembled through the build cache, so only the
+    modules changed since the last link are assembled again.
+
+    Args:
+        paths (list[str]): paths to .asm sources or .obj objects, in link order
+        runtime (str or None): path to the runtime source or object, or None
+                               to link without it
+        cache_dir (str or None): build cache directory, or None to disable it
+        optimize (tuple): names of OPTIMIZATIONS passes to run on sources
+
+    Returns:
+        Image: the linked program
+    """
+    objects = []
+    for path in ([runtime] if runtime else []) + list(paths):
+        try:
+            objects.append(read_object(path) if path.endswith(OBJECT_EXT)
+                           else compile_file(path, cache_dir, optimize))
+        except ValueError as err:
+            raise ValueError(f"{path}: {err}") from None
+    return link(objects)
+
+
+def print_report(report):
+    """
+    Prints the optimizations applied to a program and the cycles they save.
+    """
+    saved = {"executed": 0, "taken": 0}
+    for opt in report:
+        print(f"  line {opt.line_num}: {opt.message}, saves {opt.cycles} " +
+              f"cycle{'s' if opt.cycles != 1 else ''} each time " +
+              ("it runs" if opt.when == "executed" else "the branch is taken"))
+        saved[opt.when] += opt.cycles
+    if any(saved.values()):
+        print(f"  total: {saved['executed']} cycles per pass through the code, " +
+              f"{saved['taken']} more per taken branch")
+
+
+def main(argv):
+    """
+    Command line entry point. Assembles the given files and writes the memory
+    files to the output directory, either as the text files read by memory.vhd
+    or as raw binary images. A single file is written straight to the output
+    directory; several files (or --jobs) are assembled in parallel into
+    per-test directories. With -c the files are assembled to relocatable
+    objects, and with --link they are linked into a single program.
+    """
+    parser = argparse.ArgumentParser(prog="sh2_asm.py", description="SH-2 Assembler")
+    parser.add_argument("asm_files", nargs='+', metavar="asm_file",
+                        help="assembly source file(s)")
+    parser.add_argument("-o", "--output-dir", default=OUTPUT_DIR,
+                        help="directory to write memory files to")
+    parser.add_argument("--format", choices=("text", "bin"), default="text",
+                        help="text memory files for memory.vhd (default) or " +
+                             "raw big-endian binary images with a JSON symbol map")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="assemble in parallel into <output_dir>/<test>/ " +
+                             "directories with this many processes (0 for one per CPU)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR,
+                        help="build cache of previously assembled programs")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="always assemble, bypassing the build cache")
+    parser.add_argument("-O", "--optimize", action="append", default=[],
+                        choices=tuple(OPTIMIZATIONS),
+                        help="run an optimization pass and report what it saves " +
+                             "(may be given more than once)")
+    parser.add_argument("--listing", action="store_true",
+                        help="also write build.lst, a listing with the cycles of " +
+                             "each instruction, basic block, and label")
+    parser.add_argument("--hazards", action="store_true",
+                        help="print the pipeline stalls of each basic block and " +
+                             "a hot list of the worst hazards")
+    parser.add_argument("--split-memory", action="store_true",
+                        help="target separate instruction and data memories (as " +
+                             "sh2_pipe.py --split-memory) for --hazards and -O schedule")
+    parser.add_argument("-c", "--compile", action="store_true",
+                        help="write a relocatable object (<name>.obj) of each " +
+                             "file instead of memory files")
+    parser.add_argument("--link", action="store_true",
+                        help="link the files (sources or objects) and the runtime " +
+                             "into one program")
+    parser.add_argument("--runtime", default=RUNTIME_FILE,
+                        help="runtime linked before the other modules")
+    parser.add_argument("--no-runtime", action="store_true",
+                        help="link without the runtime")
+    args = parser.parse_args(argv[1:])
+    warnings.formatwarning = lambda message, *_: f"warning: {message}\n"
+    if "schedule" in args.optimize and not args.split_memory:
+        parser.error("-O schedule only saves cycles with separate memories (--split-memory)")
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    # Relocatable object of each module
+    if args.compile:
+        for asm_file in args.asm_files:
+            name = os.path.splitext(os.path.basename(asm_file))[0]
+            write_object(assemble_object_file(asm_file, optimize=args.optimize),
+                         os.path.join(args.output_dir, name + OBJECT_EXT))
+        return 0
+
+    # Modules linked into a single program written to the output directory
+    if args.link:
+        image = link_files(args.asm_files, None if args.no_runtime else args.runtime,
+                           cache_dir, tuple(args.optimize))
+        if args.format == "bin":
+            write_bin_files(image, args.output_dir)
+        else:
+            write_mem_files(image, args.output_dir)
+        if args.listing:
+            write_listing(image, args.output_dir)
+        print_report(image.report)
+        if args.hazards:
+            print_hazards(analyze_hazards(image, args.split_memory))
+
+    # Single program written straight to the output directory
+    elif len(args.asm_files) == 1 and args.jobs is None:
+        _, _, report = build_file(args.asm_files[0], args.output_dir, args.format,
+                                  cache_dir, tuple(args.optimize), args.listing)
+        print_report(report)
+
+    # Batch of programs written to per-test directories
+    else:
+        manifest = build_batch(args.asm_files, args.output_dir, args.format,
+                               cache_dir, args.jobs or 0, tuple(args.optimize),
+                               args.listing)
+        for entry in manifest:
+            if entry.get("report"):
+                print(f"{entry['source']}:")
+                print_report(Optimization(**opt) for opt in entry["report"])
+        failed = [entry for entry in manifest if "error" in entry]
+        for entry in failed:
+            print(f"{entry['source']}: {entry['error']}")
+        if failed:
+            return 1
+
+    # Static pipeline analysis of each program
+    if args.hazards and not args.link:
+        for asm_file in args.asm_files:
+            print(f"{asm_file}:")
+            print_hazards(analyze_hazards(assemble_file(asm_file, optimize=args.optimize),
+                                          args.split_memory))
+
+    if cache_dir:
+        cache_evict(cache_dir)
+    return 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,744 @@
+"""
+SH-2 Batched Instruction Set Simulator
+
+Runs many independent programs at once in lockstep, for fuzzing and design
+space sweeps that need far more executions than GHDL (or the one program at a
+time simulator of sh2_sim.py) can give. The registers and memories of all the
+programs are NumPy arrays with a row per program (a lane), and each step
+executes one instruction of every lane that is still running.
+
+Each step fetches the instruction word of every lane, looks up its operation
+and operands in tables generated at import from sh2_sim.decode_word (so from
+sh2_asm.INSTRUCTION_SET), and groups the lanes by operation. Each group is
+executed by one vectorized function built from the same OPERATIONS table as
+sh2_sim.py, so both simulators share the semantics of every instruction.
+Divergent control flow needs no special handling: every lane has its own PC
+and delay slot state, and lanes that halt or fault drop out of the steps.
+
+Usage:
+    python sh2_batch.py <input_file.asm> [...] [--copies N] [--check] [--bench]
+
+    Every program given is run --copies times (default 1000) in one batch,
+    and the number of instructions executed per second is reported. With
+    --check, every lane must end in the same state (registers and memory) as
+    the program run on sh2_sim.py, and with --bench, the rate of sh2_sim.py
+    on the same programs is measured for comparison.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from sh2_asm import MEM_BLOCKS, SLOT_ILLEGAL
+from sh2_sim import (MASK32, MAX_STEPS, OPERATIONS, PR_OFFSET, RTS_OFFSET, SR_MQ,
+                     SimulationError, Simulator, decode_word, load_program, sext)
+
+# Lanes of each program run by the command line
+COPIES = 1000
+
+
+def mem_layout():
+    """
+    Lays out the memory.vhd blocks in the memory of a lane, in address order
+    from the block no other block ends at. The blocks must be contiguous
+    modulo 2^32 (on HW3 the block at 0xFFFFFC00 wraps around to the one at
+    0), so an address is found in a lane with one subtraction and compare.
+
+    Returns:
+        tuple: (address of the first byte of a lane's memory,
+                dict of the offset of each block by its address)
+    """
+    ends = {(addr + size) & MASK32 for addr, size in MEM_BLOCKS}
+    base = next((addr for addr, _ in MEM_BLOCKS if addr not in ends), MEM_BLOCKS[0][0])
+    offsets = {addr: (addr - base) & MASK32 for addr, _ in MEM_BLOCKS}
+    end = 0
+    for addr, size in sorted(MEM_BLOCKS, key=lambda block: offsets[block[0]]):
+        assert offsets[addr] == end, "memory blocks are not contiguous"
+        end += size
+    return base, offsets
+
+
+# Memory of a lane (MEM_SIZE bytes from MEM_BASE)
+MEM_BASE, MEM_OFFSETS = mem_layout()
+MEM_SIZE = sum(size for _, size in MEM_BLOCKS)
+
+# Views of the memories by access size (every access is aligned, so a word or
+# long is one element of the big-endian view)
+ACCESS_VIEWS = {1: np.uint8, 2: '>u2', 4: '>u4'}
+SHIFTS = {1: 0, 2: 1, 4: 2}
+
+# Value of the defined flags of a byte, word, or long that has been written
+DEFINED = {1: 0x01, 2: 0x0101, 4: 0x01010101}
+
+# Operations in a fixed order (OP_ILLEGAL for words that are not instructions)
+OP_KEYS = tuple(OPERATIONS)
+OP_ILLEGAL = len(OP_KEYS)
+
+# Operands of every instruction word (up to three, as sh2_sim.decode_word)
+MAX_OPERANDS = 3
+
+# Whether each operand of an operand type is a register number (these are
+# passed to the functions executing instructions as indices into the
+# registers of all the lanes)
+REGISTER_OPERANDS = {
+    "reg": (True,), "mem": (True,), "inc": (True,), "dec": (True,),
+    "r0_indexed": (True,), "indexed": (False, True), "indexed_gbr": (False,),
+    "indexed_pc": (False,), "label": (False,), "imm": (False,),
+}
+
+
+def build_tables():
+    """
+    Builds the decode tables indexed by instruction word, and the operand
+    tables indexed by operation.
+
+    Returns:
+        tuple: arrays of the operation number of each word (OP_ILLEGAL if not
+               an instruction) and of its operands (3 x 65,536), and for each
+               operation, the number of operands, the positions of the
+               register operands, the position of the PC relative operand
+               (None if none), and the PC mask
+    """
+    index = {key: num for num, key in enumerate(OP_KEYS)}
+    arity = [0] * len(OP_KEYS)
+    pc_relative = [None] * len(OP_KEYS)
+    pc_masks = [~0] * len(OP_KEYS)
+    ops = np.full(0x10000, OP_ILLEGAL, np.int16)
+    operands = np.zeros((MAX_OPERANDS, 0x10000), np.int64)
+    for word in range(0x10000):
+        decoded = decode_word(word)
+        if decoded is not None:
+            key, args, rel, mask = decoded
+            num = index[key]
+            ops[word] = num
+            arity[num], pc_relative[num], pc_masks[num] = len(args), rel, mask
+            operands[:len(args), word] = args
+
+    registers = []
+    for num, (_, types) in enumerate(OP_KEYS):
+        flags = sum((REGISTER_OPERANDS.get(op_type, ()) for op_type in types), ())
+        assert len(flags) == arity[num]
+        registers.append(tuple(pos for pos, flag in enumerate(flags) if flag))
+    return ops, operands, tuple(arity), tuple(registers), tuple(pc_relative), tuple(pc_masks)
+
+
+OP_TABLE, OPERAND_TABLE, OP_ARITY, OP_REGISTERS, OP_PC_RELATIVE, OP_PC_MASK = build_tables()
+
+# Whether each operation is illegal in a delay slot
+SLOT_ILLEGAL_OPS = np.array([key[0] in SLOT_ILLEGAL for key in OP_KEYS] + [True])
+
+
+class BatchSimulator:
+    """
+    State of the CPUs of a batch of programs, one lane per program.
+
+    The registers of all the lanes are one array (register n of lane l is
+    element 16 * l + n), as are their memories (MEM_SIZE bytes per lane), so
+    that each access of a group of lanes is a single gather or scatter.
+
+    Attributes:
+        lanes (int): number of programs
+        r (ndarray): general registers (16 per lane, unsigned 32-bit values)
+        sr, gbr, vbr, pr, mach, macl, pc (ndarray): registers of each lane
+        mem, defined (ndarray): memory of each lane and whether each byte has
+                                been written (1 if written)
+        steps (ndarray): instructions executed by each lane
+        halted (ndarray): whether each lane has stopped (SLEEP or a fault)
+        faulted (ndarray): whether each lane has stopped on a fault
+        slot, slot_target (ndarray): whether each lane's next instruction is
+                                     a delay slot, and the branch target after it
+        errors (dict): lane -> message of the lanes that faulted
+    """
+
+    def __init__(self, sims):
+        """
+        Builds a batch from the state of simulators (usually just loaded).
+
+        Args:
+            sims (list[Simulator]): the CPU and memory of each lane
+        """
+        self.lanes = len(sims)
+        self.r = np.array([sim.r for sim in sims], np.int64).reshape(-1)
+        for name in ("sr", "gbr", "vbr", "pr", "mach", "macl", "pc"):
+            setattr(self, name, np.array([getattr(sim, name) for sim in sims], np.int64))
+        self.mem = np.zeros(self.lanes * MEM_SIZE, np.uint8)
+        self.defined = np.zeros(self.lanes * MEM_SIZE, np.uint8)
+        for lane, sim in enumerate(sims):
+            for addr, contents, defined in sim.blocks:
+                start, size = lane * MEM_SIZE + MEM_OFFSETS[addr], len(contents)
+                self.mem[start:start + size] = np.frombuffer(contents, np.uint8)
+                self.defined[start:start + size] = np.frombuffer(defined, np.uint8) != 0
+        self.mem_views = {size: self.mem.view(view) for size, view in ACCESS_VIEWS.items()}
+        self.defined_views = {size: self.defined.view(view) for size, view in ACCESS_VIEWS.items()}
+        self.steps = np.array([sim.steps for sim in sims], np.int64)
+        self.halted = np.array([sim.halted for sim in sims], bool)
+        self.faulted = np.zeros(self.lanes, bool)
+        self.slot = np.zeros(self.lanes, bool)
+        self.slot_target = np.zeros(self.lanes, np.int64)
+        self.errors = {}
+
+        # The running lanes are found again only after lanes halt, and
+        # their step limit is checked only once a lane could have reached it
+        self.running = np.flatnonzero(~self.halted)
+        self.most_steps = int(self.steps.max(initial=0))
+
+    def fault(self, lanes, message):
+        """
+        Stops lanes that cannot continue, recording why.
+
+        Args:
+            lanes (ndarray): the lanes
+            message (callable): lane -> error message
+        """
+        for lane in lanes:
+            if lane not in self.errors:
+                self.errors[lane] = message(lane)
+        self.halt(lanes)
+        self.faulted[lanes] = True
+
+    def halt(self, lanes):
+        """
+        Stops lanes (on SLEEP or a fault).
+        """
+        self.halted[lanes] = True
+        self.running = np.flatnonzero(~self.halted)
+
+    # Registers
+
+    @staticmethod
+    def r0(lanes):
+        """
+        Indices of R0 of each lane in r.
+        """
+        return lanes << 4
+
+    @staticmethod
+    def r15(lanes):
+        """
+        Indices of R15 (the stack pointer) of each lane in r.
+        """
+        return (lanes << 4) + 15
+
+    # Memory
+
+    def indices(self, lanes, addr, size):
+        """
+        Finds the accesses in the memories of their lanes (as element indices
+        in the view of the access size), faulting the lanes whose access is
+        misaligned or unmapped.
+
+        Returns:
+            tuple: (indices, mask of the accesses that are valid)
+        """
+        offset = (addr - MEM_BASE) & MASK32
+        valid = offset <= MEM_SIZE - size
+        if size > 1:
+            valid &= offset & (size - 1) == 0
+        index = lanes * MEM_SIZE + offset
+        if not valid.all():
+            bad = ~valid
+            pcs = dict(zip(lanes[bad], self.pc[lanes[bad]]))
+            addrs = dict(zip(lanes[bad], addr[bad]))
+            self.fault(lanes[bad], lambda lane: f"Misaligned or unmapped {size}-byte access of " +
+                       f"0x{addrs[lane]:08X} at PC 0x{pcs[lane]:08X}")
+            index[bad] = lanes[bad] * MEM_SIZE
+        return index >> SHIFTS[size], valid
+
+    def read(self, lanes, addr, size):
+        """
+        Reads a byte, word, or long (big-endian, zero-extended) in each lane.
+        """
+        index, _ = self.indices(lanes, addr, size)
+        return self.mem_views[size][index].astype(np.int64)
+
+    def write(self, lanes, addr, size, value):
+        """
+        Writes the low bytes of a value as a byte, word, or long in each lane.
+        """
+        index, valid = self.indices(lanes, addr, size)
+        value = np.broadcast_to(value, index.shape)
+        if not valid.all():
+            index, value = index[valid], value[valid]
+        self.mem_views[size][index] = value & ((1 << 8 * size) - 1)
+        self.defined_views[size][index] = DEFINED[size]
+
+    def push(self, lanes, value):
+        """
+        Pushes a long on the stack (@-R15) of each lane.
+        """
+        sp = self.r15(lanes)
+        self.r[sp] = (self.r[sp] - 4) & MASK32
+        self.write(lanes, self.r[sp], 4, value)
+
+    def pop(self, lanes):
+        """
+        Pops a long from the stack (@R15+) of each lane.
+        """
+        sp = self.r15(lanes)
+        value = self.read(lanes, self.r[sp], 4)
+        self.r[sp] = (self.r[sp] + 4) & MASK32
+        return value
+
+    # Status register
+
+    def t(self, lanes):
+        """
+        The T bit of each lane.
+        """
+        return self.sr[lanes] & 1
+
+    def set_t(self, lanes, t):
+        """
+        Sets the T bit of each lane, clearing the other bits of SR (see
+        Simulator.set_t).
+        """
+        self.sr[lanes] = t
+
+    def set_delayed(self, lanes, target):
+        """
+        Makes the next instruction of each lane the slot of a delayed branch.
+        """
+        self.slot[lanes] = True
+        self.slot_target[lanes] = target & MASK32
+
+    # Execution
+
+    def step(self, max_steps=MAX_STEPS):
+        """
+        Executes one instruction in every running lane.
+
+        Returns:
+            int: instructions executed
+        """
+        if self.most_steps >= max_steps:
+            over = self.running[self.steps[self.running] >= max_steps]
+            if len(over):
+                self.fault(over, lambda lane: f"No SLEEP after {max_steps} instructions " +
+                           f"(PC 0x{self.pc[lane]:08X})")
+        lanes = self.running
+        self.most_steps += 1
+
+        # Fetch and decode
+        pc = self.pc[lanes]
+        index, valid = self.indices(lanes, pc, 2)
+        words = self.mem_views[2][index].astype(np.int64)
+        undefined = self.defined_views[2][index] != DEFINED[2]
+        ops = OP_TABLE[words]
+        slot = self.slot[lanes]
+        has_slot = slot.any()
+        bad = ~valid | undefined | (ops == OP_ILLEGAL)
+        if has_slot:
+            bad |= slot & SLOT_ILLEGAL_OPS[ops]
+        if bad.any():
+            faults = dict(zip(lanes[bad], zip(pc[bad], words[bad], slot[bad], undefined[bad] & valid[bad])))
+            self.fault(lanes[bad], lambda lane: self.decode_error(*faults[lane]))
+            keep = ~bad
+            lanes, pc, words, ops, slot = lanes[keep], pc[keep], words[keep], ops[keep], slot[keep]
+        if has_slot:
+            targets = self.slot_target[lanes]
+            self.slot[lanes] = False
+
+        # Execute each operation on its lanes (the functions return None to
+        # go on to the next instruction); then lanes in a slot take their
+        # branch, and delayed branches have set up their slot
+        next_pc = pc + 2
+        order = np.argsort(ops, kind='stable')
+        sorted_ops = ops[order]
+        bounds = np.flatnonzero(sorted_ops[1:] != sorted_ops[:-1]) + 1
+        starts, ends = [0, *bounds.tolist()], [*bounds.tolist(), len(order)]
+        for start, end in zip(starts, ends):
+            group = order[start:end]
+            num = int(sorted_ops[start])
+            group_lanes, group_pc, group_words = lanes[group], pc[group], words[group]
+            args = [OPERAND_TABLE[col][group_words] for col in range(OP_ARITY[num])]
+            if OP_REGISTERS[num]:
+                base = group_lanes << 4
+                for pos in OP_REGISTERS[num]:
+                    args[pos] += base
+            rel = OP_PC_RELATIVE[num]
+            if rel is not None:
+                args[rel] = ((group_pc & OP_PC_MASK[num]) + args[rel]) & MASK32
+            result = EXECUTE[num](self, group_lanes, group_pc, *args)
+            if result is not None:
+                next_pc[group] = result
+        if has_slot:
+            next_pc = np.where(slot, targets, next_pc)
+
+        # Lanes that faulted stay at the instruction that faulted
+        done = ~self.faulted[lanes]
+        if done.all():
+            self.pc[lanes] = next_pc & MASK32
+        else:
+            self.pc[lanes[done]] = next_pc[done] & MASK32
+        self.steps[lanes] += 1
+        return len(lanes)
+
+    @staticmethod
+    def decode_error(pc, word, slot, undefined):
+        """
+        Message of a lane whose instruction cannot execute.
+        """
+        if undefined:
+            return f"Execution of undefined memory at 0x{pc:08X}"
+        if slot and OP_TABLE[word] != OP_ILLEGAL:
+            return f"Illegal slot instruction at 0x{pc:08X}"
+        return f"Illegal instruction 0x{word:04X} at 0x{pc:08X}"
+
+    def run(self, max_steps=MAX_STEPS):
+        """
+        Runs every lane until SLEEP (or a fault).
+
+        Returns:
+            int: instructions executed by all the lanes
+        """
+        total = 0
+        while len(self.running):
+            total += self.step(max_steps)
+        return total
+
+    # Results
+
+    def simulator(self, lane):
+        """
+        Copies the state of a lane into a Simulator (e.g., to write its dumps).
+        """
+        sim = Simulator([(addr, None) for addr, _ in MEM_BLOCKS])
+        sim.r = [int(value) for value in self.r[16 * lane:16 * lane + 16]]
+        for name in ("sr", "gbr", "vbr", "pr", "mach", "macl", "pc"):
+            setattr(sim, name, int(getattr(self, name)[lane]))
+        for addr, contents, defined in sim.blocks:
+            start, size = lane * MEM_SIZE + MEM_OFFSETS[addr], len(contents)
+            contents[:] = self.mem[start:start + size].tobytes()
+            defined[:] = self.defined[start:start + size].tobytes()
+        sim.steps = int(self.steps[lane])
+        sim.halted = bool(self.halted[lane] and not self.faulted[lane])
+        return sim
+
+
+# Factories of the functions executing each kind of operation on a group of
+# lanes, as the factories of sh2_sim.py. The functions are called with the
+# batch, the lanes, and arrays of their PCs and operands (register operands
+# as indices into BatchSimulator.r), and return the array of next PCs, or
+# None to go on to the next instruction.
+
+def alu(func):
+    def execute(b, lanes, pc, m, n):
+        b.r[n] = func(b.r[n], b.r[m]) & MASK32
+    return execute
+
+
+def alu_imm(func):
+    def execute(b, lanes, pc, imm, n):
+        b.r[n] = func(b.r[n], imm) & MASK32
+    return execute
+
+
+def compare(pred):
+    def execute(b, lanes, pc, m, n):
+        b.set_t(lanes, pred(b.r[n], b.r[m]))
+    return execute
+
+
+def compare_imm(pred):
+    def execute(b, lanes, pc, imm, n):
+        b.set_t(lanes, pred(b.r[n], imm))
+    return execute
+
+
+def test(pred):
+    def execute(b, lanes, pc, n):
+        b.set_t(lanes, pred(b.r[n]))
+    return execute
+
+
+def shift(func):
+    def execute(b, lanes, pc, n):
+        result, t = func(b.r[n], b.t(lanes))
+        b.r[n] = result
+        if t is not None:
+            b.set_t(lanes, t)
+    return execute
+
+
+def carry(func):
+    def execute(b, lanes, pc, m, n):
+        result, t = func(b.r[n], b.r[m], b.t(lanes))
+        b.r[n] = result & MASK32
+        b.set_t(lanes, t)
+    return execute
+
+
+def load(size, mode):
+    def address(b, lanes, args):
+        if mode in ("mem", "inc"):
+            return b.r[args[0]]
+        if mode == "r0_indexed":
+            return b.r[b.r0(lanes)] + b.r[args[0]]
+        if mode == "indexed":
+            return b.r[args[1]] + args[0]
+        if mode == "indexed_gbr":
+            return b.gbr[lanes] + args[0]
+        return args[0]
+
+    def execute(b, lanes, pc, *args):
+        value = sext(b.read(lanes, address(b, lanes, args), size), size)
+        if mode == "inc":
+            b.r[args[0]] = (b.r[args[0]] + size) & MASK32
+        b.r[args[-1]] = value
+    return execute
+
+
+def store(size, mode):
+    def execute(b, lanes, pc, m, *args):
+        value = b.r[m]
+        if mode == "mem":
+            addr = b.r[args[0]]
+        elif mode == "dec":
+            addr = b.r[args[0]] = (b.r[args[0]] - size) & MASK32
+        elif mode == "r0_indexed":
+            addr = b.r[b.r0(lanes)] + b.r[args[0]]
+        elif mode == "indexed":
+            addr = b.r[args[1]] + args[0]
+        else:
+            addr = b.gbr[lanes] + args[0]
+        b.write(lanes, addr, size, value)
+    return execute
+
+
+def store_control(name):
+    def execute(b, lanes, pc, n):
+        b.r[n] = getattr(b, name)[lanes]
+    return execute
+
+
+def push_control(name):
+    def execute(b, lanes, pc, n):
+        b.r[n] = (b.r[n] - 4) & MASK32
+        b.write(lanes, b.r[n], 4, getattr(b, name)[lanes])
+    return execute
+
+
+def load_control(name):
+    def execute(b, lanes, pc, m):
+        getattr(b, name)[lanes] = b.r[m]
+    return execute
+
+
+def pop_control(name):
+    def execute(b, lanes, pc, m):
+        getattr(b, name)[lanes] = b.read(lanes, b.r[m], 4)
+        b.r[m] = (b.r[m] + 4) & MASK32
+    return execute
+
+
+def gbr_byte(func):
+    def execute(b, lanes, pc, imm):
+        addr = b.gbr[lanes] + b.r[b.r0(lanes)]
+        b.write(lanes, addr, 1, func(b.read(lanes, addr, 1), imm))
+    return execute
+
+
+def gbr_test(pred):
+    def execute(b, lanes, pc, imm):
+        b.set_t(lanes, pred(b.read(lanes, b.gbr[lanes] + b.r[b.r0(lanes)], 1), imm))
+    return execute
+
+
+def branch(taken_if, delayed):
+    def execute(b, lanes, pc, target):
+        taken = b.t(lanes) == taken_if
+        if delayed:
+            b.set_delayed(lanes[taken], target[taken])
+            return None
+        return np.where(taken, target, pc + 2)
+    return execute
+
+
+def branch_always(link):
+    def execute(b, lanes, pc, target):
+        b.set_delayed(lanes, target)
+        if link:
+            b.pr[lanes] = pc + PR_OFFSET
+    return execute
+
+
+def branch_far(link):
+    def execute(b, lanes, pc, m):
+        b.set_delayed(lanes, pc + b.r[m])
+        if link:
+            b.pr[lanes] = pc + PR_OFFSET
+    return execute
+
+
+def jump(link):
+    def execute(b, lanes, pc, m):
+        b.set_delayed(lanes, b.r[m])
+        if link:
+            b.pr[lanes] = pc + PR_OFFSET
+    return execute
+
+
+def set_t(t):
+    def execute(b, lanes, pc):
+        b.set_t(lanes, t)
+    return execute
+
+
+def nop():
+    return lambda b, lanes, pc: None
+
+
+def sleep():
+    def execute(b, lanes, pc):
+        b.halt(lanes)
+        return pc
+    return execute
+
+
+def clear_mac():
+    def execute(b, lanes, pc):
+        b.mach[lanes] = b.macl[lanes] = 0
+    return execute
+
+
+def div0u():
+    def execute(b, lanes, pc):
+        b.sr[lanes] &= ~SR_MQ
+        b.set_t(lanes, 0)
+    return execute
+
+
+def rts():
+    def execute(b, lanes, pc):
+        b.set_delayed(lanes, b.pr[lanes] + RTS_OFFSET)
+    return execute
+
+
+def rte():
+    def execute(b, lanes, pc):
+        b.set_delayed(lanes, b.pop(lanes))
+        b.sr[lanes] = b.pop(lanes)
+    return execute
+
+
+def trapa():
+    def execute(b, lanes, pc, imm):
+        b.push(lanes, b.sr[lanes])
+        b.push(lanes, pc + 2)
+        return b.read(lanes, b.vbr[lanes] + 4 * imm, 4)
+    return execute
+
+
+def dt():
+    def execute(b, lanes, pc, n):
+        b.r[n] = (b.r[n] - 1) & MASK32
+        b.set_t(lanes, b.r[n] == 0)
+    return execute
+
+
+def movt():
+    def execute(b, lanes, pc, n):
+        b.r[n] = b.t(lanes)
+    return execute
+
+
+def tas():
+    def execute(b, lanes, pc, n):
+        value = b.read(lanes, b.r[n], 1)
+        b.set_t(lanes, value == 0)
+        b.write(lanes, b.r[n], 1, value | 0x80)
+    return execute
+
+
+def mova():
+    def execute(b, lanes, pc, addr, n):
+        b.r[b.r0(lanes)] = addr
+    return execute
+
+
+FACTORIES = {
+    "alu": alu, "alu_imm": alu_imm, "compare": compare, "compare_imm": compare_imm,
+    "test": test, "shift": shift, "carry": carry, "load": load, "store": store,
+    "store_control": store_control, "push_control": push_control,
+    "load_control": load_control, "pop_control": pop_control,
+    "gbr_byte": gbr_byte, "gbr_test": gbr_test, "branch": branch,
+    "branch_always": branch_always, "branch_far": branch_far, "jump": jump,
+    "set_t": set_t, "nop": nop, "sleep": sleep, "clear_mac": clear_mac,
+    "div0u": div0u, "rts": rts, "rte": rte, "trapa": trapa, "dt": dt,
+    "movt": movt, "tas": tas, "mova": mova,
+}
+
+# Function executing each operation (by number)
+EXECUTE = [FACTORIES[kind](*params) for kind, *params in OPERATIONS.values()]
+
+
+def main(argv):
+    """
+    Command line entry point. Runs copies of programs in one batch and
+    reports the rate of execution (and optionally checks the lanes against
+    sh2_sim.py and compares its rate).
+    """
+    parser = argparse.ArgumentParser(prog="sh2_batch.py",
+                                     description="SH-2 Batched Instruction Set Simulator")
+    parser.add_argument("programs", nargs='+', metavar="program",
+                        help="assembly sources or build directories to run")
+    parser.add_argument("--copies", type=int, default=COPIES,
+                        help="lanes running each program (default %(default)d)")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS,
+                        help="instructions executed by a lane before giving up (default %(default)d)")
+    parser.add_argument("--check", action="store_true",
+                        help="check every lane against the program run on sh2_sim.py")
+    parser.add_argument("--bench", action="store_true",
+                        help="also measure the rate of sh2_sim.py on the programs")
+    args = parser.parse_args(argv[1:])
+
+    try:
+        sims = [load_program(path) for path in args.programs]
+    except (OSError, ValueError) as err:
+        print(f"Error: {err}")
+        return 1
+
+    batch = BatchSimulator([sim for sim in sims for _ in range(args.copies)])
+    start = time.perf_counter()
+    total = batch.run(args.max_steps)
+    elapsed = time.perf_counter() - start
+    print(f"{batch.lanes} lanes: {total} instructions in {elapsed:.3f} s " +
+          f"({total / elapsed:,.0f} instructions/s)")
+    for num, path in enumerate(args.programs):
+        lanes = range(num * args.copies, (num + 1) * args.copies)
+        errors = sorted({batch.errors[lane] for lane in lanes if lane in batch.errors})
+        print(f"  {path}: " + ("; ".join(errors) if errors else
+                               f"halted after {batch.steps[lanes[0]]} instructions"))
+
+    # Reference runs on the scalar simulator
+    status = 0
+    if args.check or args.bench:
+        scalar_total, start = 0, time.perf_counter()
+        for sim in sims:
+            try:
+                scalar_total += sim.run(args.max_steps)
+            except SimulationError:
+                scalar_total += sim.steps
+        scalar_elapsed = time.perf_counter() - start
+        if args.bench:
+            scalar_rate = scalar_total / scalar_elapsed
+            print(f"sh2_sim.py: {scalar_total} instructions in {scalar_elapsed:.3f} s " +
+                  f"({scalar_rate:,.0f} instructions/s), batch speedup " +
+                  f"{total / elapsed / scalar_rate:.1f}x")
+        if args.check:
+            mismatches = 0
+            for lane in range(batch.lanes):
+                sim, again = sims[lane // args.copies], batch.simulator(lane)
+                if (sim.r, sim.sr, sim.gbr, sim.vbr, sim.pr, sim.pc, sim.blocks) != \
+                   (again.r, again.sr, again.gbr, again.vbr, again.pr, again.pc, again.blocks):
+                    mismatches += 1
+            print(f"check: {mismatches} lane{'s' if mismatches != 1 else ''} differ from sh2_sim.py")
+            status = 1 if mismatches else 0
+    return status
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,154 @@
+"""
+SH-2 Assembler Benchmark
+
+Measures the throughput of the in-process assembler on a large synthetic
+program. The generated source cycles through every operand addressing mode
+accepted by the assembler, with a label every few lines and short PC-relative
+branches between them, so the result is representative of hand-written tests
+scaled up to a large generated program.
+
+Usage:
+    python sh2_bench.py [num_lines]
+    python sh2_bench.py --memory [num_lines]
+
+    num_lines defaults to 1,000,000. The benchmark reports lines per second
+    for operand classification alone (with and without the operand cache) and
+    for a full assembly.
+
+    With --memory, sources of increasing size (up to num_lines) are written to
+    temporary files and assembled from disk, reporting the peak memory of each
+    assembly next to the size of its source. Since the assembler streams the
+    source, peak memory should grow with the image, symbols, and fixups only.
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+
+from sh2_asm import assemble, assemble_file, parse_operand
+
+# Instruction lines the synthetic source is built from (one of each operand type)
+TEMPLATE = [
+    "    MOV     #4, R0          ; immediate",
+    "    SHLL8   R0",
+    "    MOV     R0, R10",
+    "    ADD     #-5, R10",
+    "    MOV.L   R1, @R10        ; indirect",
+    "    MOV.B   @R10+, R2       ; post-increment",
+    "    MOV.W   R3, @-R11       ; pre-decrement",
+    "    MOV.L   R7,@(1,R11)     ; register displacement",
+    "    MOV.W   @(5, GBR), R0   ; GBR displacement",
+    "    AND.B   #15,@(R0,GBR)",
+    "    MOV.L   @(2, PC), R14   ; PC displacement",
+    "    MOV.B   R4,@(R0,R12)    ; R0 indexed",
+    "    LDC     R9, GBR",
+    "    STS.L   PR, @-R15",
+    "    CMP/EQ  R1, R2",
+    "    NOP",
+]
+
+# Number of instruction lines between labels
+BLOCK_SIZE = 32
+
+
+def iter_source(num_lines):
+    """
+    Generates a synthetic assembly program of num_lines lines a line at a time.
+
+    Args:
+        num_lines (int): number of source lines to generate
+
+    Yields:
+        str: each source line
+    """
+    yield ".text\n"
+    line_num, block = 1, 0
+    while line_num < num_lines:
+        block_lines = [f"Block{block}:\n"]
+        block_lines += [TEMPLATE[i % len(TEMPLATE)] + "\n" for i in range(BLOCK_SIZE - 2)]
+        block_lines.append(f"    BF      Block{block}\n")
+        for line in block_lines[:num_lines - line_num]:
+            yield line
+        line_num += len(block_lines)
+        block += 1
+
+
+def generate_source(num_lines):
+    """
+    Generates a synthetic assembly program of num_lines lines.
+
+    Args:
+        num_lines (int): number of source lines to generate
+
+    Returns:
+        list[str]: the source lines
+    """
+    return list(iter_source(num_lines))
+
+
+def bench(name, func, num_lines):
+    """
+    Times a single call of func and prints the throughput in lines/second.
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed:8.3f} s  {num_lines / elapsed:12,.0f} lines/s")
+
+
+def bench_memory(num_lines):
+    """
+    Assembles sources of increasing size from disk and prints the peak memory
+    of each assembly next to the size of the source.
+    """
+    print(f"{'lines':>12} {'source':>10} {'peak':>10} {'fixups':>10} {'time':>9}")
+    sizes = [num_lines // 16, num_lines // 4, num_lines]
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, "bench.asm")
+            with open(path, 'w') as asm_file:
+                asm_file.writelines(iter_source(size))
+            source_bytes = os.path.getsize(path)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            image = assemble_file(path, keep_source=False)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            print(f"{size:12,} {source_bytes / 2**20:8.1f}MB {peak / 2**20:8.1f}MB "
+                  f"{len(image.fixups):10,} {elapsed:8.3f}s")
+
+
+# Main loop
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="SH-2 assembler benchmark")
+    parser.add_argument("num_lines", nargs='?', type=int, default=1_000_000,
+                        help="number of source lines to generate")
+    parser.add_argument("--memory", action="store_true",
+                        help="report peak memory when assembling from disk")
+    args = parser.parse_args()
+    num_lines = args.num_lines
+
+    if args.memory:
+        bench_memory(num_lines)
+        raise SystemExit(0)
+
+    source = generate_source(num_lines)
+
+    # Operands of every instruction line, split the same way the assembler does
+    operands = [op.strip() for line in source
+                if line.startswith("    ")
+                for args in line.split(';')[0].split(None, 1)[1:]
+                for op in re.findall(r'@?\([^)]*\)|[^,]+', args)]
+
+    print(f"Synthetic source: {num_lines:,} lines")
+    bench("parse_operand", lambda: [parse_operand(op) for op in operands], num_lines)
+    bench("parse_operand (uncached)",
+          lambda: [parse_operand.__wrapped__(op) for op in operands], num_lines)
+    bench("assemble", lambda: assemble(source), num_lines)
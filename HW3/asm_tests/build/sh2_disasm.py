@@ -0,0 +1,353 @@
+"""
+SH-2 Disassembler
+
+Turns SH-2 machine code back into assembly source: the memory files written by
+the assembler (build_mem0.txt to build_mem3.txt, or the .bin images), the
+memory dumps of the simulation (dump0.txt to dump3.txt), or single instruction
+words such as the IR value of a VCD trace.
+
+The decoder is generated from the encodings in sh2_asm.INSTRUCTION_SET, so it
+never disagrees with the assembler: the encoding function of each instruction
+is probed to find the bits each of its operands is encoded in, and at import
+every one of the 65,536 instruction words is entered in DECODE_TABLE with the
+Decoder of the instruction it encodes. Decoding a word is then a single list
+lookup, and the text of instructions that do not depend on their address is
+cached, so large dumps and traces are symbolized at millions of words a second.
+
+Usage:
+    python sh2_disasm.py <mem_file> [--addr ADDR] [--symbols build.json]
+    python sh2_disasm.py --word 0xE105 [0x6212 ...] [--addr ADDR]
+
+    Memory files are text (one 16-bit binary string per line, as written by
+    the assembler and memory.vhd; lines of X are undefined) or raw big-endian
+    .bin images. The address of the first word is taken from the block number
+    in the file name (build_mem2.txt or dump2.txt is at 0x800) unless --addr
+    is given. With --symbols, the symbol map of a --format bin build labels
+    the listing and names branch targets.
+
+    Each line of the listing is the address, the word, and the instruction
+    (.word for words that are not instructions). Branch targets are absolute
+    addresses (or labels), and PC relative loads are commented with the
+    address they read, so the instruction text can be assembled again
+    (test_sh2_disasm.py checks that it gives back the same words).
+"""
+
+import argparse
+import json
+import os
+import re
+import struct
+import sys
+from collections import namedtuple
+
+from sh2_asm import (BRANCHES_DISP8, INSTRUCTION_SET, MEM_BLOCKS, PC_MASKED_LOADS,
+                     PC_OFFSET, SIGNED_IMMEDIATES)
+
+# Value each operand type is probed with to find its bits (other operand types
+# are not encoded, e.g. the SR in STC SR, Rn)
+PROBE_VALUES = {
+    "reg": 15, "mem": 15, "inc": 15, "dec": 15, "r0_indexed": 15,
+    "imm": 0xFF, "indexed_gbr": 0xFF, "indexed_pc": 0xFF,
+}
+
+# Operand text of each operand type from the value of its field(s) (the
+# displacement and register of @(disp, Rn))
+OPERAND_TEXT = {
+    "reg":              lambda n: f"R{n}",
+    "mem":              lambda n: f"@R{n}",
+    "inc":              lambda n: f"@R{n}+",
+    "dec":              lambda n: f"@-R{n}",
+    "r0_indexed":       lambda n: f"@(R0, R{n})",
+    "indexed":          lambda d, n: f"@({d}, R{n})",
+    "indexed_gbr":      lambda d: f"@({d}, GBR)",
+    "indexed_pc":       lambda d: f"@({d}, PC)",
+    "indexed_r0_gbr":   lambda: "@(R0, GBR)",
+    "sr":               lambda: "SR",
+    "gbr":              lambda: "GBR",
+    "vbr":              lambda: "VBR",
+    "pr":               lambda: "PR",
+    "pc":               lambda: "PC",
+}
+
+# Bytes read by each PC relative load (MOVA computes a long address)
+PC_LOAD_SIZES = {"MOV.W": 2, "MOV.L": 4, "MOVA": 4}
+
+# Block number of a memory file (e.g., the 2 in build_mem2.txt or dump2.txt)
+BLOCK_RE = re.compile(r"(\d)\.\w+$")
+
+# Instruction decoder: mnemonic, (operand type, field masks) of each operand,
+# and whether the text depends on the address of the instruction
+Decoder = namedtuple("Decoder", "mnemonic operands pc_relative")
+
+# Decoded PC relative instruction: text with {} for the target, and the target
+# as (address & mask) + offset, and whether it is a branch (or a load)
+PcRelative = namedtuple("PcRelative", "template mask offset branch")
+
+
+def field_value(word, mask):
+    """
+    Extracts the field under mask from an instruction word.
+    """
+    return (word & mask) // (mask & -mask) if mask else 0
+
+
+def operand_masks(func, types, mnemonic):
+    """
+    Probes the encoding function of an instruction for the bits each of its
+    operands is encoded in.
+
+    Args:
+        func (callable): encoding function from INSTRUCTION_SET
+        types (tuple): operand types of the instruction
+        mnemonic (str): instruction mnemonic
+
+    Returns:
+        tuple: (word with all operands zero, masks of each operand's fields:
+                (disp, reg) for @(disp, Rn), a single mask for other encoded
+                operands, and none for those that are implied)
+    """
+    zeros = [(0, 0) if op_type == "indexed" else 0 for op_type in types]
+    base = func(*zeros)
+    masks = []
+    for i, op_type in enumerate(types):
+        values = list(zeros)
+        if op_type == "indexed":
+            values[i] = (0xFF, 0)
+            disp = func(*values) ^ base
+            values[i] = (0, 15)
+            masks.append((disp, func(*values) ^ base))
+        elif op_type == "label":
+            masks.append((0x00FF if mnemonic in BRANCHES_DISP8 else 0x0FFF,))
+        elif op_type in PROBE_VALUES:
+            values[i] = PROBE_VALUES[op_type]
+            masks.append((func(*values) ^ base,))
+        else:
+            masks.append(())
+    return base, tuple(masks)
+
+
+def build_decode_table():
+    """
+    Builds the decode table: the Decoder of every 16-bit word (None for words
+    that are not instructions), generated from INSTRUCTION_SET.
+
+    Returns:
+        list: 65,536 Decoders indexed by instruction word
+    """
+    table = [None] * 0x10000
+    for (mnemonic, types), func in INSTRUCTION_SET.items():
+        base, masks = operand_masks(func, types, mnemonic)
+        decoder = Decoder(mnemonic, tuple(zip(types, masks)),
+                          any(op_type in ("label", "indexed_pc") for op_type in types))
+
+        # Every word with the fixed bits of the instruction (the operand bits
+        # are enumerated as the subsets of the free bits)
+        free = 0
+        for fields in masks:
+            for mask in fields:
+                free |= mask
+        sub = free
+        while True:
+            if table[base | sub] is None:
+                table[base | sub] = decoder
+            if sub == 0:
+                break
+            sub = (sub - 1) & free
+    return table
+
+
+DECODE_TABLE = build_decode_table()
+
+# Text of instructions decoded so far that do not depend on their address,
+# and the PcRelative of those that do
+TEXT_CACHE = [None] * 0x10000
+PC_CACHE = [None] * 0x10000
+
+
+def signed(value, mask):
+    """
+    Sign extends the value of a field.
+    """
+    top = (mask // (mask & -mask) + 1) >> 1
+    return value - 2 * top if value & top else value
+
+
+def operand_text(decoder, op_type, fields, word, addr, symbols):
+    """
+    Formats an operand of a decoded instruction.
+
+    Args:
+        decoder (Decoder): the instruction
+        op_type (str): operand type
+        fields (tuple): masks of the operand's fields
+        word (int): instruction word
+        addr (int): address of the instruction
+        symbols (dict or None): address -> label
+
+    Returns:
+        str: the operand as it is written in the source
+    """
+    values = [field_value(word, mask) for mask in fields]
+    if op_type == "label":
+        target = (addr + PC_OFFSET + 2 * signed(values[0], fields[0])) & 0xFFFFFFFF
+        return symbols.get(target, f"0x{target:08X}") if symbols else f"0x{target:08X}"
+    if op_type == "imm":
+        return f"#{signed(values[0], fields[0]) if decoder.mnemonic in SIGNED_IMMEDIATES else values[0]}"
+    if op_type == "reg" and not fields[0]:
+        return "R0"     # implied (e.g., MOV.B R0, @(disp, Rn))
+    return OPERAND_TEXT[op_type](*values)
+
+
+def pc_relative(decoder, word):
+    """
+    Decodes a PC relative instruction into its PcRelative.
+    """
+    if decoder.mnemonic in PC_LOAD_SIZES:
+        size = PC_LOAD_SIZES[decoder.mnemonic]
+        text = f"{decoder.mnemonic:<8}" + ", ".join(
+            operand_text(decoder, op_type, fields, word, 0, None)
+            for op_type, fields in decoder.operands)
+        return PcRelative(f"{text:<24}; {{}}", ~3 if decoder.mnemonic in PC_MASKED_LOADS else ~0,
+                          size * (word & 0x00FF) + PC_OFFSET, False)
+    _, fields = decoder.operands[0]
+    return PcRelative(f"{decoder.mnemonic:<8}{{}}", ~0,
+                      2 * signed(field_value(word, fields[0]), fields[0]) + PC_OFFSET, True)
+
+
+def disassemble_word(word, addr=0, symbols=None):
+    """
+    Disassembles one instruction word.
+
+    Args:
+        word (int): 16-bit instruction word
+        addr (int): address of the instruction (for PC relative operands)
+        symbols (dict or None): address -> label, to name branch targets
+
+    Returns:
+        str: the instruction (or a .word directive) as assembly source
+    """
+    text = TEXT_CACHE[word]
+    if text is not None:
+        return text
+
+    # Branch targets are absolute addresses (or labels), and PC relative loads
+    # are commented with the address they read
+    decoded = PC_CACHE[word]
+    if decoded is not None:
+        target = ((addr & decoded.mask) + decoded.offset) & 0xFFFFFFFF
+        name = symbols.get(target) if symbols else None
+        if decoded.branch:
+            return decoded.template.format(name or f"0x{target:08X}")
+        return decoded.template.format(f"0x{target:08X} {name}" if name else f"0x{target:08X}")
+
+    decoder = DECODE_TABLE[word]
+    if decoder is None:
+        text = f".word   0x{word:04X}"
+    elif decoder.pc_relative:
+        PC_CACHE[word] = pc_relative(decoder, word)
+        return disassemble_word(word, addr, symbols)
+    else:
+        operands = ", ".join(operand_text(decoder, op_type, fields, word, addr, symbols)
+                             for op_type, fields in decoder.operands)
+        text = f"{decoder.mnemonic:<8}{operands}".rstrip()
+    TEXT_CACHE[word] = text
+    return text
+
+
+def disassemble(words, addr=0, symbols=None):
+    """
+    Disassembles a run of instruction words.
+
+    Args:
+        words (iterable): 16-bit words (None for undefined words)
+        addr (int): address of the first word
+        symbols (dict or None): address -> label
+
+    Yields:
+        tuple: (address, word, instruction text) of each word
+    """
+    for word in words:
+        if word is None:
+            yield addr, None, "; undefined"
+        else:
+            yield addr, word, disassemble_word(word, addr, symbols)
+        addr += 2
+
+
+def read_words(path):
+    """
+    Reads the words of a memory file: a text file of 16-bit binary strings
+    (comments after ';' are ignored and undefined words are None) or a raw
+    big-endian .bin image.
+
+    Args:
+        path (str): path to the memory file
+
+    Returns:
+        list: the words of the file
+    """
+    if path.endswith(".bin"):
+        with open(path, 'rb') as in_file:
+            data = in_file.read()
+        return [word for word, in struct.iter_unpack('>H', data[:len(data) & ~1])]
+
+    words = []
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            bits = line.split(';')[0].strip()
+            if bits:
+                words.append(int(bits, 2) if set(bits) <= {'0', '1'} else None)
+    return words
+
+
+def block_addr(path):
+    """
+    Finds the address of a memory file from the block number in its name.
+    """
+    match = BLOCK_RE.search(os.path.basename(path))
+    if match and int(match[1]) < len(MEM_BLOCKS):
+        return MEM_BLOCKS[int(match[1])][0]
+    return 0
+
+
+def read_symbols(path):
+    """
+    Reads the symbol map of a --format bin build (build.json).
+
+    Returns:
+        dict: address -> label
+    """
+    with open(path, 'r') as in_file:
+        return {addr: name for name, addr in json.load(in_file)["symbols"].items()}
+
+
+def main(argv):
+    """
+    Command line entry point. Prints the disassembly of memory files or
+    instruction words.
+    """
+    parser = argparse.ArgumentParser(prog="sh2_disasm.py", description="SH-2 Disassembler")
+    parser.add_argument("files", nargs='*', metavar="file",
+                        help="memory files to disassemble")
+    parser.add_argument("--word", nargs='+', type=lambda val: int(val, 0), default=[],
+                        help="instruction words to disassemble")
+    parser.add_argument("--addr", type=lambda val: int(val, 0),
+                        help="address of the first word (by default from the file name)")
+    parser.add_argument("--symbols", help="symbol map (build.json) to label the listing")
+    args = parser.parse_args(argv[1:])
+
+    symbols = read_symbols(args.symbols) if args.symbols else None
+    runs = [(args.word, args.addr or 0)] if args.word else []
+    runs += [(read_words(path), block_addr(path) if args.addr is None else args.addr)
+             for path in args.files]
+    for words, addr in runs:
+        for addr, word, text in disassemble(words, addr, symbols):
+            if symbols and addr in symbols:
+                print(f"{symbols[addr]}:")
+            print(f"  0x{addr:08X} {'XXXX' if word is None else f'{word:04X}'}  {text}")
+    return 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,722 @@
+"""
+SH-2 Instruction Stream Fuzzer
+
+Generates random SH-2 programs from the instructions of sh2_asm.INSTRUCTION_SET
+and checks the tools that must agree on them: the simulators of sh2_sim.py and
+sh2_batch.py must end every program in the same state, and the assembler's
+optimization passes must not change what a program computes. The hand-written
+tests cover a few hundred instructions; the fuzzer covers every encoding with
+random operands, hazards, branches, and memory accesses.
+
+Every program is valid for the assembler and terminates:
+- Branches only go forward, at most two blocks ahead, and delay slots hold
+  instructions legal in a slot. Some go through a trampoline in a section of
+  their own at FAR_ADDR (a BRA back to the target), out of range of BF/BT, so
+  the programs also have branches the assembler relaxes.
+- Loops are counted down in R13 with DT, and only call subroutines.
+- Subroutines are leaves that end with RTS and do not write PR.
+- Memory accesses are set up to fall in a window of data memory (the
+  footprint) at 0x400, whose initial values are random, and GBR always holds
+  its address (R14).
+The program ends by storing R0 to R12 below SIGNATURE_END and executing SLEEP,
+so a program also makes a test for the GHDL simulation with mem_compare.py.
+
+Usage:
+    python sh2_fuzz.py [--programs N] [--seed S] [--jobs N] [--check batch|optimize]
+    python sh2_fuzz.py [--length N] [--hazards P] [--branches P] [--loops P]
+                       [--memory P] [--footprint BYTES] [--exclude MNEMONIC ...]
+    python sh2_fuzz.py --replay SEED [-o FILE]
+
+    Program i of a run is generated from seed S + i (S defaults to 1), so any
+    program is generated again with --replay. The programs are checked in
+    chunks across a pool of processes (--jobs, 0 for one per CPU), and
+    failures are deduplicated by signature: the check and its message with
+    numbers removed. The first program of each signature is reported, and
+    written to --save DIR as fuzz_<seed>.asm (to be cut down with
+    sh2_reduce.py --check before simulating it).
+
+Profile:
+    --length      instructions in the body of a program (not counting the
+                  instructions setting up memory accesses), at most 60
+    --hazards     probability that a source register is the register written
+                  by the instruction before (load-use and ALU hazards)
+    --branches    probability of a branch or call at each instruction
+    --loops       probability that a block is a counted loop
+    --memory      probability that an instruction accesses memory
+    --footprint   bytes of data memory accessed
+    --far         probability that a branch goes through a far trampoline
+"""
+
+import argparse
+import functools
+import os
+import random
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from sh2_asm import (CHUNK1_ADDR, CHUNK2_ADDR, DELAYED_BRANCHES, FLUSHING_BRANCHES,
+                     INSTRUCTION_SET, OPTIMIZATIONS, PC_OFFSET, SIGNED_IMMEDIATES, SLOT_ILLEGAL,
+                     assemble, mem_blocks)
+from sh2_batch import BatchSimulator
+from sh2_sim import ACCESS_SIZES, SimulationError, Simulator
+
+# Random register operands, and the registers the programs reserve: the loop
+# counter, the base address of the data window, and the stack pointer
+REG_POOL = tuple(range(13))
+LOOP_REG = 13
+BASE_REG = 14
+
+# Data window accessed by the programs (at most MAX_FOOTPRINT bytes from
+# DATA_ADDR), and the registers stored below SIGNATURE_END at the end
+DATA_ADDR = CHUNK1_ADDR
+MAX_FOOTPRINT = 0x300
+SIGNATURE_END = DATA_ADDR + MAX_FOOTPRINT + 4 * len(REG_POOL)
+
+# Section of the far branch trampolines (a memory block of its own, so the
+# branches to it are out of range of BF/BT), and the memory blocks that hold
+# no code (the data window and the stack)
+FAR_ADDR = CHUNK2_ADDR
+DATA_BLOCKS = (1, 3)
+
+# Program shape (programs of up to MAX_LENGTH instructions fit in the code
+# memory below DATA_ADDR, whatever their profile)
+MAX_LENGTH = 60
+BLOCK_LENGTH = (3, 8)       # instructions per block
+MAX_TRIPS = 6               # iterations of a counted loop
+SUBROUTINES = 2
+SUBROUTINE_LENGTH = (1, 4)
+
+# Lines of code after which the literals loaded are placed in a pool (which a
+# BRA to the next block jumps over), keeping them in range of MOV.W
+POOL_LINES = 48
+
+# Instructions executed before a program that has not reached SLEEP fails
+MAX_STEPS = 100000
+
+# Programs checked by each task of the pool
+CHUNK = 64
+
+# Generation profile (see the module docstring)
+Profile = namedtuple("Profile", "length hazards branches loops memory footprint far")
+PROFILE = Profile(length=40, hazards=0.3, branches=0.1, loops=0.2, memory=0.3, footprint=256,
+                  far=0.25)
+
+# Program that failed a check: its seed, the signature failures are
+# deduplicated by, and the message of the check
+Failure = namedtuple("Failure", "seed signature message")
+
+# Instructions not generated in the body of a program: SLEEP ends programs,
+# RTS ends subroutines, and TRAPA and RTE need exception handlers
+RESERVED = ("SLEEP", "RTS", "RTE", "TRAPA")
+
+# Operand types addressing memory (PC relative loads are generated as literals)
+MEMORY_OPERANDS = ("mem", "inc", "dec", "indexed", "indexed_gbr", "r0_indexed",
+                   "indexed_r0_gbr", "indexed_pc")
+
+# Instructions writing PR (not generated in subroutines, whose RTS needs it)
+PR_WRITERS = ("BSR", "BSRF", "JSR", "LDS", "LDS.L")
+
+# Calls, which return, so they may also be generated in loops
+CALLS = ("BSR", "BSRF", "JSR")
+
+# Operand values probing which register operands an instruction encodes
+PROBE_VALUES = {"reg": 1, "imm": 1, "label": "", "mem": 1, "inc": 1, "dec": 1,
+                "indexed": (1, 1), "indexed_gbr": 1, "indexed_pc": 1, "r0_indexed": 1}
+
+
+def implied_r0(key):
+    """
+    Finds the register operands of an instruction that its encoding leaves out
+    (R0 is implied, as in AND #imm, R0 or MOV.B @(disp, Rm), R0).
+
+    Returns:
+        frozenset: indices of the operands that must be R0
+    """
+    encode = INSTRUCTION_SET[key]
+    values = [PROBE_VALUES.get(op_type) for op_type in key[1]]
+    implied = set()
+    for num, op_type in enumerate(key[1]):
+        if op_type == "reg":
+            changed = list(values)
+            changed[num] = 2
+            if encode(*values) == encode(*changed):
+                implied.add(num)
+    return frozenset(implied)
+
+
+IMPLIED_R0 = {key: implied_r0(key) for key in INSTRUCTION_SET}
+
+# Instructions by how they are generated
+BRANCH_KEYS = [key for key in INSTRUCTION_SET
+               if key[0] in DELAYED_BRANCHES + tuple(FLUSHING_BRANCHES) and key[0] not in RESERVED]
+BODY_KEYS = [key for key in INSTRUCTION_SET
+             if key not in BRANCH_KEYS and key[0] not in RESERVED]
+MEMORY_KEYS = [key for key in BODY_KEYS if set(key[1]) & set(MEMORY_OPERANDS)]
+PLAIN_KEYS = [key for key in BODY_KEYS if key not in MEMORY_KEYS]
+SLOT_KEYS = [key for key in BODY_KEYS if key[0] not in SLOT_ILLEGAL and "indexed_pc" not in key[1]]
+
+
+@functools.lru_cache(maxsize=None)
+def instruction_keys(exclude):
+    """
+    Lists the instructions programs are generated from, without the excluded
+    mnemonics (subroutines and the slots of calls must not write PR either).
+
+    Args:
+        exclude (frozenset): mnemonics not to generate
+
+    Returns:
+        tuple: (branches, calls, {(memory access, leaf): body instructions},
+                {leaf: slot instructions})
+    """
+    def keep(keys, leaf):
+        return [key for key in keys if key[0] not in exclude and not (leaf and key[0] in PR_WRITERS)]
+    branches = keep(BRANCH_KEYS, False)
+    calls = [key for key in branches if key[0] in CALLS]
+    body = {(memory, leaf): keep(MEMORY_KEYS if memory else PLAIN_KEYS, leaf) or keep(PLAIN_KEYS, leaf)
+            for memory in (False, True) for leaf in (False, True)}
+    slots = {leaf: keep(SLOT_KEYS, leaf) for leaf in (False, True)}
+    return branches, calls, body, slots
+
+
+class ProgramGenerator:
+    """
+    Generates the random program of a seed.
+    """
+
+    def __init__(self, seed, profile=PROFILE, exclude=()):
+        """
+        Args:
+            seed (int): seed of the program
+            profile (Profile): shape of the program
+            exclude (iterable): mnemonics not to generate
+        """
+        self.rng = random.Random(seed)
+        self.profile = profile
+        self.branch_keys, self.call_keys, self.body_keys, self.slot_keys = instruction_keys(
+            frozenset(exclude))
+        self.lines = []
+        self.last_written = None
+        self.branches = 0
+        self.pool_line = 0
+        self.trampolines = []       # targets of the far trampolines
+
+    def emit(self, text):
+        """
+        Adds an instruction (or directive) to the program.
+        """
+        self.lines.append(f"    {text}")
+
+    def register(self, source, avoid=()):
+        """
+        Picks a register operand: a source is the register written by the
+        instruction before with the hazard probability of the profile.
+        """
+        if (source and self.last_written is not None and self.last_written not in avoid and
+                self.rng.random() < self.profile.hazards):
+            return self.last_written
+        return self.free_register(avoid)
+
+    def free_register(self, avoid, first=REG_POOL[0]):
+        """
+        Picks a random register of REG_POOL (from first on) not in avoid.
+        """
+        while True:
+            reg = self.rng.randint(first, REG_POOL[-1])
+            if reg not in avoid:
+                return reg
+
+    def offset(self, size, limit=MAX_FOOTPRINT):
+        """
+        Picks an aligned offset of an access in the data window.
+        """
+        return size * self.rng.randrange(max(1, min(self.profile.footprint, limit) // size))
+
+    @staticmethod
+    def pointer(setup, reg, offset):
+        """
+        Adds the instructions setting a register to an address of the data
+        window to the setup of an instruction.
+        """
+        setup.append(f"MOV     R{BASE_REG}, R{reg}")
+        while offset > 0:
+            step = min(offset, 0x7F)
+            setup.append(f"ADD     #{step}, R{reg}")
+            offset -= step
+
+    def immediate(self, op):
+        """
+        Picks an immediate operand (signed for MOV, ADD, and CMP/EQ).
+        """
+        return self.rng.randint(-0x80, 0x7F) if op in SIGNED_IMMEDIATES else self.rng.randrange(0x100)
+
+    def memory_operand(self, op, op_type, size, setup, avoid):
+        """
+        Builds a memory operand and the setup placing it in the data window.
+
+        Returns:
+            tuple: (operand text, address register or None)
+        """
+        rng = self.rng
+        if op_type == "indexed_pc":
+            if op == "MOVA":
+                return f"@({rng.randrange(4)}, PC)", None
+            if size == 2:
+                return f"#{rng.choice((-1, 1)) * rng.randrange(0x80, 0x8000)}", None
+            return f"#0x{rng.randrange(0x10000, 0x100000000):08X}", None
+        if op_type == "indexed_gbr":
+            return f"@({self.offset(size, 0x100 * size) // size}, GBR)", None
+        if op_type == "indexed_r0_gbr":
+            setup.append(f"MOV     #{self.offset(size, 0x80)}, R0")
+            return "@(R0, GBR)", None
+
+        reg = self.free_register(avoid, 1)
+        offset = self.offset(size)
+        if op_type == "mem":
+            self.pointer(setup, reg, offset)
+            return f"@R{reg}", reg
+        if op_type == "inc":
+            self.pointer(setup, reg, offset)
+            return f"@R{reg}+", reg
+        if op_type == "dec":
+            self.pointer(setup, reg, offset + size)
+            return f"@-R{reg}", reg
+        if op_type == "indexed":
+            disp = rng.randint(0, min(15, offset // size))
+            self.pointer(setup, reg, offset - disp * size)
+            return f"@({disp}, R{reg})", reg
+        index = size * rng.randint(0, min(offset, 0x7F) // size)       # r0_indexed
+        setup.append(f"MOV     #{index}, R0")
+        self.pointer(setup, reg, offset - index)
+        return f"@(R0, R{reg})", reg
+
+    def build(self, key):
+        """
+        Builds an instruction that is not a branch with random operands.
+
+        Returns:
+            tuple: (list of setup instructions, instruction, registers used)
+        """
+        op, types = key
+        size = ACCESS_SIZES.get(op[-2:], 4)
+        setup = []
+
+        # Register operands, then memory operands (whose address registers
+        # are set up, so they are kept apart from the register operands)
+        regs = {}
+        for num, op_type in enumerate(types):
+            if op_type == "reg":
+                if num in IMPLIED_R0[key]:
+                    regs[num] = 0
+                else:
+                    regs[num] = self.register(num < len(types) - 1, regs.values())
+        if op == "LDC" and "gbr" in types:
+            setup.append(f"MOV     R{BASE_REG}, R{regs[0]}")     # GBR stays the window
+
+        operands = []
+        used = set(regs.values())
+        if "r0_indexed" in types or "indexed_r0_gbr" in types:
+            used.add(0)
+        for num, op_type in enumerate(types):
+            if op_type == "reg":
+                operands.append(f"R{regs[num]}")
+            elif op_type == "imm":
+                operands.append(f"#{self.immediate(op)}")
+            elif op_type in MEMORY_OPERANDS:
+                text, reg = self.memory_operand(op, op_type, size, setup, used)
+                operands.append(text)
+                if reg is not None:
+                    used.add(reg)
+                    if op == "LDC.L" and "gbr" in types:
+                        setup.append(f"MOV.L   R{BASE_REG}, @R{reg}")
+            else:
+                operands.append(op_type.upper())
+
+        # The destination written, for hazards
+        if types and types[-1] == "reg":
+            self.last_written = regs[len(types) - 1]
+        elif types and types[-1] == "inc":
+            self.last_written = None
+        text = f"{op:<8}{', '.join(operands)}" if operands else op
+        return setup, text, used
+
+    def instruction(self, keys):
+        """
+        Adds a random instruction (and its setup) from keys.
+        """
+        setup, text, _ = self.build(self.rng.choice(keys))
+        for line in setup:
+            self.emit(line)
+        self.emit(text)
+
+    def body_instruction(self, leaf=False):
+        """
+        Adds a random memory access or other instruction (not writing PR in
+        a leaf subroutine).
+        """
+        self.instruction(self.body_keys[self.rng.random() < self.profile.memory, leaf])
+
+    def branch(self, block, blocks, calls_only):
+        """
+        Adds a forward branch (or a call of a subroutine) and its delay slot.
+
+        Args:
+            block (int): number of the block the branch is in
+            blocks (int): number of blocks (label L<blocks> ends the body)
+            calls_only (bool): only generate calls (in loops)
+        """
+        rng = self.rng
+        keys = self.call_keys if calls_only else self.branch_keys
+        if not keys:
+            self.body_instruction()
+            return
+        op, types = rng.choice(keys)
+        if op in CALLS:
+            target = f"S{rng.randrange(SUBROUTINES)}"
+        else:
+            target = f"L{rng.randint(block + 1, min(block + 2, blocks))}"
+            if types == ("label",) and rng.random() < self.profile.far:
+                self.trampolines.append(target)
+                target = f"F{len(self.trampolines) - 1}"
+
+        # The slot's setup goes before the branch, and the branch register
+        # is kept apart from the slot's registers (a call's slot must not
+        # write the PR it has just set)
+        slot = self.build(rng.choice(self.slot_keys[op in CALLS])) if op in DELAYED_BRANCHES else None
+        for line in slot[0] if slot else ():
+            self.emit(line)
+        if types == ("label",):
+            self.emit(f"{op:<8}{target}")
+        else:
+            reg = self.free_register(slot[2] if slot else ())
+            here = f"B{self.branches}"
+            self.branches += 1
+            if op in ("JMP", "JSR"):
+                self.emit(f"MOV.L   ={target}, R{reg}")
+                operand = f"@R{reg}"
+            else:
+                self.emit(f"MOV.L   #({target} - {here} - {PC_OFFSET}), R{reg}")
+                operand = f"R{reg}"
+            self.lines.append(f"{here}:")
+            self.emit(f"{op:<8}{operand}")
+        if slot:
+            self.emit(slot[1])
+
+    def generate(self):
+        """
+        Generates the program.
+
+        Returns:
+            str: assembly source
+        """
+        rng, profile = self.rng, self.profile
+        self.emit(".text")
+        self.emit(f"MOV.L   #{DATA_ADDR}, R{BASE_REG}")
+        self.emit(f"LDC     R{BASE_REG}, GBR")
+        for reg in REG_POOL:
+            value = rng.choice((rng.randint(-0x80, 0x7F), rng.getrandbits(32)))
+            self.emit(f"MOV.L   #{value}, R{reg}")
+
+        # Blocks of the body, each a label and (if a loop) its counter
+        blocks = []
+        remaining = profile.length
+        while remaining > 0:
+            blocks.append(min(remaining, rng.randint(*BLOCK_LENGTH)))
+            remaining -= blocks[-1]
+        for block, length in enumerate(blocks):
+            if len(self.lines) - self.pool_line >= POOL_LINES or block == 0:
+                self.emit(f"BRA     L{block}")
+                self.emit("NOP")
+                self.pool_line = len(self.lines)
+            self.lines.append(f"L{block}:")
+            loop = rng.random() < profile.loops
+            if loop:
+                self.emit(f"MOV     #{rng.randint(1, MAX_TRIPS)}, R{LOOP_REG}")
+                self.lines.append(f"L{block}_loop:")
+            for _ in range(length):
+                if rng.random() < profile.branches:
+                    self.branch(block, len(blocks), loop)
+                else:
+                    self.body_instruction()
+            if loop:
+                self.emit(f"DT      R{LOOP_REG}")
+                self.emit(f"BF      L{block}_loop")
+
+        # Registers stored for mem_compare.py, then the subroutines
+        self.lines.append(f"L{len(blocks)}:")
+        self.emit(f"MOV.L   #{SIGNATURE_END}, R{LOOP_REG}")
+        for reg in reversed(REG_POOL):
+            self.emit(f"MOV.L   R{reg}, @-R{LOOP_REG}")
+        self.emit("SLEEP")
+        for sub in range(SUBROUTINES):
+            self.lines.append(f"S{sub}:")
+            for _ in range(rng.randint(*SUBROUTINE_LENGTH)):
+                self.body_instruction(leaf=True)
+            self.emit("RTS")
+            self.instruction(self.slot_keys[True])
+
+        # Far trampolines, back to the targets of the branches to them
+        if self.trampolines:
+            self.emit(f".section far, 0x{FAR_ADDR:X}")
+            for num, target in enumerate(self.trampolines):
+                self.lines.append(f"F{num}:")
+                self.emit(f"BRA     {target}")
+                self.emit("NOP")
+
+        # Initial values of the data window
+        self.emit(".data")
+        for _ in range(0, profile.footprint, 32):
+            self.emit(".long   " + ", ".join(f"0x{rng.getrandbits(32):08X}" for _ in range(8)))
+        return "\n".join(self.lines) + "\n"
+
+
+def generate_program(seed, profile=PROFILE, exclude=()):
+    """
+    Generates the random program of a seed.
+
+    Args:
+        seed (int): seed of the program
+        profile (Profile): shape of the program
+        exclude (iterable): mnemonics not to generate
+
+    Returns:
+        str: assembly source
+    """
+    return ProgramGenerator(seed, profile, exclude).generate()
+
+
+def signature(check, message):
+    """
+    Signature of a failure: the check and its message without numbers (so
+    programs failing the same way are counted once).
+    """
+    return f"{check}: " + re.sub(r'0x[0-9A-Fa-f]+|\d+', 'N', message)
+
+
+def run_program(image, max_steps=MAX_STEPS):
+    """
+    Runs an assembled program on sh2_sim.py.
+
+    Returns:
+        tuple: (Simulator, error message or None)
+    """
+    sim = Simulator(mem_blocks(image))
+    try:
+        sim.run(max_steps)
+    except SimulationError as err:
+        return sim, str(err)
+    return sim, None
+
+
+def state_differences(sim, other, fields, blocks=DATA_BLOCKS):
+    """
+    Names the registers (and memory, of the blocks numbered in blocks) that
+    differ between two simulators.
+    """
+    names = [name for name in fields if getattr(sim, name) != getattr(other, name)]
+    names += [f"R{num}" for num in range(16) if sim.r[num] != other.r[num]]
+    if any(sim.blocks[num] != other.blocks[num] for num in blocks):
+        names.append("memory")
+    return names
+
+
+def check_batch(programs):
+    """
+    Checks that sh2_batch.py ends every program in the state sh2_sim.py does.
+
+    Args:
+        programs (list): (seed, source) of each program
+
+    Returns:
+        list[Failure]: programs that failed
+    """
+    failures = []
+    seeds, images, references = [], [], []
+    for seed, source in programs:
+        try:
+            image = assemble(source, keep_source=False)
+        except ValueError as err:
+            failures.append(Failure(seed, signature("assemble", str(err)), str(err)))
+            continue
+        sim, error = run_program(image)
+        if error:
+            failures.append(Failure(seed, signature("sh2_sim", error), error))
+            continue
+        seeds.append(seed)
+        images.append(image)
+        references.append(sim)
+
+    batch = BatchSimulator([Simulator(mem_blocks(image)) for image in images])
+    batch.run(MAX_STEPS)
+    for lane, (seed, sim) in enumerate(zip(seeds, references)):
+        if lane in batch.errors:
+            failures.append(Failure(seed, signature("sh2_batch", batch.errors[lane]), batch.errors[lane]))
+            continue
+        differences = state_differences(sim, batch.simulator(lane),
+                                        ("sr", "gbr", "vbr", "pr", "mach", "macl", "pc", "steps"),
+                                        range(len(sim.blocks)))
+        if differences:
+            message = "sh2_batch.py differs from sh2_sim.py in " + ", ".join(differences)
+            failures.append(Failure(seed, f"batch: {', '.join(differences)}", message))
+    return failures
+
+
+def check_optimize(programs):
+    """
+    Checks that the assembler's optimization passes do not change the
+    registers or data memory a program leaves (the code moves, so PR, the PC,
+    and the blocks holding code are not compared).
+
+    Args:
+        programs (list): (seed, source) of each program
+
+    Returns:
+        list[Failure]: programs that failed
+    """
+    failures = []
+    passes = tuple(OPTIMIZATIONS)
+    for seed, source in programs:
+        try:
+            plain = run_program(assemble(source, keep_source=False))
+            optimized = run_program(assemble(source, keep_source=False, optimize=passes))
+        except ValueError as err:
+            failures.append(Failure(seed, signature("assemble", str(err)), str(err)))
+            continue
+        (sim, error), (other, other_error) = plain, optimized
+        if error or other_error:
+            message = error or f"optimized: {other_error}"
+            failures.append(Failure(seed, signature("sh2_sim", message), message))
+            continue
+        differences = state_differences(sim, other, ("sr", "gbr", "vbr", "mach", "macl"))
+        if differences:
+            message = "optimized program differs in " + ", ".join(differences)
+            failures.append(Failure(seed, f"optimize: {', '.join(differences)}", message))
+    return failures
+
+
+# Checks run on the programs, and the instructions each cannot generate (the
+# optimized programs are laid out differently, so code addresses must not
+# reach the registers or memory compared)
+CHECKS = {
+    "batch": check_batch,
+    "optimize": check_optimize,
+}
+CHECK_EXCLUDES = {
+    "batch": (),
+    "optimize": ("MOVA", "STS", "STS.L", "BRAF", "BSRF", "JMP", "JSR"),
+}
+
+
+def check_chunk(check, profile, exclude, seeds):
+    """
+    Generates and checks the programs of a range of seeds (a task of the pool).
+
+    Returns:
+        list[Failure]: programs that failed
+    """
+    exclude = tuple(exclude) + CHECK_EXCLUDES[check]
+    return CHECKS[check]([(seed, generate_program(seed, profile, exclude)) for seed in seeds])
+
+
+def fuzz(check, programs, seed=1, profile=PROFILE, exclude=(), jobs=0, chunk=CHUNK):
+    """
+    Generates and checks programs across a pool of processes.
+
+    Args:
+        check (str): name of the check in CHECKS
+        programs (int): number of programs (seeds seed to seed + programs - 1)
+        seed (int): seed of the first program
+        profile (Profile): shape of the programs
+        exclude (iterable): mnemonics not to generate
+        jobs (int): number of worker processes (0 for one per CPU, 1 to check
+                    in this process)
+        chunk (int): programs per task
+
+    Returns:
+        dict: signature -> list of Failures, in seed order
+    """
+    chunks = [range(start, min(start + chunk, seed + programs))
+              for start in range(seed, seed + programs, chunk)]
+    if jobs == 1:
+        results = [check_chunk(check, profile, exclude, seeds) for seeds in chunks]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+            futures = [pool.submit(check_chunk, check, profile, tuple(exclude), seeds)
+                       for seeds in chunks]
+            results = [future.result() for future in futures]
+
+    failures = {}
+    for result in results:
+        for failure in result:
+            failures.setdefault(failure.signature, []).append(failure)
+    return failures
+
+
+def main(argv):
+    """
+    Command line entry point. Fuzzes the tools (or prints the program of a
+    seed).
+    """
+    parser = argparse.ArgumentParser(prog="sh2_fuzz.py", description="SH-2 Instruction Stream Fuzzer")
+    parser.add_argument("--check", choices=tuple(CHECKS), default="batch",
+                        help="what the programs check (default %(default)s)")
+    parser.add_argument("--programs", type=int, default=1000,
+                        help="programs to generate (default %(default)d)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the first program")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="worker processes (0 for one per CPU, the default)")
+    parser.add_argument("--save", metavar="DIR", help="write the first program of each failure to DIR")
+    parser.add_argument("--replay", type=int, metavar="SEED", help="print the program of a seed")
+    parser.add_argument("-o", "--output", help="file to write the --replay program to")
+    for name in Profile._fields:
+        default = getattr(PROFILE, name)
+        parser.add_argument(f"--{name}", type=type(default), default=default,
+                            help="(default %(default)s)")
+    parser.add_argument("--exclude", nargs='+', default=[], metavar="MNEMONIC",
+                        help="instructions not to generate")
+    args = parser.parse_args(argv[1:])
+
+    profile = Profile(*(getattr(args, name) for name in Profile._fields))
+    if not 0 < profile.length <= MAX_LENGTH:
+        print(f"Error: the length must be 1 to {MAX_LENGTH} instructions")
+        return 1
+    if not 0 < profile.footprint <= MAX_FOOTPRINT:
+        print(f"Error: the footprint must be 1 to {MAX_FOOTPRINT} bytes")
+        return 1
+    exclude = tuple(op.upper() for op in args.exclude)
+
+    if args.replay is not None:
+        source = generate_program(args.replay, profile, exclude + CHECK_EXCLUDES[args.check])
+        if args.output:
+            with open(args.output, 'w') as out_file:
+                out_file.write(source)
+        else:
+            print(source, end="")
+        return 0
+
+    start = time.perf_counter()
+    failures = fuzz(args.check, args.programs, args.seed, profile, exclude, args.jobs)
+    elapsed = time.perf_counter() - start
+    print(f"{args.programs} programs checked ({args.check}) in {elapsed:.2f} s "
+          f"({args.programs / elapsed:,.0f} programs/s)")
+
+    for sig, found in sorted(failures.items(), key=lambda item: item[1][0].seed):
+        first = found[0]
+        print(f"{len(found):>6}  {sig}\n        seed {first.seed}: {first.message}")
+        if args.save:
+            os.makedirs(args.save, exist_ok=True)
+            path = os.path.join(args.save, f"fuzz_{first.seed}.asm")
+            with open(path, 'w') as out_file:
+                out_file.write(f"; sh2_fuzz.py --check {args.check} --replay {first.seed}\n; {sig}\n")
+                out_file.write(generate_program(first.seed, profile, exclude + CHECK_EXCLUDES[args.check]))
+    if not failures:
+        print("No failures")
+    return 1 if failures else 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
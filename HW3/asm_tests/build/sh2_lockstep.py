@@ -0,0 +1,492 @@
+"""
+SH-2 Lockstep Checker
+
+Compares a GHDL simulation of the HW3 CPU with the instruction set simulator
+instruction by instruction, and stops at the first instruction where they
+diverge. mem_compare.py only shows the data memory a failing test leaves
+behind; this shows the instruction that went wrong, what the hardware wrote,
+what it should have written, and the registers at that point.
+
+The waveform does not hold the register array, so the architectural state
+changes are reconstructed from the signals of sh2_cpu.vhd sampled at each
+rising clock edge:
+- Instructions are retired in the order they enter ID (PC_ID and IR_ID),
+  except instructions flushed by a taken branch (FlushPL).
+- Register writes are those of the RegIn port (RegStore, RegInSel, and the
+  ALU result) and of the RegAxIn port (RegAxStore, RegAxInSel, and the input
+  RegAxInDataSel selects).
+- SR, GBR, VBR, and PR changes are read from the registers themselves (the
+  simulator stores the call's address plus 2 in PR as HW3 does, so PR is
+  compared as it is).
+- Memory writes are the bytes enabled by WE0 to WE3 at the address on AB.
+The simulator runs the same program, and the changes it makes to each
+register (and the bytes it writes) are matched in order against those of the
+waveform.
+
+Usage:
+    python sh2_lockstep.py <input_file.asm> [waveform.vcd] [--context N]
+    python sh2_lockstep.py <build_dir> <waveform.vcd>
+
+    The waveform defaults to the one tb_sh2_cpu.sh writes for the test
+    (tb_sh2_cpu-<test>.vcd in the run directory). Exits with status 1 at a
+    divergence, printing the instructions before it and the registers of
+    both sides, and 0 if the waveform matches the simulator until either
+    reaches SLEEP or the waveform ends.
+"""
+
+import argparse
+import os
+import sys
+from collections import deque, namedtuple
+
+from sh2_disasm import disassemble_word
+from sh2_sim import MASK32, MAX_STEPS, SimulationError, load_program
+
+# Waveform written by tb_sh2_cpu.sh for a test (relative to the run directory)
+VCD_FORMAT = "tb_sh2_cpu-{}.vcd"
+
+# Signals read from the waveform (below the testbench, without bit ranges)
+SIGNALS = {
+    "clock":        "uut.clock",
+    "pc":           "uut.pc_id",
+    "ir":           "uut.ir_id",
+    "flush":        "uut.flushpl",
+    "reg_store":    "uut.regstore_mux",
+    "reg_sel":      "uut.reginsel_ex",
+    "result":       "uut.alu_result",
+    "ax_store":     "uut.regaxstore_mux",
+    "ax_sel":       "uut.regaxinsel_ex",
+    "ax_data_sel":  "uut.regaxindatasel_ex",
+    "addr_id":      "uut.dau_addridout",
+    "data_addr":    "uut.dau_dataaddr",
+    "sr":           "uut.sr",
+    "gbr":          "uut.gbr",
+    "vbr":          "uut.vbr",
+    "pr":           "uut.pr",
+    "ab":           "uut.ab",
+    "db":           "uut.db",
+    "we0":          "uut.we0",
+    "we1":          "uut.we1",
+    "we2":          "uut.we2",
+    "we3":          "uut.we3",
+}
+
+# Inputs of the RegAxIn port by RegAxInDataSel (reg.vhd)
+AX_INPUTS = ("addr_id", "data_addr", "sr", "gbr", "vbr", "pr")
+
+# Registers compared (memory bytes are keyed by their address)
+REGISTERS = tuple(f"R{num}" for num in range(16)) + ("SR", "GBR", "VBR", "PR")
+CONTROL_REGISTERS = ("SR", "GBR", "VBR", "PR")
+
+SLEEP_WORD = 0x001B
+
+# Cycles after an instruction enters ID within which it has made all its
+# writes (loads write back in WB, behind a memory stall), and cycles apart the
+# writes of an instruction writing a register twice may be (MOV.L @R1+, R1
+# increments R1 in EX and loads it in WB)
+WRITE_LATENCY = 4
+WRITE_WINDOW = 3
+
+# Instructions shown before a divergence
+CONTEXT = 8
+
+# Instruction retired by the simulator: address, machine code, the registers
+# it changes and bytes it writes (register name or address -> value), and the
+# registers before it (in REGISTERS order)
+Retired = namedtuple("Retired", "addr word changes registers")
+
+# Instruction retired by the waveform: cycle it entered ID, address, machine
+# code (None if undefined)
+WaveInstruction = namedtuple("WaveInstruction", "cycle addr word")
+
+# Architectural state changes of a waveform: the instructions it retires,
+# register name or address -> deque of (cycle, value) changed or written, and
+# the last cycle sampled
+Waveform = namedtuple("Waveform", "instructions changes last_cycle")
+
+# First divergence: index of the instruction in the simulator's trace,
+# description, and the registers of the hardware at that point
+Divergence = namedtuple("Divergence", "index message registers")
+
+
+def read_vcd(path, names):
+    """
+    Reads signals from a VCD file, sampled just before each rising edge of the
+    clock (the values the edge stores).
+
+    Args:
+        path (str): VCD file written by GHDL
+        names (dict): key -> hierarchical signal name below the top scope,
+                      without its bit range (e.g., "uut.pc_id")
+
+    Returns:
+        list[dict]: key -> value (a string of std_logic characters) per edge
+
+    Raises:
+        ValueError: if a signal is not in the file
+    """
+    with open(path) as file:
+        # Header: identifier code of each signal
+        codes = {}
+        scope = []
+        for line in file:
+            tokens = line.split()
+            if not tokens:
+                continue
+            if tokens[0] == "$scope":
+                scope.append(tokens[2])
+            elif tokens[0] == "$upscope":
+                scope.pop()
+            elif tokens[0] == "$var":
+                name = ".".join(scope[1:] + [tokens[4].split("[")[0]])
+                codes.setdefault(name, tokens[3])
+            elif tokens[0] == "$enddefinitions":
+                break
+        missing = [name for name in names.values() if name not in codes]
+        if missing:
+            raise ValueError(f"{path}: no signal {', '.join(missing)}")
+        keys = {codes[name]: key for key, name in names.items()}
+        clock = codes[names["clock"]]
+
+        # Value changes, a timestamp at a time: the values before a timestamp
+        # where the clock rises are sampled
+        values = dict.fromkeys(names, "U")
+        samples = []
+        changes = []
+        for line in file:
+            line = line.strip()
+            if not line or line[0] == "$":
+                continue
+            if line[0] == "#":
+                apply_changes(values, changes, samples, keys, clock)
+                changes = []
+            elif line[0] in "bBrR":
+                value, code = line[1:].split()
+                changes.append((code, value))
+            else:
+                changes.append((line[1:], line[0]))
+        apply_changes(values, changes, samples, keys, clock)
+    return samples
+
+
+def apply_changes(values, changes, samples, keys, clock):
+    """
+    Applies the value changes of a timestamp, sampling the values before them
+    if the clock rises.
+    """
+    for code, value in changes:
+        if code == clock and value == "1" and values["clock"] == "0":
+            samples.append(dict(values))
+            break
+    for code, value in changes:
+        if code in keys:
+            values[keys[code]] = value
+
+
+def bits_value(bits):
+    """
+    Converts std_logic characters to an integer (None unless all are 0 or 1).
+    """
+    return int(bits, 2) if bits and bits.strip("01") == "" else None
+
+
+def extend(bits, width):
+    """
+    Extends a VCD vector value to its width (VCD drops leading zeros, and
+    leading X and Z extend as themselves).
+    """
+    return bits.rjust(width, bits[0] if bits[:1] in ("x", "X", "z", "Z") else "0")
+
+
+def read_waveform(path, start, initial):
+    """
+    Reconstructs the instructions and architectural state changes of a
+    simulation of the CPU from its waveform.
+
+    Args:
+        path (str): VCD file written by GHDL
+        start (int): address of the first instruction (the reset PC)
+        initial (dict): register name -> value at reset, the changes being
+                        the values that differ from the register's last value
+
+    Returns:
+        Waveform: the instructions and changes from the first instruction on
+    """
+    samples = read_vcd(path, SIGNALS)
+    first = next((cycle for cycle, sample in enumerate(samples)
+                  if bits_value(sample["pc"]) == start), len(samples))
+
+    instructions = []
+    changes = {}
+    current = dict(initial)
+    previous = samples[first] if first < len(samples) else {}
+    last_addr = None
+
+    def change(key, cycle, value):
+        if key in REGISTERS:
+            if current.get(key) == value:
+                return
+            current[key] = value
+        changes.setdefault(key, deque()).append((cycle, value))
+
+    for cycle in range(first, len(samples)):
+        sample = samples[cycle]
+
+        # Instruction entering ID (stalled instructions stay in ID, and the
+        # slot of a BF/S or BT/S not taken is fetched again)
+        addr, word = bits_value(sample["pc"]), bits_value(sample["ir"])
+        if addr != last_addr and sample["flush"] != "1" and addr is not None:
+            if not instructions or instructions[-1].word != SLEEP_WORD:
+                instructions.append(WaveInstruction(cycle, addr, word))
+        last_addr = addr
+
+        # Register array writes
+        if sample["reg_store"] == "1":
+            sel = bits_value(sample["reg_sel"])
+            if sel is not None:
+                change(f"R{sel}", cycle, bits_value(sample["result"]))
+        if sample["ax_store"] == "1":
+            sel, data_sel = bits_value(sample["ax_sel"]), bits_value(sample["ax_data_sel"])
+            if sel is not None and data_sel is not None and data_sel < len(AX_INPUTS):
+                change(f"R{sel}", cycle, bits_value(sample[AX_INPUTS[data_sel]]))
+
+        # Control registers
+        for name in CONTROL_REGISTERS:
+            key = name.lower()
+            if sample[key] != previous[key]:
+                change(name, cycle, bits_value(sample[key]))
+
+        # Memory writes (big-endian: WE3 enables the byte at the long address,
+        # and the bytes not written may be undefined)
+        addr, data = bits_value(sample["ab"]), extend(sample["db"], 32)
+        for lane in range(4):
+            if sample[f"we{lane}"] == "0" and addr is not None:
+                change((addr & ~3) + 3 - lane, cycle, bits_value(data[24 - 8 * lane:32 - 8 * lane]))
+        previous = sample
+
+    return Waveform(instructions, changes, len(samples) - 1)
+
+
+def registers_of(sim):
+    """
+    Gets the registers compared of the simulator (in REGISTERS order).
+    """
+    return tuple(sim.r) + (sim.sr, sim.gbr, sim.vbr, sim.pr)
+
+
+def run_reference(sim, max_steps=MAX_STEPS):
+    """
+    Runs a program on the simulator, recording the changes each instruction
+    makes.
+
+    Args:
+        sim (Simulator): the reset CPU with the program loaded
+        max_steps (int): instructions executed before giving up
+
+    Returns:
+        tuple: (list of Retired, error stopping the simulator or None)
+    """
+    retired = []
+    written = []
+
+    # Bytes written are recorded as they are written
+    write = sim.write
+
+    def record_write(addr, size, value):
+        write(addr, size, value)
+        for num in range(size):
+            written.append((((addr + num) & MASK32), (value >> 8 * (size - 1 - num)) & 0xFF))
+    sim.write = record_write
+
+    # The changes of an instruction are complete when the next one starts
+    def finish(registers):
+        if retired:
+            inst = retired[-1]
+            inst.changes.update((name, value) for name, value, old
+                                in zip(REGISTERS, registers, inst.registers) if value != old)
+            inst.changes.update(written)
+            written.clear()
+
+    def trace(addr, word):
+        registers = registers_of(sim)
+        finish(registers)
+        retired.append(Retired(addr, word, {}, registers))
+
+    error = None
+    try:
+        sim.run(max_steps, trace)
+    except SimulationError as err:
+        error = err
+    finish(registers_of(sim))
+    return retired, error
+
+
+def match_change(queue, value):
+    """
+    Takes the change of a register in the waveform matching a change of the
+    simulator, skipping earlier writes of the same instruction.
+
+    Returns:
+        tuple: (cycle, value) of the change taken
+    """
+    cycle, found = queue.popleft()
+    while found != value and queue and queue[0][1] == value and queue[0][0] - cycle <= WRITE_WINDOW:
+        cycle, found = queue.popleft()
+    return cycle, found
+
+
+def describe(key, value):
+    """
+    Formats a register or memory byte and its value (None for undefined).
+    """
+    if isinstance(key, int):
+        text = "undefined" if value is None else f"0x{value:02X}"
+        return f"byte 0x{key:08X} = {text}"
+    return f"{key} = {'undefined' if value is None else f'0x{value:08X}'}"
+
+
+def compare(reference, waveform):
+    """
+    Steps the simulator's trace and the waveform in lockstep to the first
+    instruction where they differ.
+
+    Args:
+        reference (list[Retired]): instructions executed by the simulator
+        waveform (Waveform): instructions and changes of the waveform
+
+    Returns:
+        tuple: (Divergence or None, instructions compared)
+    """
+    waves = waveform.instructions
+    changes = {key: deque(queue) for key, queue in waveform.changes.items()}
+    hardware = dict(zip(REGISTERS, reference[0].registers)) if reference else {}
+
+    def owner(cycle):
+        """Index of the instruction last to enter ID before a cycle."""
+        return max((num for num, wave in enumerate(waves[:len(reference)]) if wave.cycle < cycle),
+                   default=0)
+
+    def diverge(index, message, key=None, value=None):
+        registers = dict(hardware)
+        if key in registers:
+            registers[key] = value
+        return Divergence(index, message, registers)
+
+    for index, inst in enumerate(reference):
+        if index >= len(waves):
+            return None, index
+        wave = waves[index]
+        if (wave.addr, wave.word) != (inst.addr, inst.word):
+            text = "an undefined word" if wave.word is None else disassemble_word(wave.word, wave.addr)
+            return diverge(index, f"hardware executes 0x{wave.addr:08X} ({text})"), index
+
+        # Changes before this instruction entered ID are from those before it
+        for key, queue in changes.items():
+            if queue and queue[0][0] <= wave.cycle:
+                cycle, value = queue[0]
+                return diverge(owner(cycle), f"hardware writes {describe(key, value)} at cycle "
+                                             f"{cycle}, the simulator does not", key, value), index
+
+        for key, value in inst.changes.items():
+            queue = changes.get(key)
+            if not queue:
+                if wave.cycle + WRITE_LATENCY >= waveform.last_cycle:
+                    return None, index      # still in the pipeline when the waveform ends
+                return diverge(index, f"hardware does not write {describe(key, value)}"), index
+            cycle, found = match_change(queue, value)
+            if found != value:
+                return diverge(index, f"hardware writes {describe(key, found)} at cycle {cycle}, "
+                                      f"the simulator {describe(key, value)}", key, found), index
+            if key in hardware:
+                hardware[key] = value
+
+    # Both have finished: the hardware should not write anything more
+    for key, queue in changes.items():
+        if queue and reference and len(waves) <= len(reference):
+            cycle, value = queue[0]
+            return diverge(owner(cycle), f"hardware writes {describe(key, value)} at cycle "
+                                         f"{cycle}, the simulator does not", key, value), len(reference)
+    return None, len(reference)
+
+
+def print_divergence(divergence, reference, waveform, context=CONTEXT):
+    """
+    Prints a divergence with the instructions before it and the registers of
+    the simulator and the hardware.
+    """
+    index = divergence.index
+    inst = reference[index]
+    cycle = waveform.instructions[index].cycle if index < len(waveform.instructions) else None
+    print(f"Divergence at instruction {index}" + (f" (cycle {cycle})" if cycle is not None else "") +
+          f": 0x{inst.addr:08X}  {disassemble_word(inst.word, inst.addr)}")
+    print(f"  {divergence.message}")
+
+    print("\nInstructions (cycle entering ID, address, instruction):")
+    for num in range(max(0, index - context), index + 1):
+        before = reference[num]
+        wave_cycle = waveform.instructions[num].cycle if num < len(waveform.instructions) else "-"
+        marker = ">" if num == index else " "
+        print(f"{marker} {wave_cycle:>6}  0x{before.addr:08X}  {disassemble_word(before.word, before.addr)}")
+
+    # Registers after the instruction (simulator) and as written so far
+    # (hardware)
+    after = reference[index + 1].registers if index + 1 < len(reference) else None
+    if after is None:
+        return
+    print("\nRegisters after it (simulator / hardware, * where they differ):")
+    cells = []
+    for name, value in zip(REGISTERS, after):
+        hw_value = divergence.registers.get(name)
+        hw_text = "--------" if hw_value is None else f"{hw_value:08X}"
+        marker = "*" if hw_value != value else " "
+        cells.append(f"{name:<4}{value:08X} / {hw_text}{marker}")
+    for row in range(0, len(cells), 4):
+        print("  " + "  ".join(cells[row:row + 4]))
+
+
+def main(argv):
+    """
+    Command line entry point. Checks the waveform of a test against the
+    simulator.
+    """
+    parser = argparse.ArgumentParser(prog="sh2_lockstep.py", description="SH-2 Lockstep Checker")
+    parser.add_argument("program", help="assembly source or build directory the waveform ran")
+    parser.add_argument("waveform", nargs='?',
+                        help=f"VCD file of the simulation (default {VCD_FORMAT.format('<test>')})")
+    parser.add_argument("--context", type=int, default=CONTEXT,
+                        help="instructions shown before a divergence (default %(default)d)")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS,
+                        help="instructions executed before giving up (default %(default)d)")
+    args = parser.parse_args(argv[1:])
+
+    waveform_path = args.waveform
+    if waveform_path is None:
+        test = os.path.splitext(os.path.basename(os.path.normpath(args.program)))[0]
+        waveform_path = VCD_FORMAT.format(test)
+
+    try:
+        sim = load_program(args.program)
+        initial = dict(zip(REGISTERS, registers_of(sim)))
+        start = sim.pc
+        reference, error = run_reference(sim, args.max_steps)
+        waveform = read_waveform(waveform_path, start, initial)
+    except (OSError, ValueError) as err:
+        print(f"Error: {err}")
+        return 1
+
+    divergence, compared = compare(reference, waveform)
+    if divergence:
+        print_divergence(divergence, reference, waveform, args.context)
+        return 1
+
+    print(f"No divergence in {compared} instructions")
+    if compared < len(reference):
+        print(f"The waveform ends at cycle {waveform.last_cycle}, before instruction {compared}")
+    elif error:
+        print(f"The simulator stopped: {error}")
+    return 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,359 @@
+"""
+SH-2 Pipeline Model
+
+Cycle-level model of the HW3 CPU pipeline (IF, ID, EX, MA, and WB in
+sh2_cpu.vhd): runs a program on the instruction set simulator and times the
+instructions it executes, giving the cycles, CPI, and where the cycles lost to
+stalls and flushes go without running the GHDL simulation. Changes to the
+pipeline can then be tried on the test programs before they are built.
+
+The timing of each instruction is read from the control unit itself: the
+auto-generated instruction decoding of cu.vhd gives the next state, UpdateIR,
+ABOutSel, UseWB, BranchSel, and RMW of every opcode of opcode.vhd, and the
+state decoding gives the states that follow (WaitForFetch, WriteBack, and the
+TRAPA and RTE states), so regenerating cu.vhd updates the model too.
+
+Usage:
+    python sh2_pipe.py <input_file.asm> [--split-memory] [--early-branch] [--forward-loads]
+    python sh2_pipe.py <build_dir> [--all-configs] [--diagram N]
+
+    The program is assembled from its source or loaded from a build directory
+    as by sh2_sim.py, and runs until SLEEP (or until --max-steps instructions
+    have executed). The cycles are counted from the first instruction entering
+    ID to SLEEP entering ID (when the control unit enters its Sleep state).
+
+    With --diagram, the first N instructions are printed with the cycle they
+    enter each stage and the stall and flush cycles charged to them, and with
+    --all-configs every combination of the options below is reported.
+
+Pipeline model:
+    An instruction enters ID one cycle after the instruction before it, plus:
+    - MA/IF stalls: memory.vhd has a single port, so a data access in MA holds
+      off the next instruction fetch (UpdateIR low, then WaitForFetch).
+    - Multi-cycle instructions: the extra control unit states of read-modify-
+      write instructions (WriteBack) and of TRAPA and RTE.
+    - Branch flushes: branches are resolved in EX (TakeBranch), so a taken
+      BF/BT flushes the instruction behind it (FlushPL), and a BF/S or BT/S
+      not taken fetches its delay slot again. Delayed branches taken run their
+      slot, so they cost nothing extra.
+    Loaded registers are written in WB (UseWB), but the MA/IF stall already
+    delays the instruction using them, so loads have no load-use stall.
+
+Options:
+    --split-memory    separate instruction and data memories: data accesses
+                      no longer stall fetch, which exposes a load-use stall
+                      when the next instruction reads the loaded register
+    --forward-loads   forward loaded data from MA to EX (no load-use stall)
+    --early-branch    resolve branches in ID (no branch flushes)
+"""
+
+import argparse
+import os
+import re
+import sys
+from collections import Counter, namedtuple
+from functools import lru_cache
+
+from sh2_asm import FLUSHING_BRANCHES, instruction_effects, loaded_registers
+from sh2_disasm import disassemble_word
+from sh2_sim import MAX_STEPS, SimulationError, load_program
+
+# VHDL sources of the control unit (relative to the run directory)
+VHD_DIR = '../vhd/'
+CU_FILE = "cu.vhd"
+OPCODE_FILE = "opcode.vhd"
+
+# Markers of the auto-generated instruction and state decoding in cu.vhd
+DECODE_START = "-- Instruction decoding (auto-generated)"
+DECODE_END = "-- State Decoding Autogen"
+DECODE_SPLIT_RE = re.compile(r'\n\s*(?:if|elsif) std_match\(IR, (\w+)\) then')
+STATE_SPLIT_RE = re.compile(r'\n\s*(?:if|elsif) CurrentState = (\w+) then')
+SIGNAL_RE = re.compile(r'\b(NextState|UpdateIR|ABOutSel|UseWB|BranchSel|RMW)\s*<=\s*([\w\']+);')
+OPCODE_RE = re.compile(r'constant (Op\w+)\s*:\s*std_logic_vector[^:]*:=\s*"([01-]{16})";')
+
+# Control unit states: the state instructions run in, the state SLEEP waits
+# in, and the state of an instruction in a delay slot (the slot is decoded in
+# it, so it is not an extra cycle of the instruction before)
+NORMAL = "Normal"
+SLEEP_STATE = "Sleep"
+SLOT_STATES = ("RTE_Slot",)
+FETCH_STATE = "WaitForFetch"    # waits for the fetch held off by a data access
+
+# Signals of the control unit outside the auto-generated decoding (its defaults)
+CU_DEFAULTS = {"NextState": NORMAL, "UpdateIR": "'1'", "ABOutSel": "ABOutSel_Prog",
+               "UseWB": "'0'", "BranchSel": "BranchSel_None", "RMW": "'0'"}
+
+# Timing of an opcode from the control unit: the extra states it runs through
+# (after its own cycle, not counting SLEEP's), whether it accesses data memory
+# (ABOutSel_Data), loads a register written back in WB (UseWB), its branch
+# type (BranchSel without the prefix, or None), and whether it ends the program
+Timing = namedtuple("Timing", "states data use_wb branch sleep")
+
+# Pipeline options (see the module docstring)
+PipelineConfig = namedtuple("PipelineConfig", "split_memory forward_loads early_branch")
+BASE_CONFIG = PipelineConfig(False, False, False)
+
+# Stall and flush kinds (the first three are stalls), as the hazards reported
+# by the assembler
+STALL_KINDS = ("MA/IF", "multi-cycle", "load-use")
+FLUSH_KINDS = ("branch flush",)
+
+# Instruction timed by the model: address, machine code, cycle it enters ID,
+# and the cycles it costs by kind
+TimedInstruction = namedtuple("TimedInstruction", "addr word cycle costs")
+
+
+def read_control_unit(vhd_dir=VHD_DIR):
+    """
+    Reads the timing of every opcode from the control unit.
+
+    Args:
+        vhd_dir (str): directory holding cu.vhd and opcode.vhd
+
+    Returns:
+        tuple: (list of (opcode pattern, Timing) in decoding order, Timing of
+                words the control unit does not decode)
+    """
+    with open(os.path.join(vhd_dir, OPCODE_FILE)) as file:
+        patterns = dict(OPCODE_RE.findall(file.read()))
+    with open(os.path.join(vhd_dir, CU_FILE)) as file:
+        source = file.read()
+
+    # Next state of each state of the state decoding (the states it does not
+    # list return to Normal)
+    start, end = source.index(DECODE_START), source.index(DECODE_END)
+    parts = STATE_SPLIT_RE.split(source[end:])
+    next_states = {state: dict(SIGNAL_RE.findall(body)).get("NextState", NORMAL)
+                   for state, body in zip(parts[1::2], parts[2::2])}
+
+    def timing(signals):
+        states = []
+        state = signals["NextState"]
+        while state not in (NORMAL, SLEEP_STATE) and state not in SLOT_STATES:
+            states.append(state)
+            state = next_states.get(state, NORMAL)
+        branch = signals["BranchSel"].replace("BranchSel_", "")
+        return Timing(tuple(states), signals["ABOutSel"] == "ABOutSel_Data",
+                      signals["UseWB"] == "'1'", None if branch in ("None", "0") else branch,
+                      state == SLEEP_STATE)
+
+    parts = DECODE_SPLIT_RE.split(source[start:end])
+    table = [(patterns[name], timing({**CU_DEFAULTS, **dict(SIGNAL_RE.findall(body))}))
+             for name, body in zip(parts[1::2], parts[2::2]) if name in patterns]
+    return table, timing(CU_DEFAULTS)
+
+
+def std_match(word, pattern):
+    """
+    Matches an instruction word against an opcode pattern of opcode.vhd ('-'
+    matches either bit), as std_match in the control unit.
+    """
+    bits = f"{word:016b}"
+    return all(p in ('-', b) for p, b in zip(pattern, bits))
+
+
+class PipelineModel:
+    """
+    Times the instructions executed by the instruction set simulator on the HW3
+    pipeline.
+    """
+
+    def __init__(self, config=BASE_CONFIG, vhd_dir=VHD_DIR):
+        self.config = config
+        self.table, self.default = read_control_unit(vhd_dir)
+        self.decode = lru_cache(maxsize=None)(self._decode)
+        self.effects = lru_cache(maxsize=None)(self._effects)
+
+    def _decode(self, word):
+        """
+        Finds the timing of an instruction word (the first opcode it matches,
+        as in the if/elsif chain of the control unit).
+        """
+        return next((timing for pattern, timing in self.table if std_match(word, pattern)),
+                    self.default)
+
+    @staticmethod
+    def _effects(word):
+        """
+        Finds the registers an instruction word reads and loads from memory.
+        """
+        text = disassemble_word(word, 0).split(';')[0].split(None, 1)
+        if len(text) < 2 or text[0].startswith('.'):
+            return frozenset(), frozenset()
+        op, args = text[0], text[1].strip()
+        return instruction_effects(op, args)[0], loaded_registers(op, args)
+
+    def costs(self, word, taken, next_word):
+        """
+        Finds the cycles an instruction costs on top of its own cycle in ID.
+
+        Args:
+            word (int): the instruction word
+            taken (bool): whether the instruction is a branch that is taken
+            next_word (int): the instruction executed after it (or None)
+
+        Returns:
+            Counter: extra cycles by stall or flush kind
+        """
+        config = self.config
+        timing = self.decode(word)
+        costs = Counter()
+        for state in timing.states:
+            if state != FETCH_STATE:
+                costs["multi-cycle"] += 1
+            elif not config.split_memory:
+                costs["MA/IF"] += 1
+
+        # With a data memory of its own, the fetch behind a load is no longer
+        # held off, so the next instruction reaches EX before the data is
+        # written back
+        if (timing.use_wb and config.split_memory and not config.forward_loads and
+                next_word is not None and self.effects(word)[1] & self.effects(next_word)[0]):
+            costs["load-use"] += 1
+
+        # Branches resolved in EX: taken BF/BT flush the instruction behind
+        # them, and BF/S and BT/S not taken fetch their slot again
+        if timing.branch and not config.early_branch:
+            if timing.branch in FLUSHING_BRANCHES and taken:
+                costs["branch flush"] += 1
+            elif timing.branch.endswith('S') and not taken:
+                costs["branch flush"] += 1
+        return costs
+
+    def run(self, sim, max_steps=MAX_STEPS):
+        """
+        Runs a program on the simulator and times the instructions executed.
+
+        Args:
+            sim (Simulator): the reset CPU with the program loaded
+            max_steps (int): instructions executed before giving up
+
+        Returns:
+            tuple: (list of TimedInstruction, whether the program reached SLEEP)
+
+        Raises:
+            SimulationError: the program does something the simulator cannot
+        """
+        executed = []
+        sim.run(max_steps, lambda addr, word: executed.append((addr, word)))
+
+        timed = []
+        cycle = 0
+        for num, (addr, word) in enumerate(executed):
+            timing = self.decode(word)
+            if timing.sleep:
+                timed.append(TimedInstruction(addr, word, cycle, Counter()))
+                return timed, True
+
+            # A branch is taken if the instruction after it (or after its slot,
+            # for all but BF/BT) is not the next one in memory
+            slot = 1 if timing.branch in (None, *FLUSHING_BRANCHES) else 2
+            after = executed[num + slot][0] if num + slot < len(executed) else None
+            taken = after is not None and after != addr + 2 * slot
+            next_word = executed[num + 1][1] if num + 1 < len(executed) else None
+
+            costs = self.costs(word, taken, next_word)
+            timed.append(TimedInstruction(addr, word, cycle, costs))
+            cycle += 1 + sum(costs.values())
+        return timed, False
+
+
+def summarize(timed):
+    """
+    Totals the cycles of a timed run.
+
+    Returns:
+        tuple: (cycles, instructions, Counter of cycles by stall or flush kind)
+    """
+    totals = Counter()
+    for inst in timed:
+        totals.update(inst.costs)
+    cycles = timed[-1].cycle + 1 + sum(timed[-1].costs.values()) if timed else 0
+    return cycles, len(timed), totals
+
+
+def print_report(timed, reached_sleep):
+    """
+    Prints the cycles, CPI, and stall and flush breakdown of a timed run.
+    """
+    cycles, count, totals = summarize(timed)
+    print(f"Instructions: {count}" + ("" if reached_sleep else " (SLEEP not reached)"))
+    print(f"Cycles:       {cycles}")
+    print(f"CPI:          {cycles / count if count else 0:.3f}")
+    for heading, kinds in (("Stalls", STALL_KINDS), ("Flushes", FLUSH_KINDS)):
+        print(f"{heading}:{sum(totals[kind] for kind in kinds):>{14 - len(heading)}}")
+        for kind in kinds:
+            share = totals[kind] / cycles if cycles else 0
+            print(f"  {kind:<14}{totals[kind]:>6}  ({share:.1%})")
+
+
+def print_diagram(timed, count):
+    """
+    Prints the first instructions of a timed run with the cycle they enter each
+    stage (the stages after ID are reached one cycle apart unless stalled) and
+    the cycles charged to them.
+    """
+    print(f"{'Addr':>10}  {'Instruction':<30}{'IF':>6}{'ID':>6}{'EX':>6}{'MA':>6}{'WB':>6}  Extra")
+    for inst in timed[:count]:
+        stages = "".join(f"{inst.cycle + offset:>6}" for offset in range(-1, 4))
+        extra = ", ".join(f"{kind} {cycles}" for kind, cycles in inst.costs.items() if cycles)
+        text = disassemble_word(inst.word, inst.addr).split(';')[0].rstrip()
+        print(f"0x{inst.addr:08X}  {text:<30}{stages}  {extra}")
+
+
+def config_name(config):
+    """
+    Names a pipeline configuration by its options.
+    """
+    options = [f"--{field.replace('_', '-')}" for field, on in config._asdict().items() if on]
+    return " ".join(options) or "HW3 pipeline"
+
+
+def main(argv):
+    """
+    Command line entry point. Times a program on the pipeline and reports its
+    cycles.
+    """
+    parser = argparse.ArgumentParser(prog="sh2_pipe.py", description="SH-2 Pipeline Model")
+    parser.add_argument("program", help="assembly source or build directory to run")
+    parser.add_argument("--split-memory", action="store_true",
+                        help="separate instruction and data memories")
+    parser.add_argument("--forward-loads", action="store_true",
+                        help="forward loaded data from MA to EX")
+    parser.add_argument("--early-branch", action="store_true", help="resolve branches in ID")
+    parser.add_argument("--all-configs", action="store_true",
+                        help="report every combination of the options above")
+    parser.add_argument("--diagram", type=int, default=0, metavar="N",
+                        help="print the stages of the first N instructions")
+    parser.add_argument("--vhd-dir", default=VHD_DIR,
+                        help=f"directory of cu.vhd and opcode.vhd (default {VHD_DIR})")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS,
+                        help="instructions executed before giving up (default %(default)d)")
+    args = parser.parse_args(argv[1:])
+
+    if args.all_configs:
+        configs = [PipelineConfig(split, forward, early)
+                   for split in (False, True) for forward in (False, True)
+                   for early in (False, True) if split or not forward]
+    else:
+        configs = [PipelineConfig(args.split_memory, args.forward_loads, args.early_branch)]
+
+    try:
+        for config in configs:
+            model = PipelineModel(config, args.vhd_dir)
+            timed, reached_sleep = model.run(load_program(args.program), args.max_steps)
+            if len(configs) > 1:
+                print(f"\n{config_name(config)}")
+            print_report(timed, reached_sleep)
+            if args.diagram:
+                print()
+                print_diagram(timed, args.diagram)
+    except (OSError, ValueError, SimulationError) as err:
+        print(f"Error: {err}")
+        return 1
+    return 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
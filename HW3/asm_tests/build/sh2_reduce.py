@@ -0,0 +1,354 @@
+"""
+SH-2 Failing Program Reducer
+
+Cuts a failing assembly program down to a small program that fails the same
+way (delta debugging). Whole blocks (a label and the lines up to the next
+label) are removed first, then single lines (instructions, directives, and
+labels), for as long as any removal keeps the program failing. The result is
+1-minimal: removing any one line of it makes it assemble differently, pass,
+or fail some other way.
+
+Every candidate must stay a valid program: it must assemble, and (if the
+original does) run to SLEEP on sh2_sim.py, so a removal never turns the
+failure into a missing SLEEP or an unmapped access. Candidates are keyed by
+a hash of their assembled memory, so removing a comment, an unreferenced
+label, or anything else that does not change the memory image costs nothing,
+and each image is checked once. The candidates of each step are checked in
+parallel across a pool of processes, in order, taking the first that still
+fails, so the result does not depend on the number of processes.
+
+Usage:
+    python sh2_reduce.py <program.asm> --check batch|optimize [-o FILE] [--jobs N]
+    python sh2_reduce.py <program.asm> --command "CMD {}" [--timeout S] [-o FILE] [--jobs N]
+
+    --check runs a check of sh2_fuzz.py, and a candidate fails the same way if
+    it fails with the same signature (as for programs written by
+    sh2_fuzz.py --save). --command runs CMD with {} replaced by the path of the
+    candidate (or the path appended), and a candidate fails the same way if
+    the command exits with the status it does for the original, which must be
+    non-zero. For a GHDL failure, CMD assembles the candidate, simulates it, and
+    compares the dump with the memory sh2_sim.py leaves (or runs
+    sh2_lockstep.py on its waveform); with --jobs above 1 the runs must not
+    share output files.
+
+    The reduced program is written to FILE (<program>_reduced.asm by default).
+"""
+
+import argparse
+import hashlib
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sh2_asm import LABEL_RE, assemble, mem_blocks
+from sh2_fuzz import CHECKS
+from sh2_sim import MAX_STEPS, SimulationError, Simulator
+
+
+def split_lines(source):
+    """
+    Splits a program into the lines that can be removed, without comments
+    and blank lines, and with labels on lines of their own.
+
+    Returns:
+        list[str]: lines of code
+    """
+    lines = []
+    for line in source.splitlines():
+        code = line.split(';', 1)[0].rstrip()
+        label_match = LABEL_RE.match(code.strip())
+        if label_match and code.strip()[label_match.end():].strip():
+            lines.append(label_match.group(0))
+            code = "    " + code.strip()[label_match.end():].strip()
+        if code.strip():
+            lines.append(code)
+    return lines
+
+
+def split_blocks(lines, kept):
+    """
+    Groups the kept lines of a program into blocks: a label and the lines up
+    to the next label (or section directive).
+
+    Args:
+        lines (list[str]): lines of the program
+        kept (list[int]): indices of the lines kept
+
+    Returns:
+        list[list[int]]: indices of the lines of each block
+    """
+    blocks = []
+    for num in kept:
+        code = lines[num].strip()
+        if not blocks or LABEL_RE.match(code) or code.split()[0] in ('.text', '.data', '.section'):
+            blocks.append([])
+        blocks[-1].append(num)
+    return blocks
+
+
+def image_hash(source, include_dir=None, simulate=True):
+    """
+    Assembles a candidate and hashes its memory image.
+
+    Args:
+        source (str): assembly source
+        include_dir (str): directory .incbin files are relative to
+        simulate (bool): also require the program to run to SLEEP on sh2_sim.py
+
+    Returns:
+        str: hex digest of the memory blocks, or None if the program is not
+             valid
+    """
+    try:
+        blocks = mem_blocks(assemble(source, keep_source=False, include_dir=include_dir))
+    except ValueError:
+        return None
+    if simulate:
+        try:
+            Simulator(blocks).run(MAX_STEPS)
+        except SimulationError:
+            return None
+    digest = hashlib.sha1()
+    for addr, contents in blocks:
+        digest.update(addr.to_bytes(4, 'big'))
+        digest.update(contents)
+    return digest.hexdigest()
+
+
+def run_check(check, source):
+    """
+    Checks a candidate with a check of sh2_fuzz.py.
+
+    Returns:
+        str: signature of its failure, or None if it passes
+    """
+    failures = CHECKS[check]([(0, source)])
+    return failures[0].signature if failures else None
+
+
+def run_command(command, source, timeout=None):
+    """
+    Checks a candidate with a command, run on the candidate written to a
+    temporary file.
+
+    Returns:
+        int: exit status of the command (None if it timed out)
+    """
+    with tempfile.TemporaryDirectory(prefix="sh2_reduce_") as tmp_dir:
+        path = os.path.join(tmp_dir, "reduce.asm")
+        with open(path, 'w') as out_file:
+            out_file.write(source)
+        args = [arg.replace("{}", path) for arg in shlex.split(command)]
+        if "{}" not in command:
+            args.append(path)
+        try:
+            return subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                  timeout=timeout).returncode
+        except subprocess.TimeoutExpired:
+            return None
+
+
+def outcome(test, source):
+    """
+    Outcome of a candidate (a task of the pool): the signature of a check or
+    the exit status of a command.
+
+    Args:
+        test (tuple): ("check", name) or ("command", command, timeout)
+        source (str): assembly source of the candidate
+    """
+    if test[0] == "check":
+        return run_check(test[1], source)
+    return run_command(test[1], source, test[2])
+
+
+class Reducer:
+    """
+    Reduces a failing program by delta debugging.
+    """
+
+    def __init__(self, source, test, pool=None, jobs=1, include_dir=None):
+        """
+        Args:
+            source (str): assembly source of the failing program
+            test (tuple): ("check", name) or ("command", command, timeout)
+            pool (ProcessPoolExecutor): processes to check candidates in (None
+                                        to check them in this process)
+            jobs (int): candidates checked at a time
+            include_dir (str): directory .incbin files are relative to
+
+        Raises:
+            ValueError: if the program does not assemble or does not fail
+        """
+        self.lines = split_lines(source)
+        self.test = test
+        self.pool = pool
+        self.jobs = jobs
+        self.include_dir = include_dir
+        self.cache = {}             # image hash -> outcome
+        self.tests = 0              # candidates checked (not found in the cache)
+        self.invalid = 0            # candidates that were not valid programs
+
+        # The original must fail (and candidates must run to SLEEP if it does)
+        self.simulate = image_hash(source, include_dir) is not None
+        digest = image_hash(source, include_dir, self.simulate)
+        if digest is None:
+            raise ValueError("the program does not assemble")
+        self.failure = outcome(test, self.source(range(len(self.lines))))
+        self.cache[digest] = self.failure
+        if self.failure in (None, 0):
+            raise ValueError("the program does not fail the check")
+
+    def source(self, kept):
+        """
+        Builds the source of a candidate from the indices of its lines.
+        """
+        return "\n".join(self.lines[num] for num in kept) + "\n"
+
+    def first_failing(self, candidates):
+        """
+        Finds the first candidate that fails the same way as the original,
+        checking up to jobs candidates at a time.
+
+        Args:
+            candidates (list[list[int]]): indices of the lines of each candidate
+
+        Returns:
+            list[int]: the first failing candidate, or None
+        """
+        pending = []        # (candidate, image hash, source) of valid candidates
+        for candidate in candidates:
+            source = self.source(candidate)
+            digest = image_hash(source, self.include_dir, self.simulate)
+            if digest is None:
+                self.invalid += 1
+            elif digest not in self.cache or self.cache[digest] == self.failure:
+                pending.append((candidate, digest, source))
+                if len(pending) == self.jobs or (digest in self.cache and len(pending) == 1):
+                    found = self.check(pending)
+                    if found is not None:
+                        return found
+                    pending = []
+        return self.check(pending)
+
+    def check(self, pending):
+        """
+        Checks candidates in parallel (unless their outcome is cached).
+
+        Args:
+            pending (list): (candidate, image hash, source) of each candidate
+
+        Returns:
+            list[int]: the first candidate failing the same way, or None
+        """
+        unchecked = {digest: source for _, digest, source in pending if digest not in self.cache}
+        if self.pool is None:
+            results = [outcome(self.test, source) for source in unchecked.values()]
+        else:
+            results = self.pool.map(outcome, [self.test] * len(unchecked), unchecked.values())
+        self.cache.update(zip(unchecked, results))
+        self.tests += len(unchecked)
+        for candidate, digest, _ in pending:
+            if self.cache[digest] == self.failure:
+                return candidate
+        return None
+
+    def ddmin(self, units):
+        """
+        Removes as many units (groups of line indices) as possible, trying
+        the complement of each of n chunks for n = 2, 4, ... up to the number
+        of units.
+
+        Returns:
+            list[list[int]]: units kept
+        """
+        chunks = 2
+        while len(units) >= 2:
+            size = len(units) / chunks
+            parts = [units[round(num * size):round((num + 1) * size)] for num in range(chunks)]
+            candidates = [[unit for other in parts if other is not part for unit in other] for part in parts]
+            found = self.first_failing([sorted(num for unit in candidate for num in unit)
+                                        for candidate in candidates])
+            if found is not None:
+                kept = set(found)
+                units = [unit for unit in units if unit[0] in kept]
+                chunks = max(chunks - 1, 2)
+            elif chunks >= len(units):
+                break
+            else:
+                chunks = min(2 * chunks, len(units))
+        return units
+
+    def reduce(self, report=None):
+        """
+        Reduces the program: blocks, then lines, until neither removes
+        anything.
+
+        Args:
+            report (callable): called with the name of each pass and the
+                               number of lines left after it
+
+        Returns:
+            str: assembly source of the reduced program
+        """
+        kept = list(range(len(self.lines)))
+        while True:
+            before = len(kept)
+            for name in ("blocks", "lines"):
+                units = split_blocks(self.lines, kept) if name == "blocks" else [[num] for num in kept]
+                kept = sorted(num for unit in self.ddmin(units) for num in unit)
+                if report:
+                    report(name, len(kept))
+            if len(kept) == before:
+                return self.source(kept)
+
+
+def main(argv):
+    """
+    Command line entry point. Reduces a failing program.
+    """
+    parser = argparse.ArgumentParser(prog="sh2_reduce.py", description="SH-2 Failing Program Reducer")
+    parser.add_argument("program", help="assembly source of the failing program")
+    test = parser.add_mutually_exclusive_group(required=True)
+    test.add_argument("--check", choices=tuple(CHECKS), help="check of sh2_fuzz.py the program fails")
+    test.add_argument("--command", help="command the program fails ({} is replaced by its path)")
+    parser.add_argument("--timeout", type=float, help="seconds before a --command run counts as passing")
+    parser.add_argument("-o", "--output", help="file to write the reduced program to")
+    parser.add_argument("--jobs", type=int, default=0,
+                        help="worker processes (0 for one per CPU, the default; 1 to check in this process)")
+    args = parser.parse_args(argv[1:])
+
+    with open(args.program) as in_file:
+        source = in_file.read()
+    test = ("check", args.check) if args.check else ("command", args.command, args.timeout)
+    jobs = args.jobs or os.cpu_count()
+    output = args.output or os.path.splitext(args.program)[0] + "_reduced.asm"
+
+    start = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        reducer = Reducer(source, test, pool, jobs, os.path.dirname(os.path.abspath(args.program)))
+        print(f"{args.program}: {len(reducer.lines)} lines, failing with {reducer.failure}")
+        reduced = reducer.reduce(lambda name, lines: print(f"    {name:<8}{lines:>6} lines"))
+    except ValueError as err:
+        print(f"Error: {args.program}: {err}")
+        return 1
+    finally:
+        if pool:
+            pool.shutdown()
+
+    with open(output, 'w') as out_file:
+        out_file.write(reduced)
+    print(f"Wrote {output}: {len(split_lines(reduced))} lines ({reducer.tests} checks, "
+          f"{len(reducer.cache)} programs cached, {reducer.invalid} candidates not valid, "
+          f"{time.perf_counter() - start:.1f} s)")
+    return 0
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,1036 @@
+"""
+SH-2 Instruction Set Simulator
+
+Executes the programs built by the assembler instruction by instruction, as a
+golden model of the HW3 CPU: it gives the memory a test should leave behind
+without running the GHDL simulation of sh2_cpu.vhd, and without expected
+files computed by hand. The final memory is written as the dump files of
+memory.vhd (dump0.txt to dump3.txt), so mem_compare.py checks the result of
+the simulator exactly as it checks a simulation, and it can be written as an
+expected file (<test>_exp.txt) for new tests.
+
+Instructions are predecoded: the first time an address is executed, its word
+is decoded with the decode table of sh2_disasm.py into the function executing
+the instruction and its operands (registers, immediates, scaled displacements,
+and the absolute targets of branches and PC relative loads), and later
+executions only call the function. Writes to a predecoded word drop it, so
+self-modifying code runs as written.
+
+Usage:
+    python sh2_sim.py <input_file.asm> [--dump-dir DIR] [--expected FILE]
+    python sh2_sim.py <build_dir> [--dump-dir DIR] [--expected FILE]
+
+    A program is either assembled from its source or loaded from the memory
+    files in a build directory (build_mem0.txt to build_mem3.txt, or the .bin
+    images); memory blocks without a file are undefined (X), as in memory.vhd.
+    The program runs from address 0 with every register zero until SLEEP (or
+    until --max-steps instructions have executed). The dump files are written
+    to ../asm_tests/mem_dump/ unless --dump-dir is given, and with --trace
+    every instruction executed is printed.
+
+    With --expected, the data memory (from 0x400, or --expected-addr) is also
+    written as an expected file for mem_compare.py, ending at the last
+    non-zero long.
+
+Execution model:
+    The simulator follows the HW3 CPU where it differs from the SH-2 manual:
+    - PC relative addresses are computed from the address of the instruction
+      plus sh2_asm.PC_OFFSET, and MOVA does not clear the low two bits of the
+      PC (only MOV.L @(disp, PC) does, as the assembler's literal pools
+      expect).
+    - Setting the T bit writes all of SR (the other bits are cleared), while
+      LDC to SR writes all 32 bits.
+    - TRAPA #imm pushes SR and then the address of the next instruction, and
+      jumps to the long at VBR + 4 * imm; RTE pops the PC and then SR and
+      executes its delay slot.
+    - BSR, BSRF, and JSR save the address of the call plus 2 in PR (not plus
+      4), and RTS returns to PR + 2, so STS PR reads the call's address plus
+      2 and an RTS after LDS Rm, PR returns to Rm + 2.
+    - CLRMAC is the only MAC instruction (it clears MACH and MACL).
+    Branches, exceptions, SLEEP, and MOVA are illegal in a delay slot, and
+    misaligned or unmapped memory accesses stop the simulation.
+"""
+
+import argparse
+import os
+import struct
+import sys
+
+from sh2_asm import (CHUNK1_ADDR, INSTRUCTION_SET, MEM_BLOCKS, OUTPUT_FILES,
+                     PC_MASKED_LOADS, PC_OFFSET, SIGNED_IMMEDIATES, SLOT_ILLEGAL,
+                     assemble_file, mem_blocks)
+from sh2_disasm import DECODE_TABLE, disassemble_word, field_value, signed
+
+# Default directory of the memory dump files (relative to the run directory),
+# and the dump file of each memory block
+DUMP_DIR = '../asm_tests/mem_dump/'
+DUMP_FILES = ("dump0.txt", "dump1.txt", "dump2.txt", "dump3.txt")
+
+# Instructions executed before a program that has not reached SLEEP is stopped
+MAX_STEPS = 1000000
+
+# Address the expected file starts at (the data memory checked by mem_compare.py)
+EXPECTED_ADDR = CHUNK1_ADDR
+
+MASK32 = 0xFFFFFFFF
+SIGN32 = 0x80000000
+
+# SR bits cleared by DIV0U besides T (M and Q)
+SR_MQ = 0x0300
+
+# PR saved by a call is its address plus PR_OFFSET (PRSel_PC in pau.vhd stores
+# the PC of the call), and RTS returns to PR plus RTS_OFFSET (PAU_OffsetWord)
+PR_OFFSET = 2
+RTS_OFFSET = 2
+
+# Bytes accessed by each operation size suffix (MOVA computes a long address)
+ACCESS_SIZES = {".B": 1, ".W": 2, ".L": 4}
+
+
+class SimulationError(Exception):
+    """
+    Raised when a program cannot continue: an illegal instruction, a branch
+    in a delay slot, a misaligned or unmapped access, or too many steps.
+    """
+
+
+def sext(value, size):
+    """
+    Sign extends a byte, word, or long to an unsigned 32-bit register value.
+    """
+    top = 0x80 << 8 * (size - 1)
+    value &= (top << 1) - 1
+    return ((value ^ top) - top) & MASK32
+
+
+def to_signed(value):
+    """
+    Interprets a 32-bit register value as a signed integer.
+    """
+    return (value ^ SIGN32) - SIGN32
+
+
+def overflow(result):
+    """
+    Whether a signed result does not fit in 32 bits.
+    """
+    return (result < -SIGN32) | (result >= SIGN32)
+
+
+def same_byte(n, m):
+    """
+    CMP/STR: whether any byte of Rn equals the same byte of Rm.
+    """
+    diff = n ^ m
+    return (((diff & 0xFF) == 0) | ((diff & 0xFF00) == 0) |
+            ((diff & 0xFF0000) == 0) | ((diff & 0xFF000000) == 0))
+
+
+def decode_word(word):
+    """
+    Decodes an instruction word into its operands as they are passed to the
+    functions executing instructions, apart from its address: a PC relative
+    operand (a branch target or @(disp, PC) address) is the offset from the
+    address of the instruction with the low bits under the PC mask.
+
+    Args:
+        word (int): 16-bit instruction word
+
+    Returns:
+        tuple or None: (key in OPERATIONS, list of operands, index of the PC
+                        relative operand or None, PC mask), or None if the
+                        word is not an instruction
+    """
+    decoder = DECODE_TABLE[word]
+    if decoder is None:
+        return None
+
+    mnemonic = decoder.mnemonic
+    size = ACCESS_SIZES.get(mnemonic[-2:], 4)
+    args = []
+    pc_relative, pc_mask = None, ~0
+    for op_type, fields in decoder.operands:
+        values = [field_value(word, mask) for mask in fields]
+        if op_type == "label":
+            pc_relative = len(args)
+            args.append(PC_OFFSET + 2 * signed(values[0], fields[0]))
+        elif op_type == "imm":
+            args.append(signed(values[0], fields[0]) & MASK32
+                        if mnemonic in SIGNED_IMMEDIATES else values[0])
+        elif op_type == "indexed":
+            args += (values[0] * size, values[1])
+        elif op_type == "indexed_gbr":
+            args.append(values[0] * size)
+        elif op_type == "indexed_pc":
+            pc_relative = len(args)
+            pc_mask = ~3 if mnemonic in PC_MASKED_LOADS else ~0
+            args.append(PC_OFFSET + values[0] * size)
+        else:
+            args += values
+    return (mnemonic, tuple(op_type for op_type, _ in decoder.operands)), args, pc_relative, pc_mask
+
+
+class Simulator:
+    """
+    State of the CPU (registers and memory) and the predecoded program.
+
+    Attributes:
+        r (list[int]): general registers R0-R15 (unsigned 32-bit)
+        sr, gbr, vbr, pr, mach, macl (int): control and system registers
+        pc (int): address of the next instruction
+        blocks (list): (address, contents, defined) of each memory block, the
+                       contents and defined flags being bytearrays
+        steps (int): instructions executed
+        halted (bool): whether SLEEP has executed
+        undefined_reads (int): reads of memory that was never written (read as 0)
+        delayed (int or None): target of the delayed branch just executed
+        decoded (dict): address -> predecoded instruction
+    """
+
+    def __init__(self, blocks):
+        """
+        Resets the CPU with the given memory.
+
+        Args:
+            blocks (list): (address, contents or None) of each memory block,
+                           None for blocks without an initial value (X)
+        """
+        self.r = [0] * 16
+        self.sr = self.gbr = self.vbr = self.pr = self.mach = self.macl = 0
+        self.pc = 0
+        self.blocks = []
+        for (addr, contents), (_, size) in zip(blocks, MEM_BLOCKS):
+            if contents is None:
+                self.blocks.append((addr, bytearray(size), bytearray(size)))
+            else:
+                self.blocks.append((addr, bytearray(contents), bytearray(b"\1" * size)))
+        self.steps = 0
+        self.halted = False
+        self.undefined_reads = 0
+        self.delayed = None
+        self.decoded = {}
+
+    # Memory
+
+    def locate(self, addr, size):
+        """
+        Finds the memory block holding an access.
+
+        Returns:
+            tuple: (contents, defined, offset) of the access in its block
+
+        Raises:
+            SimulationError: if the access is misaligned or outside the blocks
+        """
+        if addr % size:
+            raise SimulationError(f"Misaligned {size}-byte access of 0x{addr:08X} at PC 0x{self.pc:08X}")
+        for base, contents, defined in self.blocks:
+            offset = addr - base
+            if 0 <= offset <= len(contents) - size:
+                return contents, defined, offset
+        raise SimulationError(f"Access of unmapped address 0x{addr:08X} at PC 0x{self.pc:08X}")
+
+    def read(self, addr, size):
+        """
+        Reads a byte, word, or long (big-endian, zero-extended).
+        """
+        contents, defined, offset = self.locate(addr & MASK32, size)
+        if 0 in defined[offset:offset + size]:
+            self.undefined_reads += 1
+        return int.from_bytes(contents[offset:offset + size], 'big')
+
+    def write(self, addr, size, value):
+        """
+        Writes the low bytes of a value as a byte, word, or long.
+        """
+        addr &= MASK32
+        contents, defined, offset = self.locate(addr, size)
+        contents[offset:offset + size] = (value & ((1 << 8 * size) - 1)).to_bytes(size, 'big')
+        defined[offset:offset + size] = b"\1" * size
+
+        # Code written over is decoded again
+        self.decoded.pop(addr & ~1, None)
+        if size == 4:
+            self.decoded.pop(addr + 2, None)
+
+    def push(self, value):
+        """
+        Pushes a long on the stack (@-R15).
+        """
+        self.r[15] = (self.r[15] - 4) & MASK32
+        self.write(self.r[15], 4, value)
+
+    def pop(self):
+        """
+        Pops a long from the stack (@R15+).
+        """
+        value = self.read(self.r[15], 4)
+        self.r[15] = (self.r[15] + 4) & MASK32
+        return value
+
+    # Status register
+
+    @property
+    def t(self):
+        """
+        The T bit of SR.
+        """
+        return self.sr & 1
+
+    def set_t(self, t):
+        """
+        Sets the T bit. The HW3 CPU writes SR with the T bit alone, clearing
+        the other bits of SR.
+        """
+        self.sr = 1 if t else 0
+
+    # Execution
+
+    def decode(self, addr):
+        """
+        Predecodes the instruction at an address.
+
+        Returns:
+            tuple: (function executing the instruction, its operands, whether
+                    it is illegal in a delay slot)
+
+        Raises:
+            SimulationError: if the word is undefined or not an instruction
+        """
+        contents, defined, offset = self.locate(addr, 2)
+        if 0 in defined[offset:offset + 2]:
+            raise SimulationError(f"Execution of undefined memory at 0x{addr:08X}")
+        word = int.from_bytes(contents[offset:offset + 2], 'big')
+        decoded = decode_word(word)
+        if decoded is None:
+            raise SimulationError(f"Illegal instruction 0x{word:04X} at 0x{addr:08X}")
+
+        # PC relative operands are made absolute
+        key, args, pc_relative, pc_mask = decoded
+        if pc_relative is not None:
+            args[pc_relative] = ((addr & pc_mask) + args[pc_relative]) & MASK32
+        entry = (EXECUTE[key], tuple(args), key[0] in SLOT_ILLEGAL)
+        self.decoded[addr] = entry
+        return entry
+
+    def run(self, max_steps=MAX_STEPS, trace=None):
+        """
+        Runs the program until SLEEP.
+
+        Args:
+            max_steps (int): instructions executed before giving up
+            trace (callable or None): called with (address, word) before each
+                                      instruction executes
+
+        Returns:
+            int: instructions executed
+
+        Raises:
+            SimulationError: if the program cannot continue or does not halt
+        """
+        decoded = self.decoded
+        pc = self.pc
+        slot_of = None          # target of the branch whose slot executes next
+        while not self.halted:
+            if self.steps >= max_steps:
+                self.pc = pc
+                raise SimulationError(f"No SLEEP after {max_steps} instructions (PC 0x{pc:08X})")
+            self.pc = pc
+            execute, args, slot_illegal = decoded.get(pc) or self.decode(pc)
+            if slot_of is not None and slot_illegal:
+                raise SimulationError(f"Illegal slot instruction at 0x{pc:08X}")
+            if trace:
+                trace(pc, self.read(pc, 2))
+            self.steps += 1
+            next_pc = execute(self, pc, *args)
+
+            # The slot has executed: take the branch (a delayed branch only
+            # sets its target, executing the next instruction first)
+            if slot_of is not None:
+                next_pc, slot_of = slot_of, None
+            if self.delayed is not None:
+                slot_of, self.delayed = self.delayed, None
+            pc = next_pc & MASK32
+        self.pc = pc
+        return self.steps
+
+    # Results
+
+    def dump_lines(self, num):
+        """
+        Yields the lines of the dump file of a memory block, as written by
+        memory.vhd (a 16-bit binary string per word, X for undefined bits).
+        """
+        _, contents, defined = self.blocks[num]
+        for offset in range(0, len(contents), 2):
+            yield "".join(f"{contents[i]:08b}" if defined[i] else "XXXXXXXX"
+                          for i in (offset, offset + 1)) + "\n"
+
+    def write_dumps(self, dump_dir=DUMP_DIR):
+        """
+        Writes the memory dump files (dump0.txt through dump3.txt).
+        """
+        for num, filename in enumerate(DUMP_FILES):
+            with open(os.path.join(dump_dir, filename), 'w') as out_file:
+                out_file.writelines(self.dump_lines(num))
+
+    def expected_lines(self, addr=EXPECTED_ADDR):
+        """
+        Yields the lines of an expected file for mem_compare.py: the start
+        address and the longs from there to the last long that is non-zero
+        (undefined bytes are 0), commented with the address every 16 bytes.
+        """
+        contents, _, offset = self.locate(addr, 4)
+        longs = [value for value, in struct.iter_unpack('>I', contents[offset:])]
+        while longs and not longs[-1]:
+            longs.pop()
+        yield f"StartAddr: 0x{addr:04X}\n"
+        for num, value in enumerate(longs):
+            line = f"L.{to_signed(value)}"
+            yield f"{line:<12}; 0x{addr + 4 * num:04X}\n" if num % 4 == 0 else line + "\n"
+
+    def write_expected(self, path, addr=EXPECTED_ADDR):
+        """
+        Writes an expected file for mem_compare.py (see expected_lines).
+        """
+        with open(path, 'w') as out_file:
+            out_file.writelines(self.expected_lines(addr))
+
+
+# Operation of each instruction, keyed like INSTRUCTION_SET: the kind of
+# operation (a factory in FACTORIES building the function that executes it)
+# and its parameters. The functions passed as parameters only use arithmetic,
+# bitwise, and comparison operators, so the same table drives the batched
+# simulator of sh2_batch.py on NumPy arrays.
+OPERATIONS = {
+    ("CLRT", ()):               ("set_t", 0),
+    ("CLRMAC", ()):             ("clear_mac",),
+    ("DIV0U", ()):              ("div0u",),
+    ("NOP", ()):                ("nop",),
+    ("RTE", ()):                ("rte",),
+    ("RTS", ()):                ("rts",),
+    ("SETT", ()):               ("set_t", 1),
+    ("SLEEP", ()):              ("sleep",),
+
+    ("CMP/PL", ("reg",)):       ("test", lambda n: to_signed(n) > 0),
+    ("CMP/PZ", ("reg",)):       ("test", lambda n: to_signed(n) >= 0),
+    ("DT", ("reg",)):           ("dt",),
+    ("MOVT", ("reg",)):         ("movt",),
+    ("ROTL", ("reg",)):         ("shift", lambda n, t: (((n << 1) | (n >> 31)) & MASK32, n >> 31)),
+    ("ROTR", ("reg",)):         ("shift", lambda n, t: ((n >> 1) | ((n & 1) << 31), n & 1)),
+    ("ROTCL", ("reg",)):        ("shift", lambda n, t: (((n << 1) | t) & MASK32, n >> 31)),
+    ("ROTCR", ("reg",)):        ("shift", lambda n, t: ((n >> 1) | (t << 31), n & 1)),
+    ("SHAL", ("reg",)):         ("shift", lambda n, t: ((n << 1) & MASK32, n >> 31)),
+    ("SHAR", ("reg",)):         ("shift", lambda n, t: ((n >> 1) | (n & SIGN32), n & 1)),
+    ("SHLL", ("reg",)):         ("shift", lambda n, t: ((n << 1) & MASK32, n >> 31)),
+    ("SHLR", ("reg",)):         ("shift", lambda n, t: (n >> 1, n & 1)),
+    ("SHLL2", ("reg",)):        ("shift", lambda n, t: ((n << 2) & MASK32, None)),
+    ("SHLR2", ("reg",)):        ("shift", lambda n, t: (n >> 2, None)),
+    ("SHLL8", ("reg",)):        ("shift", lambda n, t: ((n << 8) & MASK32, None)),
+    ("SHLR8", ("reg",)):        ("shift", lambda n, t: (n >> 8, None)),
+    ("SHLL16", ("reg",)):       ("shift", lambda n, t: ((n << 16) & MASK32, None)),
+    ("SHLR16", ("reg",)):       ("shift", lambda n, t: (n >> 16, None)),
+
+    ("STC", ("sr", "reg")):     ("store_control", "sr"),
+    ("STC", ("gbr", "reg")):    ("store_control", "gbr"),
+    ("STC", ("vbr", "reg")):    ("store_control", "vbr"),
+    ("STS", ("pr", "reg")):     ("store_control", "pr"),
+    ("TAS.B", ("mem",)):        ("tas",),
+    ("STC.L", ("sr", "dec")):   ("push_control", "sr"),
+    ("STC.L", ("gbr", "dec")):  ("push_control", "gbr"),
+    ("STC.L", ("vbr", "dec")):  ("push_control", "vbr"),
+    ("STS.L", ("pr", "dec")):   ("push_control", "pr"),
+    ("LDC", ("reg", "sr")):     ("load_control", "sr"),
+    ("LDC", ("reg", "gbr")):    ("load_control", "gbr"),
+    ("LDC", ("reg", "vbr")):    ("load_control", "vbr"),
+    ("LDS", ("reg", "pr")):     ("load_control", "pr"),
+    ("JMP", ("mem",)):          ("jump", False),
+    ("JSR", ("mem",)):          ("jump", True),
+    ("LDC.L", ("inc", "sr")):   ("pop_control", "sr"),
+    ("LDC.L", ("inc", "gbr")):  ("pop_control", "gbr"),
+    ("LDC.L", ("inc", "vbr")):  ("pop_control", "vbr"),
+    ("LDS.L", ("inc", "pr")):   ("pop_control", "pr"),
+    ("BRAF", ("reg",)):         ("branch_far", False),
+    ("BSRF", ("reg",)):         ("branch_far", True),
+
+    ("ADD", ("reg", "reg")):    ("alu", lambda n, m: n + m),
+    ("ADDC", ("reg", "reg")):   ("carry", lambda n, m, t: (n + m + t, n + m + t > MASK32)),
+    ("ADDV", ("reg", "reg")):   ("carry", lambda n, m, t: (n + m, overflow(to_signed(n) + to_signed(m)))),
+    ("AND", ("reg", "reg")):    ("alu", lambda n, m: n & m),
+    ("CMP/EQ", ("reg", "reg")): ("compare", lambda n, m: n == m),
+    ("CMP/HS", ("reg", "reg")): ("compare", lambda n, m: n >= m),
+    ("CMP/GE", ("reg", "reg")): ("compare", lambda n, m: to_signed(n) >= to_signed(m)),
+    ("CMP/HI", ("reg", "reg")): ("compare", lambda n, m: n > m),
+    ("CMP/GT", ("reg", "reg")): ("compare", lambda n, m: to_signed(n) > to_signed(m)),
+    ("CMP/STR", ("reg", "reg")): ("compare", same_byte),
+    ("EXTS.B", ("reg", "reg")): ("alu", lambda n, m: sext(m, 1)),
+    ("EXTS.W", ("reg", "reg")): ("alu", lambda n, m: sext(m, 2)),
+    ("EXTU.B", ("reg", "reg")): ("alu", lambda n, m: m & 0xFF),
+    ("EXTU.W", ("reg", "reg")): ("alu", lambda n, m: m & 0xFFFF),
+    ("MOV", ("reg", "reg")):    ("alu", lambda n, m: m),
+    ("NEG", ("reg", "reg")):    ("alu", lambda n, m: -m),
+    ("NEGC", ("reg", "reg")):   ("carry", lambda n, m, t: (-m - t, m + t > 0)),
+    ("NOT", ("reg", "reg")):    ("alu", lambda n, m: ~m),
+    ("OR", ("reg", "reg")):     ("alu", lambda n, m: n | m),
+    ("SUB", ("reg", "reg")):    ("alu", lambda n, m: n - m),
+    ("SUBC", ("reg", "reg")):   ("carry", lambda n, m, t: (n - m - t, n < m + t)),
+    ("SUBV", ("reg", "reg")):   ("carry", lambda n, m, t: (n - m, overflow(to_signed(n) - to_signed(m)))),
+    ("SWAP.B", ("reg", "reg")): ("alu", lambda n, m: (m & 0xFFFF0000) | ((m & 0xFF) << 8) | ((m >> 8) & 0xFF)),
+    ("SWAP.W", ("reg", "reg")): ("alu", lambda n, m: (m << 16) | (m >> 16)),
+    ("TST", ("reg", "reg")):    ("compare", lambda n, m: n & m == 0),
+    ("XOR", ("reg", "reg")):    ("alu", lambda n, m: n ^ m),
+    ("XTRCT", ("reg", "reg")):  ("alu", lambda n, m: (m << 16) | (n >> 16)),
+
+    ("MOV.B", ("reg", "mem")):          ("store", 1, "mem"),
+    ("MOV.W", ("reg", "mem")):          ("store", 2, "mem"),
+    ("MOV.L", ("reg", "mem")):          ("store", 4, "mem"),
+    ("MOV.B", ("mem", "reg")):          ("load", 1, "mem"),
+    ("MOV.W", ("mem", "reg")):          ("load", 2, "mem"),
+    ("MOV.L", ("mem", "reg")):          ("load", 4, "mem"),
+    ("MOV.B", ("inc", "reg")):          ("load", 1, "inc"),
+    ("MOV.W", ("inc", "reg")):          ("load", 2, "inc"),
+    ("MOV.L", ("inc", "reg")):          ("load", 4, "inc"),
+    ("MOV.B", ("reg", "dec")):          ("store", 1, "dec"),
+    ("MOV.W", ("reg", "dec")):          ("store", 2, "dec"),
+    ("MOV.L", ("reg", "dec")):          ("store", 4, "dec"),
+    ("MOV.B", ("reg", "r0_indexed")):   ("store", 1, "r0_indexed"),
+    ("MOV.W", ("reg", "r0_indexed")):   ("store", 2, "r0_indexed"),
+    ("MOV.L", ("reg", "r0_indexed")):   ("store", 4, "r0_indexed"),
+    ("MOV.B", ("r0_indexed", "reg")):   ("load", 1, "r0_indexed"),
+    ("MOV.W", ("r0_indexed", "reg")):   ("load", 2, "r0_indexed"),
+    ("MOV.L", ("r0_indexed", "reg")):   ("load", 4, "r0_indexed"),
+    ("MOV.B", ("indexed", "reg")):      ("load", 1, "indexed"),
+    ("MOV.W", ("indexed", "reg")):      ("load", 2, "indexed"),
+    ("MOV.B", ("reg", "indexed")):      ("store", 1, "indexed"),
+    ("MOV.W", ("reg", "indexed")):      ("store", 2, "indexed"),
+    ("MOV.L", ("reg", "indexed")):      ("store", 4, "indexed"),
+    ("MOV.L", ("indexed", "reg")):      ("load", 4, "indexed"),
+    ("MOV.B", ("reg", "indexed_gbr")):  ("store", 1, "indexed_gbr"),
+    ("MOV.W", ("reg", "indexed_gbr")):  ("store", 2, "indexed_gbr"),
+    ("MOV.L", ("reg", "indexed_gbr")):  ("store", 4, "indexed_gbr"),
+    ("MOV.B", ("indexed_gbr", "reg")):  ("load", 1, "indexed_gbr"),
+    ("MOV.W", ("indexed_gbr", "reg")):  ("load", 2, "indexed_gbr"),
+    ("MOV.L", ("indexed_gbr", "reg")):  ("load", 4, "indexed_gbr"),
+    ("MOVA", ("indexed_pc", "reg")):    ("mova",),
+
+    ("BF", ("label",)):         ("branch", 0, False),
+    ("BF/S", ("label",)):       ("branch", 0, True),
+    ("BT", ("label",)):         ("branch", 1, False),
+    ("BT/S", ("label",)):       ("branch", 1, True),
+    ("BRA", ("label",)):        ("branch_always", False),
+    ("BSR", ("label",)):        ("branch_always", True),
+    ("MOV.W", ("indexed_pc", "reg")):   ("load", 2, "indexed_pc"),
+    ("MOV.L", ("indexed_pc", "reg")):   ("load", 4, "indexed_pc"),
+
+    ("AND.B", ("imm", "indexed_r0_gbr")):   ("gbr_byte", lambda value, imm: value & imm),
+    ("OR.B", ("imm", "indexed_r0_gbr")):    ("gbr_byte", lambda value, imm: value | imm),
+    ("TST.B", ("imm", "indexed_r0_gbr")):   ("gbr_test", lambda value, imm: value & imm == 0),
+    ("XOR.B", ("imm", "indexed_r0_gbr")):   ("gbr_byte", lambda value, imm: value ^ imm),
+    ("AND", ("imm", "reg")):    ("alu_imm", lambda n, imm: n & imm),
+    ("CMP/EQ", ("imm", "reg")): ("compare_imm", lambda n, imm: n == imm),
+    ("OR", ("imm", "reg")):     ("alu_imm", lambda n, imm: n | imm),
+    ("TST", ("imm", "reg")):    ("compare_imm", lambda n, imm: n & imm == 0),
+    ("XOR", ("imm", "reg")):    ("alu_imm", lambda n, imm: n ^ imm),
+    ("TRAPA", ("imm",)):        ("trapa",),
+
+    ("ADD", ("imm", "reg")):    ("alu_imm", lambda n, imm: n + imm),
+    ("MOV", ("imm", "reg")):    ("alu_imm", lambda n, imm: imm),
+}
+
+# Every instruction the assembler encodes can be executed
+assert OPERATIONS.keys() == INSTRUCTION_SET.keys()
+
+
+# Factories of the functions executing each kind of operation. Each function
+# is called with the simulator, the address of the instruction, and its
+# predecoded operands in order (registers by number, sign-extended
+# immediates, scaled displacements, and absolute branch targets and PC
+# relative addresses), and returns the address of the next instruction.
+# Delayed branches set the simulator's delayed target instead.
+
+def alu(func):
+    """
+    Rn = func(Rn, Rm) for register-register operations.
+    """
+    def execute(cpu, pc, m, n):
+        cpu.r[n] = func(cpu.r[n], cpu.r[m]) & MASK32
+        return pc + 2
+    return execute
+
+
+def alu_imm(func):
+    """
+    Rn = func(Rn, imm) for immediate operations.
+    """
+    def execute(cpu, pc, imm, n):
+        cpu.r[n] = func(cpu.r[n], imm) & MASK32
+        return pc + 2
+    return execute
+
+
+def compare(pred):
+    """
+    T = pred(Rn, Rm) for register compares and tests.
+    """
+    def execute(cpu, pc, m, n):
+        cpu.set_t(pred(cpu.r[n], cpu.r[m]))
+        return pc + 2
+    return execute
+
+
+def compare_imm(pred):
+    """
+    T = pred(Rn, imm) for compares and tests with an immediate.
+    """
+    def execute(cpu, pc, imm, n):
+        cpu.set_t(pred(cpu.r[n], imm))
+        return pc + 2
+    return execute
+
+
+def test(pred):
+    """
+    T = pred(Rn) for compares of a register with zero.
+    """
+    def execute(cpu, pc, n):
+        cpu.set_t(pred(cpu.r[n]))
+        return pc + 2
+    return execute
+
+
+def shift(func):
+    """
+    Rn, T = func(Rn, T) for shifts and rotates (T is None for those that
+    leave T unchanged).
+    """
+    def execute(cpu, pc, n):
+        cpu.r[n], t = func(cpu.r[n], cpu.t)
+        if t is not None:
+            cpu.set_t(t)
+        return pc + 2
+    return execute
+
+
+def carry(func):
+    """
+    Rn, T = func(Rn, Rm, T) for the operations with carry, borrow, or overflow.
+    """
+    def execute(cpu, pc, m, n):
+        result, t = func(cpu.r[n], cpu.r[m], cpu.t)
+        cpu.r[n] = result & MASK32
+        cpu.set_t(t)
+        return pc + 2
+    return execute
+
+
+def load(size, mode):
+    """
+    Loads (sign-extended) for each addressing mode of the source.
+    """
+    def mem(cpu, pc, m, n):
+        cpu.r[n] = sext(cpu.read(cpu.r[m], size), size)
+        return pc + 2
+
+    def inc(cpu, pc, m, n):
+        value = sext(cpu.read(cpu.r[m], size), size)
+        cpu.r[m] = (cpu.r[m] + size) & MASK32
+        cpu.r[n] = value
+        return pc + 2
+
+    def r0_indexed(cpu, pc, m, n):
+        cpu.r[n] = sext(cpu.read(cpu.r[0] + cpu.r[m], size), size)
+        return pc + 2
+
+    def indexed(cpu, pc, disp, m, n):
+        cpu.r[n] = sext(cpu.read(cpu.r[m] + disp, size), size)
+        return pc + 2
+
+    def indexed_gbr(cpu, pc, disp, n):
+        cpu.r[n] = sext(cpu.read(cpu.gbr + disp, size), size)
+        return pc + 2
+
+    def indexed_pc(cpu, pc, addr, n):
+        cpu.r[n] = sext(cpu.read(addr, size), size)
+        return pc + 2
+
+    return {"mem": mem, "inc": inc, "r0_indexed": r0_indexed, "indexed": indexed,
+            "indexed_gbr": indexed_gbr, "indexed_pc": indexed_pc}[mode]
+
+
+def store(size, mode):
+    """
+    Stores for each addressing mode of the destination.
+    """
+    def mem(cpu, pc, m, n):
+        cpu.write(cpu.r[n], size, cpu.r[m])
+        return pc + 2
+
+    def dec(cpu, pc, m, n):
+        value = cpu.r[m]
+        cpu.r[n] = (cpu.r[n] - size) & MASK32
+        cpu.write(cpu.r[n], size, value)
+        return pc + 2
+
+    def r0_indexed(cpu, pc, m, n):
+        cpu.write(cpu.r[0] + cpu.r[n], size, cpu.r[m])
+        return pc + 2
+
+    def indexed(cpu, pc, m, disp, n):
+        cpu.write(cpu.r[n] + disp, size, cpu.r[m])
+        return pc + 2
+
+    def indexed_gbr(cpu, pc, m, disp):
+        cpu.write(cpu.gbr + disp, size, cpu.r[m])
+        return pc + 2
+
+    return {"mem": mem, "dec": dec, "r0_indexed": r0_indexed, "indexed": indexed,
+            "indexed_gbr": indexed_gbr}[mode]
+
+
+def store_control(name):
+    """
+    STC/STS: Rn = the control or system register.
+    """
+    def execute(cpu, pc, n):
+        cpu.r[n] = getattr(cpu, name)
+        return pc + 2
+    return execute
+
+
+def push_control(name):
+    """
+    STC.L/STS.L: the control or system register to @-Rn.
+    """
+    def execute(cpu, pc, n):
+        cpu.r[n] = (cpu.r[n] - 4) & MASK32
+        cpu.write(cpu.r[n], 4, getattr(cpu, name))
+        return pc + 2
+    return execute
+
+
+def load_control(name):
+    """
+    LDC/LDS: the control or system register = Rm.
+    """
+    def execute(cpu, pc, m):
+        setattr(cpu, name, cpu.r[m])
+        return pc + 2
+    return execute
+
+
+def pop_control(name):
+    """
+    LDC.L/LDS.L: the control or system register = @Rm+.
+    """
+    def execute(cpu, pc, m):
+        setattr(cpu, name, cpu.read(cpu.r[m], 4))
+        cpu.r[m] = (cpu.r[m] + 4) & MASK32
+        return pc + 2
+    return execute
+
+
+def gbr_byte(func):
+    """
+    Read-modify-write of the byte at @(R0, GBR): byte = func(byte, imm).
+    """
+    def execute(cpu, pc, imm):
+        addr = cpu.gbr + cpu.r[0]
+        cpu.write(addr, 1, func(cpu.read(addr, 1), imm))
+        return pc + 2
+    return execute
+
+
+def gbr_test(pred):
+    """
+    T = pred(byte, imm) for the byte at @(R0, GBR).
+    """
+    def execute(cpu, pc, imm):
+        cpu.set_t(pred(cpu.read(cpu.gbr + cpu.r[0], 1), imm))
+        return pc + 2
+    return execute
+
+
+def branch(taken_if, delayed):
+    """
+    Conditional branches taken when T == taken_if (with or without a slot).
+    """
+    def execute(cpu, pc, target):
+        if cpu.t != taken_if:
+            return pc + 2
+        if delayed:
+            cpu.delayed = target
+            return pc + 2
+        return target
+    return execute
+
+
+def branch_always(link):
+    """
+    BRA/BSR: delayed branch to the label (saving the call's address in PR).
+    """
+    def execute(cpu, pc, target):
+        cpu.delayed = target
+        if link:
+            cpu.pr = pc + PR_OFFSET
+        return pc + 2
+    return execute
+
+
+def branch_far(link):
+    """
+    BRAF/BSRF: delayed branch to PC + Rm.
+    """
+    def execute(cpu, pc, m):
+        cpu.delayed = (pc + PC_OFFSET + cpu.r[m]) & MASK32
+        if link:
+            cpu.pr = pc + PR_OFFSET
+        return pc + 2
+    return execute
+
+
+def jump(link):
+    """
+    JMP/JSR: delayed jump to @Rm.
+    """
+    def execute(cpu, pc, m):
+        cpu.delayed = cpu.r[m]
+        if link:
+            cpu.pr = pc + PR_OFFSET
+        return pc + 2
+    return execute
+
+
+def set_t(t):
+    """
+    CLRT/SETT.
+    """
+    def execute(cpu, pc):
+        cpu.set_t(t)
+        return pc + 2
+    return execute
+
+
+def nop():
+    return lambda cpu, pc: pc + 2
+
+
+def sleep():
+    def execute(cpu, pc):
+        cpu.halted = True
+        return pc
+    return execute
+
+
+def clear_mac():
+    def execute(cpu, pc):
+        cpu.mach = cpu.macl = 0
+        return pc + 2
+    return execute
+
+
+def div0u():
+    def execute(cpu, pc):
+        cpu.sr &= ~SR_MQ
+        cpu.set_t(0)
+        return pc + 2
+    return execute
+
+
+def rts():
+    def execute(cpu, pc):
+        cpu.delayed = (cpu.pr + RTS_OFFSET) & MASK32
+        return pc + 2
+    return execute
+
+
+def rte():
+    def execute(cpu, pc):
+        cpu.delayed = cpu.pop()
+        cpu.sr = cpu.pop()
+        return pc + 2
+    return execute
+
+
+def trapa():
+    def execute(cpu, pc, imm):
+        cpu.push(cpu.sr)
+        cpu.push(pc + 2)
+        return cpu.read(cpu.vbr + 4 * imm, 4)
+    return execute
+
+
+def dt():
+    def execute(cpu, pc, n):
+        cpu.r[n] = (cpu.r[n] - 1) & MASK32
+        cpu.set_t(cpu.r[n] == 0)
+        return pc + 2
+    return execute
+
+
+def movt():
+    def execute(cpu, pc, n):
+        cpu.r[n] = cpu.t
+        return pc + 2
+    return execute
+
+
+def tas():
+    def execute(cpu, pc, n):
+        value = cpu.read(cpu.r[n], 1)
+        cpu.set_t(value == 0)
+        cpu.write(cpu.r[n], 1, value | 0x80)
+        return pc + 2
+    return execute
+
+
+def mova():
+    def execute(cpu, pc, addr, n):
+        cpu.r[0] = addr & MASK32
+        return pc + 2
+    return execute
+
+
+FACTORIES = {
+    "alu": alu, "alu_imm": alu_imm, "compare": compare, "compare_imm": compare_imm,
+    "test": test, "shift": shift, "carry": carry, "load": load, "store": store,
+    "store_control": store_control, "push_control": push_control,
+    "load_control": load_control, "pop_control": pop_control,
+    "gbr_byte": gbr_byte, "gbr_test": gbr_test, "branch": branch,
+    "branch_always": branch_always, "branch_far": branch_far, "jump": jump,
+    "set_t": set_t, "nop": nop, "sleep": sleep, "clear_mac": clear_mac,
+    "div0u": div0u, "rts": rts, "rte": rte, "trapa": trapa, "dt": dt,
+    "movt": movt, "tas": tas, "mova": mova,
+}
+
+# Function executing each instruction
+EXECUTE = {key: FACTORIES[kind](*params) for key, (kind, *params) in OPERATIONS.items()}
+
+
+def read_mem_file(path):
+    """
+    Reads a memory file: a text file of 16-bit binary strings (as written by
+    the assembler or memory.vhd; comments after ';' are ignored) or a raw
+    .bin image.
+
+    Returns:
+        tuple: (contents, defined) bytearrays, bytes with X bits undefined
+    """
+    if path.endswith(".bin"):
+        with open(path, 'rb') as in_file:
+            contents = bytearray(in_file.read())
+        return contents, bytearray(b"\1" * len(contents))
+
+    contents, defined = bytearray(), bytearray()
+    with open(path, 'r') as in_file:
+        for line in in_file:
+            bits = line.split(';')[0].strip()
+            for byte in (bits[:8], bits[8:16]):
+                if byte:
+                    known = set(byte) <= {'0', '1'}
+                    contents.append(int(byte, 2) if known else 0)
+                    defined.append(known)
+    return contents, defined
+
+
+def load_build(build_dir):
+    """
+    Loads the memory files of a build directory into a simulator (the text
+    files, or else the .bin images; blocks without a file are undefined).
+
+    Args:
+        build_dir (str): directory holding build_mem0.txt etc.
+
+    Returns:
+        Simulator: the reset CPU with the program loaded
+    """
+    sim = Simulator([(addr, None) for addr, _ in MEM_BLOCKS])
+    for num, (_, contents, defined) in enumerate(sim.blocks):
+        for fmt in ("text", "bin"):
+            path = os.path.join(build_dir, OUTPUT_FILES[fmt][num])
+            if os.path.exists(path):
+                data, known = read_mem_file(path)
+                size = min(len(data), len(contents))
+                contents[:size] = data[:size]
+                defined[:size] = known[:size]
+                break
+    return sim
+
+
+def load_program(path, optimize=()):
+    """
+    Loads a program into a simulator: assembled from its source, or from the
+    memory files of a build directory.
+
+    Args:
+        path (str): assembly source or build directory
+        optimize (tuple): assembler optimizations to assemble with
+
+    Returns:
+        Simulator: the reset CPU with the program loaded
+    """
+    if os.path.isdir(path):
+        return load_build(path)
+    return Simulator(mem_blocks(assemble_file(path, keep_source=False, optimize=optimize)))
+
+
+def print_state(sim):
+    """
+    Prints the registers of the simulator.
+    """
+    for row in range(0, 16, 4):
+        print("  ".join(f"R{num:<2} {sim.r[num]:08X}" for num in range(row, row + 4)))
+    print(f"SR  {sim.sr:08X}  GBR {sim.gbr:08X}  VBR {sim.vbr:08X}  PR  {sim.pr:08X}")
+    print(f"PC  {sim.pc:08X}  MACH {sim.mach:08X} MACL {sim.macl:08X}")
+
+
+def main(argv):
+    """
+    Command line entry point. Runs a program and writes its memory dumps (and
+    optionally an expected file).
+    """
+    parser = argparse.ArgumentParser(prog="sh2_sim.py", description="SH-2 Instruction Set Simulator")
+    parser.add_argument("program", help="assembly source or build directory to run")
+    parser.add_argument("--dump-dir", default=DUMP_DIR,
+                        help=f"directory to write the memory dumps to (default {DUMP_DIR})")
+    parser.add_argument("--no-dump", action="store_true", help="do not write the memory dumps")
+    parser.add_argument("--expected", help="expected file to write for mem_compare.py")
+    parser.add_argument("--expected-addr", type=lambda val: int(val, 0), default=EXPECTED_ADDR,
+                        help="address the expected file starts at (default 0x%(default)04X)")
+    parser.add_argument("--max-steps", type=int, default=MAX_STEPS,
+                        help="instructions executed before giving up (default %(default)d)")
+    parser.add_argument("--trace", action="store_true", help="print each instruction executed")
+    parser.add_argument("-O", "--optimize", action="append", default=[],
+                        help="assembler optimization to assemble the source with")
+    args = parser.parse_args(argv[1:])
+
+    def trace(addr, word):
+        print(f"  0x{addr:08X} {word:04X}  {disassemble_word(word, addr)}")
+
+    try:
+        sim = load_program(args.program, tuple(args.optimize))
+    except (OSError, ValueError) as err:
+        print(f"Error: {err}")
+        return 1
+
+    # The memory is dumped even if the program stops early, as the testbench
+    # dumps it after a fixed time
+    status = 0
+    try:
+        sim.run(args.max_steps, trace if args.trace else None)
+        print(f"Halted at 0x{sim.pc:08X} after {sim.steps} instructions")
+    except SimulationError as err:
+        print(f"Error: {err}")
+        status = 1
+    if sim.undefined_reads:
+        print(f"Warning: {sim.undefined_reads} reads of undefined memory (read as 0)")
+    print_state(sim)
+    if not args.no_dump:
+        sim.write_dumps(args.dump_dir)
+    if args.expected and not status:
+        sim.write_expected(args.expected, args.expected_addr)
+    return status
+
+
+# Main loop
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,237 @@
+"""
+Tests of sh2_asm.py: programs assembled (and linked) in-process are run on
+sh2_sim.py.
+
+Usage:
+    python -m pytest test_sh2_asm.py
+"""
+
+import glob
+import os
+
+import pytest
+
+import sh2_asm
+from sh2_asm import (analyze_hazards, assemble, assemble_file, assemble_object, link,
+                     mem_blocks)
+from sh2_pipe import BASE_CONFIG, PipelineConfig, PipelineModel, summarize
+from sh2_sim import Simulator
+
+# Test programs (sys_ctrl.asm is left out: its vector table is commented out,
+# so its TRAPA does not reach a handler) and the VHDL the pipeline model reads
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PROGRAMS = sorted(os.path.basename(path) for path in glob.glob(os.path.join(TESTS_DIR, "*.asm"))
+                  if not path.endswith("sys_ctrl.asm"))
+VHD_DIR = os.path.join(TESTS_DIR, os.pardir, "vhd")
+
+# Code between a branch and its target that no 8-bit displacement reaches
+FAR = "    NOP\n" * 300
+
+# Module whose BT is relaxed (its target is past 300 NOPs), calling a routine
+# of the module linked after it
+MODULE_A = """
+    .global Other
+    .text
+Start:
+    SETT
+    BT      Far
+""" + FAR + """
+Far:
+    BSR     Other
+    NOP
+    SLEEP
+"""
+MODULE_B = """
+    .global Other
+    .text
+Other:
+    RTS
+    MOV     #5, R0
+"""
+
+
+def run(image):
+    """
+    Runs a program on the simulator.
+
+    Returns:
+        Simulator: the CPU once the program has reached SLEEP
+    """
+    sim = Simulator(mem_blocks(image))
+    sim.run()
+    return sim
+
+
+def cycles(image, config=BASE_CONFIG):
+    """
+    Cycles a program takes on the HW3 pipeline (sh2_pipe.py).
+    """
+    timed, _ = PipelineModel(config, VHD_DIR).run(Simulator(mem_blocks(image)))
+    return summarize(timed)[0]
+
+
+def test_link_relaxed_module():
+    # The relaxed .text of the first module pushes the second one along
+    image = link([assemble_object(MODULE_A), assemble_object(MODULE_B)])
+    first, second = [sect for sect in image.sections if sect.name == ".text"]
+    assert second.addr == first.end + -first.end % second.align
+    assert image.symbols["OTHER"] == second.addr
+    assert run(image).r[0] == 5
+
+
+def test_link_undefined_symbol():
+    # A name no module defines is an error naming the reference
+    with pytest.raises(ValueError, match="Undefined symbol: OTHER"):
+        link([assemble_object(MODULE_A)])
+
+
+@pytest.mark.parametrize("op", ["BF/S", "BT/S"])
+@pytest.mark.parametrize("t", [0, 1])
+def test_relax_delayed_conditional(op, t):
+    # The slot runs whether or not the relaxed branch is taken
+    image = assemble(f"""
+    .text
+    MOV     #{t}, R0
+    CMP/EQ  #1, R0
+    {op}    Far
+    ADD     #1, R1
+    MOV     #7, R2
+    SLEEP
+""" + FAR + """
+Far:
+    MOV     #9, R2
+    SLEEP
+""")
+    assert "relaxed" in image.sections[0].source[4]
+    sim = run(image)
+    taken = t == (op == "BT/S")
+    assert (sim.r[1], sim.r[2]) == (1, 9 if taken else 7)
+
+
+@pytest.mark.parametrize("padding", ["", "    NOP\n"])
+def test_relax_bsr(monkeypatch, padding):
+    # No BSR in the four memory blocks is out of range, so the range is narrowed
+    monkeypatch.setitem(sh2_asm.BRANCH_RANGE, 12, sh2_asm.BRANCH_RANGE[8])
+    image = assemble("""
+    .text
+    MOV     #0, R15
+""" + padding + """
+    BSR     Sub
+    MOV     #3, R1
+    MOV     #4, R3
+    SLEEP
+""" + FAR + """
+Sub:
+    RTS
+    ADD     #1, R1
+""")
+    assert any("relaxed: BSR" in line for line in image.sections[0].source.values())
+    sim = run(image)
+    assert (sim.r[0], sim.r[1], sim.r[3], sim.r[15]) == (0, 4, 4, 0)
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_fill_slots_programs(program):
+    # Filling slots keeps what every test computes, and costs no cycles
+    path = os.path.join(TESTS_DIR, program)
+    plain, filled = assemble_file(path), assemble_file(path, optimize=("fill-slots",))
+    sim, other = run(plain), run(filled)
+    assert other.r[:15] == sim.r[:15]
+    assert [block[1] for block in other.blocks[1:]] == [block[1] for block in sim.blocks[1:]]
+    assert cycles(filled) <= cycles(plain)
+
+
+def test_fill_slots_backward_only():
+    # The loop's BF becomes BF/S; the forward BT, mostly not taken, stays
+    image = assemble("""
+    .text
+    MOV     #3, R1
+Loop:
+    ADD     #2, R2
+    CMP/EQ  #9, R0
+    BT      Done
+    MOV     #7, R3
+    DT      R1
+    BF      Loop
+Done:
+    SLEEP
+""", optimize=("fill-slots",))
+    assert [opt.message.split()[0] for opt in image.report] == ["BF/S"]
+    assert run(image).r[2] == 6
+
+
+@pytest.mark.parametrize("split_memory", [False, True])
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_hazards_match_pipeline(program, split_memory):
+    # The static hazards of the instructions executed add up to the cycles
+    # sh2_pipe.py charges (branch flushes when taken, slot refetches when not)
+    image = assemble_file(os.path.join(TESTS_DIR, program))
+    hazards = {}
+    for block in analyze_hazards(image, split_memory):
+        for hazard in block.hazards:
+            hazards.setdefault(hazard.addr, []).append(hazard)
+    config = PipelineConfig(split_memory, False, False)
+    timed, _ = PipelineModel(config, VHD_DIR).run(Simulator(mem_blocks(image)))
+
+    static = 0
+    for i, inst in enumerate(timed):
+        for hazard in hazards.get(inst.addr, ()):
+            if hazard.kind == "branch flush":
+                static += hazard.cycles * (timed[i + 1].addr != inst.addr + 2)
+            elif hazard.kind == "slot refetch":
+                static += hazard.cycles * (timed[i + 2].addr == inst.addr + 4)
+            else:
+                static += hazard.cycles
+    cycles, count, _ = summarize(timed)
+    assert static == cycles - count
+
+
+def test_schedule_block():
+    # The independent MOV is moved between the load and its user, and labels
+    # keep their addresses
+    image = assemble("""
+    .text
+    MOV     #8, R1
+    MOV.L   @R1, R2
+    ADD     R2, R3
+    MOV     #5, R4
+Done:
+    SLEEP
+""", optimize=("schedule",))
+    source = image.sections[0].source
+    assert [source[offset].split()[0] for offset in range(0, 8, 2)] == ["MOV", "MOV.L", "MOV", "ADD"]
+    assert [(opt.message.split(", ")[1], opt.cycles) for opt in image.report] == \
+        [("split memory load-use stalls 1 -> 0", 1)]
+    assert image.symbols["DONE"] == 8
+    sim = run(image)
+    assert (sim.r[3], sim.r[4]) == (sim.r[2], 5)
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_schedule_programs(program):
+    # Scheduling keeps what every test computes, saves the cycles it reports
+    # with split memory, and changes nothing on the HW3 memory
+    path = os.path.join(TESTS_DIR, program)
+    plain, scheduled = assemble_file(path), assemble_file(path, optimize=("schedule",))
+    sim, other = run(plain), run(scheduled)
+    assert other.r[:15] == sim.r[:15]
+    assert [block[1] for block in other.blocks[1:]] == [block[1] for block in sim.blocks[1:]]
+    split = PipelineConfig(True, False, False)
+    saved = sum(opt.cycles for opt in scheduled.report)
+    assert cycles(plain, split) - cycles(scheduled, split) == saved
+    assert cycles(scheduled) == cycles(plain)
+
+
+@pytest.mark.parametrize("op", ["MOV", "ADD"])
+def test_signed_immediate_pattern(op):
+    # 0x80 to 0xFF are the byte pattern of a sign-extended immediate
+    with pytest.warns(UserWarning, match=f"line 3: {op} #255 is sign-extended to -1"):
+        image = assemble(f"""
+    .text
+    {op}     #0xFF, R0
+    CMP/EQ  #-1, R0
+    MOVT    R2
+    SLEEP
+""")
+    sim = run(image)
+    assert (sim.r[0], sim.r[2]) == (0xFFFFFFFF, 1)
@@ -0,0 +1,63 @@
+"""
+Tests of sh2_disasm.py: the output of the disassembler is assembled again and
+must give back the same words, for every section of each test program and for
+all 65,536 words.
+
+Usage:
+    python -m pytest test_sh2_disasm.py
+"""
+
+import glob
+import os
+import struct
+
+import pytest
+
+from sh2_asm import assemble, assemble_file
+from sh2_disasm import disassemble
+
+# Test programs
+TESTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PROGRAMS = sorted(os.path.basename(path) for path in glob.glob(os.path.join(TESTS_DIR, "*.asm")))
+
+# Words assembled at once (a memory block), and the address of the words that
+# are not from a program
+CHECK_WORDS = 512
+CHECK_ADDR = 0x800
+
+
+def round_trip(words, addr):
+    """
+    Disassembles words and assembles the result again.
+
+    Args:
+        words (list[int]): instruction words (at most a memory block)
+        addr (int): address of the first word
+
+    Returns:
+        list[tuple]: (address, word, text, word assembled from text) of every
+                     word that did not survive the round trip
+    """
+    lines = [text for _, _, text in disassemble(words, addr)]
+    image = assemble([f".section .text, 0x{addr:X}"] + lines)
+    data = image.sections[0].data if image.sections else b''
+    again = [word for word, in struct.iter_unpack('>H', data)]
+    return [(addr + 2 * i, word, text, again[i] if i < len(again) else None)
+            for i, (word, text) in enumerate(zip(words, lines))
+            if i >= len(again) or again[i] != word]
+
+
+@pytest.mark.parametrize("program", PROGRAMS)
+def test_round_trip_program(program):
+    # Every section of the assembled program, a block at a time
+    for sect in assemble_file(os.path.join(TESTS_DIR, program)).sections:
+        data = sect.data[:len(sect.data) & ~1]
+        words = [word for word, in struct.iter_unpack('>H', data)]
+        for start in range(0, len(words), CHECK_WORDS):
+            assert round_trip(words[start:start + CHECK_WORDS], sect.addr + 2 * start) == []
+
+
+@pytest.mark.parametrize("start", range(0, 0x10000, CHECK_WORDS))
+def test_round_trip_words(start):
+    # Every instruction word (and .word for those that are not instructions)
+    assert round_trip(list(range(start, start + CHECK_WORDS)), CHECK_ADDR) == []
@@ -0,0 +1,80 @@
+"""
+Tests of sh2_lockstep.py on a waveform written for a BSR/RTS pair.
+
+Usage:
+    python -m pytest test_sh2_lockstep.py
+"""
+
+from sh2_asm import assemble, mem_blocks
+from sh2_lockstep import REGISTERS, SIGNALS, compare, read_waveform, registers_of, run_reference
+from sh2_sim import Simulator
+
+# Program calling a subroutine: PR is 0x2 after the BSR (its address plus 2)
+PROGRAM = """
+    .text
+    BSR     Sub
+    NOP
+    SLEEP
+Sub:
+    RTS
+    NOP
+"""
+
+# Instructions entering ID, a cycle each (SLEEP stays in ID), and PR as HW3
+# stores it: the address of the BSR plus 2
+CYCLES = [0x0, 0x2, 0x6, 0x8] + [0x4] * 8
+HW_PR = 0x2
+
+
+def write_vcd(path, words, pr):
+    """
+    Writes a waveform of the program: the signals sh2_lockstep.py reads, with
+    pr written to PR at the third rising edge.
+    """
+    names = {key: name.split(".")[1] for key, name in SIGNALS.items()}
+    codes = {key: chr(ord("!") + num) for num, key in enumerate(SIGNALS)}
+    lines = ["$scope module tb_sh2_cpu $end", "$scope module uut $end"]
+    lines += [f"$var wire 32 {codes[key]} {names[key]} $end" for key in SIGNALS]
+    lines += ["$upscope $end", "$upscope $end", "$enddefinitions $end"]
+
+    constant = {"flush": "0", "reg_store": "0", "ax_store": "0", "sr": "b0", "gbr": "b0",
+                "vbr": "b0", "ab": "b0", "db": "b0", "we0": "1", "we1": "1", "we2": "1", "we3": "1"}
+    for num, addr in enumerate(CYCLES):
+        values = {"clock": "1", "pc": f"b{addr:b}", "ir": f"b{words[addr]:b}",
+                  "pr": f"b{pr if num >= 2 else 0:b}"}
+        if num == 0:
+            values.update(constant)
+        lines.append(f"#{10 * num}")
+        lines += [f"{value} {codes[key]}" if value[0] == "b" else f"{value}{codes[key]}"
+                  for key, value in values.items()]
+        lines += [f"#{10 * num + 5}", f"0{codes['clock']}"]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def lockstep(tmp_path, pr):
+    """
+    Compares the simulator with a waveform of the program.
+    """
+    sim = Simulator(mem_blocks(assemble(PROGRAM)))
+    words = {addr: sim.read(addr, 2) for addr in set(CYCLES)}
+    initial = dict(zip(REGISTERS, registers_of(sim)))
+    reference, error = run_reference(sim)
+    assert error is None
+
+    path = tmp_path / "bsr_rts.vcd"
+    write_vcd(path, words, pr)
+    return compare(reference, read_waveform(str(path), 0, initial))
+
+
+def test_bsr_rts_pr(tmp_path):
+    # PR written by the BSR matches the simulator as it is
+    divergence, compared = lockstep(tmp_path, HW_PR)
+    assert divergence is None
+    assert compared == 5
+
+
+def test_pr_diverges(tmp_path):
+    # A PR of the return address (the SH-2 manual's) is a divergence
+    divergence, _ = lockstep(tmp_path, HW_PR + 2)
+    assert divergence is not None
+    assert "PR = 0x00000004" in divergence.message
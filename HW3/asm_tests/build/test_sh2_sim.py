@@ -0,0 +1,69 @@
+"""
+Tests of sh2_sim.py: small programs assembled in-process are run and the
+registers they leave behind are checked against the HW3 CPU.
+
+Usage:
+    python -m pytest test_sh2_sim.py
+"""
+
+import pytest
+
+from sh2_asm import assemble, mem_blocks
+from sh2_batch import BatchSimulator
+from sh2_sim import Simulator
+
+
+def run(source):
+    """
+    Runs a program on the simulator and on a batch of one lane.
+
+    Returns:
+        Simulator: the CPU once the program has reached SLEEP (the batch lane
+                   having left the same registers)
+    """
+    blocks = mem_blocks(assemble(source))
+    sim = Simulator(blocks)
+    sim.run()
+    batch = BatchSimulator([Simulator(blocks)])
+    batch.run()
+    lane = batch.simulator(0)
+    assert (lane.r, lane.pr) == (sim.r, sim.pr)
+    return sim
+
+
+@pytest.mark.parametrize("call", ["BSR     Sub", "JSR     @R1", "BSRF    R2"])
+def test_call_saves_address_plus_2(call):
+    # HW3 saves the address of the call plus 2 in PR (PRSel_PC in pau.vhd),
+    # and RTS adds 2 back to return past the delay slot
+    sim = run(f"""
+    .text
+    MOV     #Sub, R1
+    MOV     #Sub - Call, R2
+Call:
+    {call}
+    NOP
+    MOV     #3, R4
+    SLEEP
+Sub:
+    STS     PR, R3
+    RTS
+    NOP
+""")
+    assert (sim.r[3], sim.r[4]) == (6, 3)
+
+
+def test_rts_returns_to_pr_plus_2():
+    # An RTS after LDS Rm, PR returns to Rm + 2
+    sim = run("""
+    .text
+    MOV     #Back - 2, R1
+    LDS     R1, PR
+    RTS
+    NOP
+    MOV     #1, R0
+Back:
+    MOV     #2, R0
+    SLEEP
+""")
+    assert sim.r[0] == 2
+    assert sim.pr == 8
@@ -0,0 +1,138 @@
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+;                                                                             ;
+;                             SH-2 Test Runtime                               ;
+;                                                                             ;
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+; Description :
+;   Startup code, trap vector table, and memory routines shared by programs
+;   linked with sh2_asm.py --link. The runtime is linked before the other
+;   modules, so __start is placed at 0x0 where the CPU starts executing.
+;   A linked program defines main (.global main), which is called with the
+;   stack pointer R15 at the top of memory and returns with RTS; the program
+;   then ends with SLEEP.
+;
+; Routines (arguments in R4-R6, result in R0; R1, R2, R5, and R6 are not
+; preserved):
+;   memcpy(R4 dst, R5 src, R6 n) : copies n bytes from src to dst, returns dst
+;   memset(R4 dst, R5 byte, R6 n): fills n bytes at dst with byte, returns dst
+;   Both move longs when dst, src, and n are multiples of 4, and bytes
+;   otherwise. Loads are scheduled away from the instructions using them.
+;
+; Traps:
+;   TRAPA #0 ends the program; TRAPA #1 through #7 return immediately.
+;
+; Revision History:
+;   17 Oct 26   Initial revision
+;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;;
+
+    .global __start, __exit, __vectors, __trap_return, memcpy, memset
+
+.text
+
+;;--------------------------------------------------------------------------
+;; __start: Set up the trap vectors and stack, then call main
+;;--------------------------------------------------------------------------
+__start:
+    MOV.L   =__vectors, R0
+    LDC     R0, VBR         ; TRAPA vectors
+    MOV     #0, R15         ; stack grows down from the top of memory
+    MOV.L   =main, R0
+    JSR     @R0
+    NOP
+__exit:
+    SLEEP
+
+;;--------------------------------------------------------------------------
+;; __trap_return: Handler of the traps that do nothing
+;;--------------------------------------------------------------------------
+__trap_return:
+    RTE
+    NOP
+
+;;--------------------------------------------------------------------------
+;; memcpy: Copy R6 bytes from @R5 to @R4, returning R4 in R0
+;;--------------------------------------------------------------------------
+memcpy:
+    MOV     R4, R0
+    OR      R5, R0
+    OR      R6, R0
+    TST     #3, R0          ; T = dst, src, and n are multiples of 4
+    BF/S    MemcpyBytes
+    MOV     R4, R1          ; R1 = next byte of dst
+    SHLR2   R6              ; R6 = longs to copy
+    TST     R6, R6
+    BT      MemcpyDone
+MemcpyLongs:
+    MOV.L   @R5+, R2
+    DT      R6
+    MOV.L   R2, @R1
+    BF/S    MemcpyLongs
+    ADD     #4, R1
+MemcpyDone:
+    RTS
+    MOV     R4, R0
+
+MemcpyBytes:
+    TST     R6, R6
+    BT      MemcpyDone
+MemcpyByteLoop:
+    MOV.B   @R5+, R2
+    DT      R6
+    MOV.B   R2, @R1
+    BF/S    MemcpyByteLoop
+    ADD     #1, R1
+    RTS
+    MOV     R4, R0
+
+;;--------------------------------------------------------------------------
+;; memset: Fill R6 bytes at @R4 with the byte in R5, returning R4 in R0
+;;--------------------------------------------------------------------------
+memset:
+    MOV     R4, R0
+    OR      R6, R0
+    TST     #3, R0          ; T = dst and n are multiples of 4
+    BF/S    MemsetBytes
+    MOV     R4, R1          ; R1 = next byte of dst
+    EXTU.B  R5, R5          ; replicate the byte into a long
+    MOV     R5, R0
+    SHLL8   R0
+    OR      R0, R5
+    MOV     R5, R0
+    SHLL16  R0
+    OR      R0, R5
+    SHLR2   R6              ; R6 = longs to fill
+    TST     R6, R6
+    BT      MemsetDone
+MemsetLongs:
+    DT      R6
+    MOV.L   R5, @R1
+    BF/S    MemsetLongs
+    ADD     #4, R1
+MemsetDone:
+    RTS
+    MOV     R4, R0
+
+MemsetBytes:
+    TST     R6, R6
+    BT      MemsetDone
+MemsetByteLoop:
+    DT      R6
+    MOV.B   R5, @R1
+    BF/S    MemsetByteLoop
+    ADD     #1, R1
+    RTS
+    MOV     R4, R0
+
+;;--------------------------------------------------------------------------
+;; __vectors: TRAPA vector table (VBR + 4 * imm)
+;;--------------------------------------------------------------------------
+    .align  4
+__vectors:
+    .long   __exit          ; TRAPA #0: end the program
+    .long   __trap_return   ; TRAPA #1
+    .long   __trap_return   ; TRAPA #2
+    .long   __trap_return   ; TRAPA #3
+    .long   __trap_return   ; TRAPA #4
+    .long   __trap_return   ; TRAPA #5
+    .long   __trap_return   ; TRAPA #6
+    .long   __trap_return   ; TRAPA #7
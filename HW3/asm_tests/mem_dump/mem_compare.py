@@ -5,150 +5,298 @@ Compares expected memory values from an SH-2 assembly test case against the actu
 memory contents dumped during simulation from memory.vhd.
 
 Usage:
-    python mem_compare.py <test_name>
+    python mem_compare.py <test_name> [--dump-dir DIR] [--expected FILE] [--rows N]
 
 Where <test_name> refers to the base name (without extension) of the test case file,
 used to locate the expected memory output file:
     ../asm_tests/expected/<test_name>_exp.txt
 
 Expected input files:
-- ../asm_tests/build/build_mem0.txt    # Program memory from assembler
-- ../asm_tests/build/build_mem1.txt    # Data memory from assembler
-- ../asm_tests/mem_dump/dump0.txt      # Program memory from simulation
-- ../asm_tests/mem_dump/dump1.txt      # Data memory from simulation
+- ../asm_tests/mem_dump/dump0.txt      # Block 0 (0x00000000, program memory)
+- ../asm_tests/mem_dump/dump1.txt      # Block 1 (0x00000400, data memory)
+- ../asm_tests/mem_dump/dump2.txt      # Block 2 (0x00000800)
+- ../asm_tests/mem_dump/dump3.txt      # Block 3 (0xFFFFFC00, stack)
 
-This script supports:
-- Parsing binary strings from assembler output and memory dumps.
-- Parsing expected values in 8-bit (B.), 16-bit (W.), or 32-bit (L.) format.
-- Comparing each memory byte and reporting mismatches.
+The four dumps are loaded into one NumPy uint8 array (with a mask of the bytes
+that were defined, i.e. not U or X in the simulation), the expected values into
+another (with a mask of the bits that are compared), and the whole memory is
+compared in one vectorized operation. Mismatches are grouped into contiguous
+ranges, and each range is reported with the longs it spans as a long, two words,
+and four bytes, expected and actual (- is a don't care digit, X an undefined one).
 
-The program memory checking feature was removed, in this current implementation,
-only data memory is compared with the memory contents dumped.
+Expected file format:
+    StartAddr: 0x0400       ; address of the values that follow (on the first line,
+                            ; and again anywhere to move to another address or block)
+    B.-5                    ; 8-bit value (binary b1010, hex 0x1F, or decimal)
+    W.2000                  ; 16-bit value
+    L.0x1234XXXX            ; 32-bit value, X hex digits (or binary bits) are don't
+                            ; cares, and L.X skips a long
+Values are big endian and packed one after the other; bytes not listed are not
+compared.
+
+The script exits with status 1 if any byte differs (so it can be used as the check
+of sh2_reduce.py --command).
 
 Author: Garrett Knuf
 Date:   26 Apr 2025
 """
 
+import argparse
 import sys
-from pathlib import Path
+from collections import namedtuple
+
+import numpy as np
+
+# Memory blocks of memory.vhd (START_ADDR0-3 of tb_sh2_cpu.vhd as byte addresses)
+BLOCK_SIZE = 0x400
+MEM_BLOCKS = (0x00000000, 0x00000400, 0x00000800, 0xFFFFFC00)
+
+# Files read by default
+DUMP_DIR = "../asm_tests/mem_dump"
+EXPECTED_FILE = "../asm_tests/expected/{}_exp.txt"
+
+# Longs shown for each range of mismatches, and the bytes that may match between
+# two mismatches of a range (so a long is not split between ranges)
+MAX_ROWS = 8
+MAX_GAP = 3
+
+# Sizes of the expected value prefixes
+VALUE_SIZES = {"B.": 1, "W.": 2, "L.": 4}
+
+# Whole memory: the bytes of the four blocks, and which of them are compared
+# (a mask of the bits for expected values, of the defined bytes for dumps)
+Memory = namedtuple("Memory", "values mask")
+
 
 def parse_memory(memory_text):
     """
-    Read in memory contents generated from assembly build (1 per line). Lines read
-    in should be 16-bit binary strings. Whitespace is removed and a colon indicates
-    that it and every character after is a comment.
+    Read in memory contents dumped by memory.vhd (or generated by the assembler),
+    1 16-bit binary string per line. Whitespace is removed and a semicolon indicates
+    that it and every character after is a comment. Bytes that are not all 0s and
+    1s (U or X in the simulation) are not defined.
     Example input:
         1110000001000000	; 0x00000050 : MOV     #64, R0
     Output:
-        ['11100000','01000000']
+        Memory(values=array([0xE0, 0x40]), mask=array([0xFF, 0xFF]))
     """
-    binary_values = []
-    
-    for line in memory_text.strip().splitlines():
-        # Split at semicolon to remove comments
-        parts = line.split(';')
-        bin_part = parts[0].strip()
-        
-        # Only process non-empty binary parts
-        if bin_part:
-            binary_values.append(bin_part[:8])
-            binary_values.append(bin_part[8:])
-    
-    return binary_values
+    words = [line.split(';')[0].strip() for line in memory_text.splitlines()]
+    words = [word[:16].ljust(16, 'U') for word in words if word]
+    bits = np.frombuffer("".join(words).encode(), dtype=np.uint8).reshape(-1, 8) - ord('0')
+    defined = (bits <= 1).all(axis=1)
+    values = np.packbits(bits == 1, axis=1)[:, 0]
+    return Memory(values, np.where(defined, 0xFF, 0).astype(np.uint8))
 
 
-def parse_value(val):
+def parse_value(val, size=4):
     """
     Parses a string representing a numer value in binary, hexadecimal, or decimal
-    format.
+    format, with the mask of its bits that are compared (X digits are don't cares).
 
     Support formats:
-    - Binary: prefixed with 'b' (e.g., 'b1010')
-    - Hexadecimal: prefixed with '0x' (e.g., '0x1F')
+    - Binary: prefixed with 'b' (e.g., 'b1010', 'b10XX')
+    - Hexadecimal: prefixed with '0x' (e.g., '0x1F', '0x1X')
     - Decimal: unprefixed (e.g., '42')
+    - Don't care: 'X'
+
+    Returns:
+        tuple: (value, mask) truncated to size bytes
     """
     val = val.strip()
+    all_bits = (1 << 8 * size) - 1
+    if val.upper() == "X":
+        return 0, 0
     if val.startswith("b"):  # Binary literal
-        return int(val[1:], 2)
+        digits, bits = val[1:], 1
     elif val.startswith("0x"):  # Hexadecimal
-        return int(val, 16)
+        digits, bits = val[2:], 4
     else:  # Decimal
-        return int(val)
+        return int(val) & all_bits, all_bits
+    value = int(digits.upper().replace("X", "0"), 2 ** bits)
+    mask = all_bits     # bits above the digits given are 0
+    for digit in digits:
+        mask = (mask << bits) | (0 if digit in "xX" else (1 << bits) - 1)
+    return value & all_bits, mask & all_bits
 
-# Main loop
-if __name__ == "__main__":
 
-    # Check if the correct number of arguments is passed
-    if len(sys.argv) != 2:
-        print("Usage: python mem_compare.py <test_name>")
-        sys.exit(1)
-
-    # Assembly build output (program memory)
-    asm_build_file = f"../asm_tests/build/build_mem0.txt"
-
-    # Assembly build output (data memory)
-    data_build_file = f"../asm_tests/build/build_mem1.txt"
-
-    # Expected data memory file
-    expected_memory_file = f"../asm_tests/expected/{sys.argv[1]}_exp.txt"
-
-    # Actual memory contents dumped during simulation
-    memory_dump_file0 = f"../asm_tests/mem_dump/dump0.txt"  # Program memory
-    memory_dump_file1 = f"../asm_tests/mem_dump/dump1.txt"  # Data memory
-
-    # Open assembly memory build
-    with open(asm_build_file, "r") as asm_file:
-        asm_build_text = asm_file.read()
-
-    # Open memory dump after test
-    with open(memory_dump_file0, "r") as dump_file0:
-        mem_dump_text0 = dump_file0.read()
-    with open(memory_dump_file1, "r") as dump_file1:
-        mem_dump_text1 = dump_file1.read()
-
-    # Open expected data file
-    start_addr = 0
-    exp_value_list = []
-    with open(expected_memory_file, "r") as exp_file:
-        for line_num, line in enumerate(exp_file):
-            line = line.split(';', 1)[0].strip()
-            if line_num == 0:
-                addr_str = line.split(": ")[1]
-                start_addr = int(addr_str, 16)
-            else:
-                if line.startswith("L."):
-                    value = parse_value(line[2:])  # 32-bit value
-                    # Split into four 8-bit chunks (big endian: MSB first)
-                    for shift in (24, 16, 8, 0):
-                        byte = (value >> shift) & 0xFF
-                        exp_value_list.append(f"{byte:08b}")
-                elif line.startswith("W."):
-                    value = parse_value(line[2:])  # 16-bit value
-                    for shift in (8, 0):
-                        byte = (value >> shift) & 0xFF
-                        exp_value_list.append(f"{byte:08b}")
-                elif line.startswith("B."):
-                    value = parse_value(line[2:])  # 8-bit value
-                    exp_value_list.append(f"{value & 0xFF:08b}")
-                else:
-                    print(f"Unknown line: {line}")
-
-        # Move expected values into correct memory contents
-        mem_arr = []
-        for i, bin_str in enumerate(exp_value_list):
-            mem_arr.append(bin_str)
-
-        # Check memory contents match
-        dump_arr1 = parse_memory(mem_dump_text1)
-        err_cnt = 0
-        for i, bin in enumerate(mem_arr):
-            if mem_arr[i] != dump_arr1[i]:
-                print(f"Error @ 0x{i+1024:04X} - expected {mem_arr[i]} - actual {dump_arr1[i]}")
-                err_cnt += 1
-
-        # Output test results
-        test_name = Path(asm_build_file).stem
-        if err_cnt == 0:
-            print(f"'{sys.argv[1]}.asm' tests passed!")
+def memory_index(addr):
+    """
+    Index of an address in the whole memory (the four blocks one after the other),
+    or None if it is not in a block.
+    """
+    for num, start in enumerate(MEM_BLOCKS):
+        if start <= addr < start + BLOCK_SIZE:
+            return num * BLOCK_SIZE + addr - start
+    return None
+
+
+def memory_address(index):
+    """
+    Address of an index of the whole memory.
+    """
+    return MEM_BLOCKS[index // BLOCK_SIZE] + index % BLOCK_SIZE
+
+
+def load_dumps(dump_dir=DUMP_DIR):
+    """
+    Loads the dumps of the four blocks into the whole memory (a block whose dump
+    is missing or short is undefined).
+
+    Returns:
+        Memory: the dumped memory
+    """
+    values = np.zeros(len(MEM_BLOCKS) * BLOCK_SIZE, dtype=np.uint8)
+    mask = np.zeros_like(values)
+    for num in range(len(MEM_BLOCKS)):
+        try:
+            with open(f"{dump_dir}/dump{num}.txt", "r") as dump_file:
+                dump = parse_memory(dump_file.read())
+        except FileNotFoundError:
+            continue
+        size = min(len(dump.values), BLOCK_SIZE)
+        values[num * BLOCK_SIZE:num * BLOCK_SIZE + size] = dump.values[:size]
+        mask[num * BLOCK_SIZE:num * BLOCK_SIZE + size] = dump.mask[:size]
+    return Memory(values, mask)
+
+
+def load_expected(expected_text):
+    """
+    Loads the expected values of a test into the whole memory.
+
+    Returns:
+        tuple: (Memory of the expected values, list of error messages for values
+                that are not understood or are outside the memory blocks)
+    """
+    indices, values, masks, errors = [], [], [], []
+    addr = None
+    for line_num, line in enumerate(expected_text.splitlines(), 1):
+        line = line.split(';', 1)[0].strip()
+        if not line:
+            continue
+        if "StartAddr:" in line:
+            addr = int(line.split(":", 1)[1], 16)
+        elif line[:2] in VALUE_SIZES and addr is not None:
+            size = VALUE_SIZES[line[:2]]
+            try:
+                value, mask = parse_value(line[2:], size)
+            except ValueError:
+                errors.append(f"Unknown line: {line}")
+                continue
+            for shift in range(8 * size - 8, -8, -8):  # big endian: MSB first
+                index = memory_index(addr)
+                if index is None:
+                    errors.append(f"Expected value at 0x{addr:08X} (line {line_num}) " +
+                                  "is outside the memory blocks")
+                elif (mask >> shift) & 0xFF:
+                    indices.append(index)
+                    values.append((value >> shift) & 0xFF)
+                    masks.append((mask >> shift) & 0xFF)
+                addr = (addr + 1) & 0xFFFFFFFF
         else:
-            print(f"Tests failed: {err_cnt} errors.")
+            errors.append(f"Unknown line: {line}")
+
+    expected = Memory(np.zeros(len(MEM_BLOCKS) * BLOCK_SIZE, dtype=np.uint8),
+                      np.zeros(len(MEM_BLOCKS) * BLOCK_SIZE, dtype=np.uint8))
+    expected.values[indices] = values
+    expected.mask[indices] = masks
+    return expected, errors
+
+
+def compare(actual, expected):
+    """
+    Compares the whole memory with the expected values: a byte differs if a bit
+    compared differs or the byte is not defined.
+
+    Returns:
+        np.ndarray: indices of the bytes that differ
+    """
+    return np.flatnonzero(((actual.values ^ expected.values) | ~actual.mask) & expected.mask)
+
+
+def mismatch_ranges(indices, gap=MAX_GAP):
+    """
+    Groups the indices of the bytes that differ into ranges (in one block), with up
+    to gap bytes that match between two that differ.
+
+    Returns:
+        list[(int, int, int)]: first and last index of each range, and the number
+                               of bytes that differ in it
+    """
+    if len(indices) == 0:
+        return []
+    breaks = np.flatnonzero((np.diff(indices) > gap + 1) | (np.diff(indices // BLOCK_SIZE) != 0))
+    starts = np.concatenate(([0], breaks + 1))
+    ends = np.concatenate((breaks, [len(indices) - 1]))
+    return list(zip(indices[starts].tolist(), indices[ends].tolist(), (ends - starts + 1).tolist()))
+
+
+def hex_digits(memory, index, size, undefined):
+    """
+    Formats size bytes of memory as hex digits, a don't care digit as - and an
+    undefined one (a byte of a dump that is not defined) as X.
+    """
+    digits = ""
+    for num in range(index, index + size):
+        for shift in (4, 0):
+            if (memory.mask[num] >> shift) & 0xF == 0xF:
+                digits += f"{(memory.values[num] >> shift) & 0xF:X}"
+            else:
+                digits += undefined
+    return digits
+
+
+def print_range(first, last, count, actual, expected, rows=MAX_ROWS):
+    """
+    Prints a range of bytes that differ with the longs it spans, as a long, two
+    words, and four bytes, expected and actual.
+    """
+    print(f"Error @ 0x{memory_address(first):08X}-0x{memory_address(last):08X} "
+          f"({count} byte{'s' if count > 1 else ''} differ{'' if count > 1 else 's'})")
+    longs = range(first - first % 4, last + 1, 4)
+    for index in longs[:rows]:
+        for name, memory, undefined in (("expected", expected, "-"), ("actual", actual, "X")):
+            addr = f"0x{memory_address(index):08X}" if name == "expected" else ""
+            words = " ".join("0x" + hex_digits(memory, index + offset, 2, undefined) for offset in (0, 2))
+            data = " ".join(hex_digits(memory, index + offset, 1, undefined) for offset in range(4))
+            print(f"    {addr:<12}{name:<10}0x{hex_digits(memory, index, 4, undefined)}  {words}  {data}")
+    if len(longs) > rows:
+        print(f"    ... {len(longs) - rows} more longs")
+
+
+def main(argv):
+    """
+    Command line entry point. Compares the memory dumped by the simulation with
+    the expected values of a test.
+    """
+    parser = argparse.ArgumentParser(prog="mem_compare.py", description="Memory Comparison")
+    parser.add_argument("test_name", help="base name of the test (without .asm)")
+    parser.add_argument("--dump-dir", default=DUMP_DIR, help="directory of dump0.txt to dump3.txt")
+    parser.add_argument("--expected", help="expected memory file (by default " +
+                        EXPECTED_FILE.format("<test_name>") + ")")
+    parser.add_argument("--rows", type=int, default=MAX_ROWS,
+                        help="longs shown for each range of errors (default %(default)d)")
+    args = parser.parse_args(argv[1:])
+
+    # Open expected data file and memory dumps after test
+    with open(args.expected or EXPECTED_FILE.format(args.test_name), "r") as exp_file:
+        expected, errors = load_expected(exp_file.read())
+    actual = load_dumps(args.dump_dir)
+    for error in errors:
+        print(error)
+
+    # Check memory contents match
+    indices = compare(actual, expected)
+    for first, last, count in mismatch_ranges(indices):
+        print_range(first, last, count, actual, expected, args.rows)
+
+    # Output test results
+    err_cnt = len(indices) + len(errors)
+    if err_cnt == 0:
+        print(f"'{args.test_name}.asm' tests passed!")
+    else:
+        print(f"Tests failed: {err_cnt} errors.")
+    return 1 if err_cnt else 0
+
+
+# Main loop
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
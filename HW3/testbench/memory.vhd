@@ -106,9 +106,8 @@ architecture  behavioral  of  MEMORY32x32  is
 
     file    MEM_FILE0 : text;
     file    MEM_FILE1 : text;
-    -- Warning: MEM_FILE2 and MEM_FILE3 are not used in this code
-    --  but are declared for completeness. They can be easily added
-    --  to the code if needed.
+    -- MEM_FILE2 and MEM_FILE3 are optional, they are only loaded if the
+    --  files exist (otherwise blocks 2 and 3 are left as X)
     file    MEM_FILE2 : text;
     file    MEM_FILE3 : text;
 
@@ -231,6 +230,7 @@ begin
         end procedure;
 
         variable files_loaded : std_logic := '0';
+        variable file_status  : file_open_status;
 
         -- data read from memory
         variable  MemData  :  std_logic_vector(31 downto 0);
@@ -241,6 +241,17 @@ begin
         if files_loaded = '0' then
             LoadMemFromFile(MEM_FILE0, RAMbits0);
             LoadMemFromFile(MEM_FILE1, RAMbits1);
+
+            -- Only load blocks 2 and 3 if their files exist
+            file_open(file_status, MEM_FILE2, MEM_FILEPATH2, read_mode);
+            if file_status = open_ok then
+                LoadMemFromFile(MEM_FILE2, RAMbits2);
+            end if;
+            file_open(file_status, MEM_FILE3, MEM_FILEPATH3, read_mode);
+            if file_status = open_ok then
+                LoadMemFromFile(MEM_FILE3, RAMbits3);
+            end if;
+
             files_loaded := '1';
         end if;
 
@@ -16,6 +16,8 @@
 -- Generics:
 --   mem0_filepath  -   Path for memory block 0 init file (program memory)
 --   mem1_filepath  -   Path for memory block 1 init file (data memory)
+--   mem2_filepath  -   Path for memory block 2 init file (optional)
+--   mem3_filepath  -   Path for memory block 3 init file (optional)
 --
 --  Revision History:
 --     17 April 2025    Garrett Knuf    Initial revision.
@@ -34,7 +36,9 @@ use work.CUConstants.all;
 entity tb_sh2_cpu is
     generic (
         mem0_filepath : string := "no_file_provided"; -- file to read memory from
-        mem1_filepath : string := "no_file_provided"  -- file to read memory from
+        mem1_filepath : string := "no_file_provided"; -- file to read memory from
+        mem2_filepath : string := "no_file_provided"; -- file to read memory from
+        mem3_filepath : string := "no_file_provided"  -- file to read memory from
     );
 end tb_sh2_cpu;
 
@@ -152,8 +156,8 @@ begin
                                            -- ((2^32) / 4) - 256 
             MEM_FILEPATH0  => mem0_filepath,
             MEM_FILEPATH1  => mem1_filepath,
-            MEM_FILEPATH2  => "memfile2.txt",
-            MEM_FILEPATH3  => "memfile3.txt"
+            MEM_FILEPATH2  => mem2_filepath,
+            MEM_FILEPATH3  => mem3_filepath
         )
         port map (
             RE0 => RE0,